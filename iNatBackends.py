@@ -0,0 +1,402 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatBackends.py
+# Backends that carry out the tools' geoprocessing steps (table import, observation selection, joins, feature and
+# CSV export, indexing and relationship creation), either with arcpy on file gdbs or with SQLite/GeoPackage and
+# NumPy, so the same tool logic runs in ArcGIS Pro or on a machine without ArcGIS
+
+# Notes:
+# - creating a backend imports nothing heavy; arcpy, NumPy and the spatial engine are imported the first time a
+#   method needs them
+# - getBackend chooses by name, then the INAT_BACKEND environment variable (arcpy or open), then whether arcpy is
+#   installed; backendFor chooses from a store path's extension and workingBackend from the working store found
+# - tables are written without indexes, which addIndexes then builds together
+# - GeoPackage outputs record their relationships in the relationships table (GeoPackage has no relationship
+#   classes) and index both keys of each
+
+# import Python packages
+import importlib.util
+import os
+import iNatCsv
+import iNatExchangeUtils
+import iNatStores
+
+
+# backend chosen when none is named, if set
+backend_variable = 'INAT_BACKEND'
+# table of the relationships of a GeoPackage output
+relationship_table = 'relationships'
+relationship_fields = [('name', 'TEXT'), ('origin', 'TEXT'), ('destination', 'TEXT'), ('primary_key', 'TEXT'),
+                       ('foreign_key', 'TEXT')]
+# rows inserted per call when writing a selection to several tables
+insert_size = 10000
+
+
+class Backend:
+    """Steps common to both backends, through the iNatStores working store interface"""
+    name = None
+    extension = None
+
+    def storePath(self, folder, name):
+        """Path of a store named name in folder, with this backend's extension."""
+        return folder + '/' + name + self.extension
+
+    def openStore(self, store_path):
+        return iNatStores.openStore(store_path)
+
+    def createStore(self, store_path):
+        """Create a store if it does not exist."""
+        self.openStore(store_path).close()
+
+    def exists(self, path):
+        """Whether a file, folder or store exists, or a table in a store (given as <store path>/<table>)."""
+        folder, table = os.path.split(path)
+        if os.path.splitext(folder)[1].lower() in ('.gdb', '.gpkg'):
+            if not os.path.exists(folder):
+                return False
+            store = self.openStore(folder)
+            exists = store.exists(table)
+            store.close()
+            return exists
+        return os.path.exists(path)
+
+    def fields(self, store_path, table):
+        store = self.openStore(store_path)
+        fields = store.fields(table)
+        store.close()
+        return fields
+
+    def createTable(self, store_path, table, source_store_path, source_table, geometry=False):
+        """Create an empty table (or point table if geometry) with the fields of a table in another store."""
+        store = self.openStore(store_path)
+        store.createTable(table, self.fields(source_store_path, source_table), geometry)
+        store.close()
+
+    def readRows(self, store_path, table, field_names=None, where=None):
+        """Yield the rows of a table, optionally limited to fields and a SQL where clause."""
+        store = self.openStore(store_path)
+        try:
+            yield from store.readRows(table, field_names, where)
+        finally:
+            store.close()
+
+    def jurisdictionIndex(self, messages=None):
+        """Prepared jurisdiction buffers for selections (terrestrial from the shapefile, as the gdb buffers need
+        arcpy)."""
+        import iNatSpatial
+        return iNatSpatial.loadJurisdictions(messages)
+
+    def canadaJurisdictions(self):
+        """Jurisdictions of jurisdictionIndex making up Canada (the CA group of the shapefile)."""
+        return ['CA']
+
+    def readIds(self, store_path, table, field):
+        """iNatJoins.IdSet of a field of a table."""
+        import iNatJoins
+        return iNatJoins.readIds(self.readRows(store_path, table, [field]))
+
+    def joinRows(self, store_path, table, key_field, id_set, join_memory=None, folder=None):
+        """Yield the rows of a table whose key_field is in id_set (all rows if id_set is None): a semi-join read in
+        one pass or, with a join_memory limit in bytes, an external sort and merge-join."""
+        import iNatJoins
+        field_names = [name for name, field_type in self.fields(store_path, table)]
+        rows = self.readRows(store_path, table, field_names)
+        if id_set is None:
+            return rows
+        if join_memory:
+            return iNatJoins.sortedSemiJoin(rows, field_names.index(key_field), id_set, join_memory, folder)
+        return iNatJoins.semiJoin(rows, field_names.index(key_field), id_set)
+
+    def exportRows(self, rows, store_path, table, field_names, csv_path, csv_compression=None):
+        """Insert rows into an existing table and write their attributes to a CSV as they are read; returns the
+        number of rows written."""
+        store = self.openStore(store_path)
+        geometry = field_names[-1] == 'SHAPE@XY'
+        with iNatCsv.CsvWriter(csv_path, field_names[:-1] if geometry else field_names,
+                               csv_compression) as csv_writer:
+            store.insertRows(table, field_names, iNatCsv.teeRows(rows, csv_writer, geometry))
+        store.close()
+        return csv_writer.rows
+
+    def addIndexes(self, store_path, indexes, workers=None, messages=None):
+        """Create a list of (table, field, index name) indexes in one stage once tables are written (see
+        iNatLoader.buildIndexes)."""
+        import iNatLoader
+        return iNatLoader.buildIndexes(store_path, indexes, workers, messages)
+
+    def createRelationships(self, store_path, bucket_names):
+        """Relate the tables of a jurisdiction output, including observations_all and each bucket's observations."""
+        for origin, destination, primary_key, foreign_key in iNatExchangeUtils.relationships:
+            self.createRelationship(store_path, origin, destination, primary_key, foreign_key)
+        for bucket_name in ['all'] + bucket_names:
+            for origin, destination, primary_key, foreign_key in iNatExchangeUtils.bucket_relationships:
+                self.createRelationship(store_path, origin.replace('observations', 'observations_' + bucket_name),
+                                        destination.replace('observations', 'observations_' + bucket_name),
+                                        primary_key, foreign_key)
+
+    def selectByJurisdiction(self, store_path, field_names, jurisdictions, admin1_name=None, messages=None):
+        """Yield observations (field_names plus SHAPE@XY) named as being in admin1_name or in the buffers of any
+        of a list of jurisdictions."""
+        raise NotImplementedError
+
+    def selectByPolygon(self, store_path, field_names, polygon, messages=None):
+        """Yield observations (field_names plus SHAPE@XY) intersecting a custom polygon."""
+        raise NotImplementedError
+
+    def selectObservations(self, store_path, field_names, jurisdictions=None, admin1_name=None, polygon=None,
+                           messages=None):
+        """Yield observations (field_names plus SHAPE@XY) selected by jurisdiction or custom polygon, or all
+        observations if neither is given."""
+        if jurisdictions:
+            return self.selectByJurisdiction(store_path, field_names, jurisdictions, admin1_name, messages)
+        if polygon:
+            return self.selectByPolygon(store_path, field_names, polygon, messages)
+        return self.readRows(store_path, 'observations', field_names + ['SHAPE@XY'])
+
+
+class ArcpyBackend(Backend):
+    """Steps run with arcpy geoprocessing on file gdbs"""
+    name = 'arcpy'
+    extension = '.gdb'
+
+    @property
+    def arcpy(self):
+        """arcpy, imported on first use."""
+        import arcpy
+        arcpy.env.overwriteOutput = True
+        return arcpy
+
+    def jurisdictionIndex(self, messages=None):
+        """Prepared jurisdiction buffers for selections, terrestrial from the gdb buffers (the polygons
+        SelectLayerByLocation and buildMembership use, so selections do not depend on whether membership was
+        built)."""
+        import iNatSpatial
+        return iNatSpatial.loadJurisdictions(messages, iNatSpatial.jurisdiction_buffer)
+
+    def canadaJurisdictions(self):
+        """Jurisdictions of jurisdictionIndex making up Canada, those of the gdb buffers selected by
+        iNatSpatial.canada_where."""
+        import iNatSpatial
+        with self.arcpy.da.SearchCursor(iNatSpatial.jurisdiction_buffer, ['JurisdictionAbbreviation'],
+                                        iNatSpatial.canada_where) as cursor:
+            return [row[0] for row in cursor]
+
+    def exists(self, path):
+        return self.arcpy.Exists(path)
+
+    def createStore(self, store_path):
+        if not self.arcpy.Exists(store_path):
+            self.arcpy.management.CreateFileGDB(os.path.dirname(store_path), os.path.basename(store_path))
+
+    def createTable(self, store_path, table, source_store_path, source_table, geometry=False):
+        # the source table is the template, keeping its field lengths and spatial reference
+        source = source_store_path + '/' + source_table
+        if geometry:
+            self.arcpy.management.CreateFeatureclass(store_path, table, 'POINT', source, spatial_reference=source)
+        else:
+            self.arcpy.management.CreateTable(store_path, table, source)
+
+    def importTable(self, csv_path, store_path, table, drop_fields=()):
+        """Import a CSV as a table with TableToTable (then sorted by the table's cluster key, if it has one) and
+        return the number of rows."""
+        arcpy = self.arcpy
+        cluster_key = iNatExchangeUtils.cluster_keys.get(table)
+        if cluster_key:
+            arcpy.conversion.TableToTable(csv_path, store_path, table + '_unsorted')
+            arcpy.management.Sort(store_path + '/' + table + '_unsorted', store_path + '/' + table,
+                                  [[cluster_key, 'ASCENDING']])
+            arcpy.management.Delete(store_path + '/' + table + '_unsorted')
+        else:
+            arcpy.conversion.TableToTable(csv_path, store_path, table)
+        for field in drop_fields:
+            arcpy.management.DeleteField(store_path + '/' + table, field)
+        return int(arcpy.management.GetCount(store_path + '/' + table)[0])
+
+    def importObservations(self, csv_path, store_path, messages=None):
+        """Import the observations CSV as points, giving preference to private coordinates where available and
+        leaving out geoprivacy = 'private', and return the number of observations."""
+        arcpy = self.arcpy
+        arcpy.conversion.TableToTable(csv_path, store_path, 'obs_temp')
+        obs_temp = store_path + '/obs_temp'
+        iNatExchangeUtils.displayMessage(messages,
+                                         'Plotting observations, preferring private coordinates where available')
+        arcpy.management.AddField(obs_temp, 'lon', 'DOUBLE')
+        arcpy.management.AddField(obs_temp, 'lat', 'DOUBLE')
+        arcpy.management.AddField(obs_temp, 'observed_on_text', 'TEXT')
+        expr = '''
+def get_coord(coord, private_coord):
+    if private_coord:
+        return private_coord
+    else:
+        return coord'''
+        arcpy.management.CalculateField(obs_temp, 'lon', 'get_coord(!longitude!, !private_longitude!)', 'PYTHON3',
+                                        expr)
+        arcpy.management.CalculateField(obs_temp, 'lat', 'get_coord(!latitude!, !private_latitude!)', 'PYTHON3',
+                                        expr)
+        # newer versions of ArcGIS interpret observed_on as Date Only, which Python interprets as Text not as
+        # DateTime
+        arcpy.management.CalculateField(obs_temp, 'observed_on_text', '!observed_on!', 'PYTHON3')
+        # arcpy.management.CalculateField(obs_temp, 'observed_on_text', "!observed_on!.strftime('%Y-%m-%d')",
+        #                                 'PYTHON3')
+        arcpy.management.MakeTableView(obs_temp, 'obs_temp_vw', "geoprivacy IS NULL OR geoprivacy <> 'private'")
+        arcpy.management.XYTableToPoint('obs_temp_vw', store_path + '/observations', 'lon', 'lat')
+        arcpy.management.Delete('obs_temp_vw')
+        arcpy.management.Delete(obs_temp)
+        return int(arcpy.management.GetCount(store_path + '/observations')[0])
+
+    def selectByJurisdiction(self, store_path, field_names, jurisdictions, admin1_name=None, messages=None):
+        import iNatSpatial
+        arcpy = self.arcpy
+        if not arcpy.Exists(store_path + '/' + iNatSpatial.membership_table):
+            # observations named as being in the jurisdiction, then those inside the terrestrial or marine buffers
+            # from the geometry cache, read without writing to the working store (which would change its
+            # fingerprint, and could collide with a concurrent export)
+            named = "place_admin1_name = '" + admin1_name.replace("'", "''") + "'" if admin1_name else None
+            if named:
+                yield from self.readRows(store_path, 'observations', field_names + ['SHAPE@XY'], named)
+            index = self.jurisdictionIndex(messages)
+            rows = self.readRows(store_path, 'observations', field_names + ['SHAPE@XY'],
+                                 'NOT (' + named + ') OR place_admin1_name IS NULL' if named else None)
+            yield from iNatSpatial.insideRows(rows, index, jurisdictions)
+            return
+        arcpy.management.MakeFeatureLayer(store_path + '/observations', 'obs_lyr')
+        if admin1_name:
+            arcpy.management.SelectLayerByAttribute('obs_lyr', 'NEW_SELECTION',
+                                                    "place_admin1_name in '" + admin1_name + "'")
+        # buffer intersections were computed once at import
+        arcpy.management.SelectLayerByAttribute('obs_lyr', 'ADD_TO_SELECTION',
+                                                iNatSpatial.membershipWhere(jurisdictions))
+        try:
+            with arcpy.da.SearchCursor('obs_lyr', field_names + ['SHAPE@XY']) as cursor:
+                yield from cursor
+        finally:
+            arcpy.management.Delete('obs_lyr')
+
+    def selectByPolygon(self, store_path, field_names, polygon, messages=None):
+        arcpy = self.arcpy
+        arcpy.management.MakeFeatureLayer(store_path + '/observations', 'obs_lyr')
+        arcpy.management.SelectLayerByLocation('obs_lyr', 'INTERSECT', polygon)
+        try:
+            with arcpy.da.SearchCursor('obs_lyr', field_names + ['SHAPE@XY']) as cursor:
+                yield from cursor
+        finally:
+            arcpy.management.Delete('obs_lyr')
+
+    def createRelationship(self, store_path, origin, destination, primary_key, foreign_key):
+        """Create a one to many relationship class from origin to destination."""
+        self.arcpy.management.CreateRelationshipClass(store_path + '/' + origin, store_path + '/' + destination,
+                                                      store_path + '/' + origin + '_' + destination, 'SIMPLE',
+                                                      destination, origin, 'NONE', 'ONE_TO_MANY', 'NONE',
+                                                      primary_key, foreign_key)
+
+
+class OpenBackend(Backend):
+    """Steps run with SQLite/GeoPackage and the NumPy spatial engine, without ArcGIS"""
+    name = 'open'
+    extension = '.gpkg'
+
+    def importTable(self, csv_path, store_path, table, drop_fields=()):
+        """Stream a CSV into a table and return the number of rows."""
+        import iNatLoader
+        store = self.openStore(store_path)
+        count = iNatLoader.loadTable(csv_path, store, table, None, drop_fields)
+        store.close()
+        return count
+
+    def importObservations(self, csv_path, store_path, messages=None):
+        """Stream the observations CSV into a point table, giving preference to private coordinates where
+        available and leaving out geoprivacy = 'private', and return the number of observations."""
+        import iNatLoader
+        store = self.openStore(store_path)
+        count = iNatLoader.loadObservations(csv_path, store, messages)
+        store.close()
+        return count
+
+    def selectByJurisdiction(self, store_path, field_names, jurisdictions, admin1_name=None, messages=None):
+        import iNatFrame
+        import iNatJoins
+        import iNatSpatial
+        store = self.openStore(store_path)
+        named = "place_admin1_name = '" + admin1_name.replace("'", "''") + "'" if admin1_name else None
+        try:
+            if store.exists(iNatSpatial.membership_table):
+                # buffer intersections were computed once at import
+                where = iNatSpatial.membershipWhere(jurisdictions) + (' OR ' + named if named else '')
+                yield from store.readRows('observations', field_names + ['SHAPE@XY'], where)
+                return
+            frame = iNatFrame.loadFrame(store_path, messages)
+            if frame is not None:
+                # name and buffer tests as masks over the observation frame, then one read of the selected rows
+                index = self.jurisdictionIndex(messages)
+                mask = frame.insideMask(index, jurisdictions)
+                if admin1_name:
+                    mask |= frame.isIn('place_admin1_name', [admin1_name])
+                rows = store.readRows('observations', field_names + ['SHAPE@XY'])
+                yield from iNatJoins.semiJoin(rows, field_names.index('id'), frame.selectIds(mask))
+                return
+            # observations named as being in the jurisdiction, then those inside its cached buffers
+            if named:
+                yield from store.readRows('observations', field_names + ['SHAPE@XY'], named)
+            index = self.jurisdictionIndex(messages)
+            rows = store.readRows('observations', field_names + ['SHAPE@XY'],
+                                  'NOT (' + named + ') OR place_admin1_name IS NULL' if named else None)
+            yield from iNatSpatial.insideRows(rows, index, jurisdictions)
+        finally:
+            store.close()
+
+    def selectByPolygon(self, store_path, field_names, polygon, messages=None):
+        import iNatSpatial
+        rows = self.readRows(store_path, 'observations', field_names + ['SHAPE@XY'])
+        return iNatSpatial.insideRows(rows, iNatSpatial.polygonIndex(polygon), ['custom'])
+
+    def createRelationships(self, store_path, bucket_names):
+        # a rerun replaces the relationships recorded before
+        store = self.openStore(store_path)
+        store.createTable(relationship_table, relationship_fields)
+        store.close()
+        Backend.createRelationships(self, store_path, bucket_names)
+
+    def createRelationship(self, store_path, origin, destination, primary_key, foreign_key):
+        """Record a one to many relationship from origin to destination and index its keys."""
+        store = self.openStore(store_path)
+        if not store.exists(relationship_table):
+            store.createTable(relationship_table, relationship_fields)
+        store.insertRows(relationship_table, [field for field, field_type in relationship_fields],
+                         [(origin + '_' + destination, origin, destination, primary_key, foreign_key)])
+        store.addIndex(origin, [primary_key], primary_key + '_idx')
+        store.addIndex(destination, [foreign_key], foreign_key + '_idx')
+        store.close()
+
+
+backends = {'arcpy': ArcpyBackend, 'open': OpenBackend}
+
+
+def getBackend(name=None):
+    """Backend by name ('arcpy' or 'open'), else the one named by INAT_BACKEND, else arcpy if it is installed."""
+    name = name or os.environ.get(backend_variable)
+    if not name:
+        name = 'arcpy' if importlib.util.find_spec('arcpy') is not None else 'open'
+    return backends[name]()
+
+
+def backendFor(store_path):
+    """Backend for a store, from its extension."""
+    return OpenBackend() if os.path.splitext(store_path)[1].lower() == '.gpkg' else ArcpyBackend()
+
+
+def workingBackend(store_base):
+    """Backend for the working store <store_base>.gdb or <store_base>.gpkg: the one named by INAT_BACKEND, else the
+    one whose store exists (preferring the gdb when arcpy is installed), else the default."""
+    if os.environ.get(backend_variable):
+        return getBackend()
+    default = getBackend()
+    for backend in [default] + [backends[name]() for name in backends if name != default.name]:
+        if os.path.exists(store_base + backend.extension):
+            if backend.name == 'arcpy' and importlib.util.find_spec('arcpy') is None:
+                continue
+            return backend
+    return default
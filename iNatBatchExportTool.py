@@ -0,0 +1,394 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatBatchExportTool.py
+# ArcGIS Python tool for exporting iNaturalist.ca records for many jurisdictions at once, scanning the working store
+# once and fanning rows out to per-jurisdiction writers running in parallel worker processes
+
+# Notes:
+# - requires the observation_jurisdictions membership table created by the iNat Import Tool
+# - outputs have the same layout as the iNat Jurisdiction Export Tool (one folder, gdb/GeoPackage and CSVs each)
+
+# import Python packages
+import datetime
+import multiprocessing
+import os
+import queue
+import iNatBackends
+import iNatCsv
+import iNatDelta
+import iNatExchangeUtils
+import iNatSpatial
+import iNatStores
+
+
+# rows buffered per jurisdiction and table before being sent to a writer
+send_size = 5000
+# seconds to wait on a full writer queue before checking that the writer is still running
+put_timeout = 5
+
+
+class JurisdictionWriter:
+    """Write the tables of one jurisdiction to its gdb/GeoPackage and CSVs"""
+    def __init__(self, jur_label, jur_folder, store_path, date_label, csv_compression=None):
+        self.jur_label = jur_label
+        self.jur_folder = jur_folder
+        self.store_path = store_path
+        self.date_label = date_label
+        self.csv_compression = csv_compression
+        if not os.path.exists(jur_folder):
+            os.makedirs(jur_folder)
+        self.store = iNatStores.openStore(store_path)
+        self.field_names = {}
+        self.csv_writers = {}
+
+    def createTable(self, table, fields, geometry):
+        self.store.createTable(table, fields, geometry)
+        names = [name for name, field_type in fields]
+        self.field_names[table] = names + ['SHAPE@XY'] if geometry else names
+        # csvs hold attributes only, as TableToTable does
+        self.csv_writers[table] = iNatCsv.CsvWriter(self.jur_folder + '/iNat_' + table + '_' + self.date_label +
+                                                    '.csv', names, self.csv_compression)
+
+    def writeRows(self, table, rows):
+        self.store.insertRows(table, self.field_names[table], rows)
+        if self.field_names[table][-1] == 'SHAPE@XY':
+            rows = [row[:-1] for row in rows]
+        self.csv_writers[table].writerows(rows)
+
+    def finish(self, bucket_names):
+        """Close csvs, then index and relate the tables."""
+        while self.csv_writers:
+            table, csv_writer = self.csv_writers.popitem()
+            csv_writer.close()
+        # all indexes in one batch once the tables are written
+        self.store.addIndexes([(table, [field], index_name) for table, field, index_name in
+                               iNatExchangeUtils.outputIndexes(list(self.field_names))])
+        self.store.close()
+        iNatBackends.backendFor(self.store_path).createRelationships(self.store_path, bucket_names)
+
+    def abort(self):
+        """Discard the csvs not yet closed, leaving any existing outputs untouched."""
+        while self.csv_writers:
+            table, csv_writer = self.csv_writers.popitem()
+            try:
+                csv_writer.abort()
+            except (OSError, ValueError):
+                pass
+
+
+def writerProcess(queue, outputs, date_label, bucket_names, csv_compression=None):
+    """Consume (jurisdiction, action, table, payload) messages for a group of jurisdictions until None arrives (or
+    an abort message, which discards their csvs)."""
+    writers = {}
+    try:
+        for jur_label, (jur_folder, store_path) in outputs.items():
+            writers[jur_label] = JurisdictionWriter(jur_label, jur_folder, store_path, date_label, csv_compression)
+        while True:
+            message = queue.get()
+            if message is None:
+                break
+            jur_label, action, table, payload = message
+            if action == 'abort':
+                # another writer failed
+                for writer in writers.values():
+                    writer.abort()
+                return
+            if action == 'create':
+                writers[jur_label].createTable(table, *payload)
+            elif table.startswith('observations_'):
+                # bucket rows are also written to observations_all
+                writers[jur_label].writeRows(table, payload)
+                writers[jur_label].writeRows('observations_all', payload)
+            else:
+                writers[jur_label].writeRows(table, payload)
+        for writer in writers.values():
+            writer.finish(bucket_names)
+    except BaseException:
+        # no partial csvs are left behind (the exit code tells the controlling process)
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+
+class iNatBatchExportTool:
+    """Export iNaturalist.ca records for many jurisdictions in one pass over the working store"""
+    def __init__(self):
+        pass
+
+    def runiNatBatchExportTool(self, parameters, messages):
+        # start time
+        start_time = datetime.datetime.now()
+        iNatExchangeUtils.displayMessage(messages, 'Start time: ' + str(start_time))
+
+        # make variables for parms
+        iNatExchangeUtils.displayMessage(messages, 'Processing parameters')
+        iNatExchangeUtils.project_path = parameters[0].valueAsText
+        iNatExchangeUtils.output_path = iNatExchangeUtils.project_path + '/' + iNatExchangeUtils.output_folder
+        iNatExchangeUtils.input_label = parameters[1].valueAsText
+        iNatExchangeUtils.date_label = parameters[2].valueAsText
+        jur_labels = [label.strip("' ") for label in parameters[3].valueAsText.split(';')]
+        if 'changed' in jur_labels:
+            # jurisdictions whose observations changed in a delta import
+            manifest = iNatDelta.readManifest(iNatExchangeUtils.input_label)
+            if manifest is None or manifest['changed_jurisdictions'] is None:
+                iNatExchangeUtils.displayMessage(messages, 'No delta manifest with changed jurisdictions, ' +
+                                                 'exporting all')
+                jur_labels = ['all']
+            else:
+                jur_labels = [jur_label for jur_label in jur_labels if jur_label != 'changed'] + \
+                    [jur_label for jur_label in manifest['changed_jurisdictions'] if jur_label not in jur_labels]
+                if not jur_labels:
+                    iNatExchangeUtils.displayMessage(messages, 'No jurisdictions changed')
+                    return
+                iNatExchangeUtils.displayMessage(messages, 'Changed jurisdictions: ' + ', '.join(jur_labels))
+        if 'all' in jur_labels:
+            jur_labels = list(iNatExchangeUtils.prov_dict.keys())
+        bucket_names = [bucket_name for bucket_name, param in zip(iNatExchangeUtils.bucket_names, parameters[4:8])
+                        if param.valueAsText == 'true']
+        if not bucket_names:
+            iNatExchangeUtils.displayMessage(messages, 'ERROR: you must include at least one set of records')
+            # terminate with error
+            return
+        extension = '.gpkg' if parameters[8].valueAsText == 'GeoPackage' else '.gdb'
+        workers = int(parameters[9].valueAsText) if parameters[9].valueAsText else os.cpu_count()
+        iNatExchangeUtils.csv_compression = iNatCsv.compressionOption(parameters[10].valueAsText)
+        store_path = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + extension
+        if not iNatBackends.backendFor(store_path).exists(store_path + '/' + iNatSpatial.membership_table):
+            iNatExchangeUtils.displayMessage(messages, 'ERROR: the working store has no ' +
+                                             iNatSpatial.membership_table + ' table; rerun the iNat Import Tool')
+            # terminate with error
+            return
+        missing = iNatSpatial.missingMarine(store_path, jur_labels)
+        if missing:
+            iNatExchangeUtils.displayMessage(messages, 'ERROR: the working store\'s membership table has no marine ' +
+                                             'buffers (imported without arcpy), which ' + ', '.join(missing) +
+                                             ' need; reimport with arcpy or export only other jurisdictions')
+            # terminate with error
+            return
+        store = iNatStores.openStore(store_path)
+        iNatExchangeUtils.startRun('iNatBatchExport', messages)
+        try:
+
+            # one bit per jurisdiction; each province/territory sets the bits of every jurisdiction that contains it
+            jur_bits = dict((jur_label, 1 << i) for i, jur_label in enumerate(jur_labels))
+            member_bits = {}
+            for jur_label in jur_labels:
+                for jurisdiction in iNatExchangeUtils.jurisdiction_groups.get(jur_label, [jur_label]):
+                    member_bits[jurisdiction] = member_bits.get(jurisdiction, 0) | jur_bits[jur_label]
+            # observations named as being in a province (matching place_admin1_name in '<name>' for all but CA)
+            name_bits = dict((iNatExchangeUtils.prov_dict[jur_label], jur_bits[jur_label]) for jur_label in jur_labels
+                             if jur_label != 'CA')
+            membership = {}
+            with iNatExchangeUtils.stage('Reading jurisdiction membership', messages) as stage:
+                for observation_id, jurisdiction in store.readRows(iNatSpatial.membership_table,
+                                                                   ['observation_id', 'jurisdiction']):
+                    stage.rows += 1
+                    bits = member_bits.get(jurisdiction)
+                    if bits:
+                        membership[observation_id] = membership.get(observation_id, 0) | bits
+
+            # start writers, spreading the jurisdictions over the worker processes
+            iNatExchangeUtils.setWorkerExecutable()
+            workers = max(1, min(workers, len(jur_labels)))
+            processes = []
+            # one jurisdiction of each writer, to address the writer itself
+            writer_labels = jur_labels[:workers]
+            jur_queues = {}
+            jur_processes = {}
+            for worker in range(workers):
+                outputs = {}
+                for jur_label in jur_labels[worker::workers]:
+                    jur_folder = iNatExchangeUtils.output_path + '/' + jur_label
+                    outputs[jur_label] = (jur_folder, jur_folder + '/iNat_' + jur_label + '_' +
+                                          iNatExchangeUtils.date_label + extension)
+                writer_queue = multiprocessing.Queue(maxsize=100)
+                process = multiprocessing.Process(target=writerProcess,
+                                                  args=(writer_queue, outputs, iNatExchangeUtils.date_label,
+                                                        bucket_names, iNatExchangeUtils.csv_compression))
+                for jur_label in outputs:
+                    jur_queues[jur_label] = writer_queue
+                    jur_processes[jur_label] = process
+                process.start()
+                processes.append(process)
+            buffers = {}
+
+            def put(jur_label, message):
+                """Queue a message for the writer of a jurisdiction, stopping all writers and raising if it has died
+                rather than waiting on its full queue forever."""
+                while True:
+                    try:
+                        jur_queues[jur_label].put(message, timeout=put_timeout)
+                        return
+                    except queue.Full:
+                        if not jur_processes[jur_label].is_alive():
+                            stopWriters()
+                            raise RuntimeError('the writer for ' + jur_label + ' stopped (exit code ' +
+                                               str(jur_processes[jur_label].exitcode) + ')')
+
+            def stopWriters():
+                """Ask the running writers to discard their csvs, terminating any that have not stopped in time."""
+                for jur_label in writer_labels:
+                    if jur_processes[jur_label].is_alive():
+                        try:
+                            jur_queues[jur_label].put((jur_label, 'abort', None, None), timeout=put_timeout)
+                        except queue.Full:
+                            pass
+                for process in processes:
+                    process.join(put_timeout)
+                    if process.is_alive():
+                        process.terminate()
+                # rows still queued for stopped writers are dropped rather than blocking exit
+                for jur_label in writer_labels:
+                    jur_queues[jur_label].cancel_join_thread()
+
+            def send(bits, table, row):
+                """Buffer a row for every jurisdiction in bits, sending full buffers to the writers."""
+                for jur_label, jur_bit in jur_bits.items():
+                    if bits & jur_bit:
+                        buffer = buffers.setdefault((jur_label, table), [])
+                        buffer.append(row)
+                        if len(buffer) >= send_size:
+                            put(jur_label, (jur_label, 'rows', table, buffer))
+                            buffers[(jur_label, table)] = []
+
+            def flush():
+                for (jur_label, table), buffer in buffers.items():
+                    if buffer:
+                        put(jur_label, (jur_label, 'rows', table, buffer))
+                buffers.clear()
+
+            def create(table, fields, geometry=False):
+                for jur_label in jur_labels:
+                    put(jur_label, (jur_label, 'create', table, (fields, geometry)))
+
+            # observations, split into buckets
+            with iNatExchangeUtils.stage('Exporting observations', messages) as stage:
+                fields = store.fields('observations')
+                field_names = [name for name, field_type in fields]
+                for table in ['observations_' + bucket_name for bucket_name in bucket_names] + ['observations_all']:
+                    create(table, fields, geometry=True)
+                id_index = field_names.index('id')
+                taxon_index = field_names.index('taxon_id')
+                admin1_index = field_names.index('place_admin1_name')
+                geoprivacy_index = field_names.index('geoprivacy')
+                taxon_geoprivacy_index = field_names.index('taxon_geoprivacy')
+                private_latitude_index = field_names.index('private_latitude')
+                observation_bits = {}
+                taxon_bits = {}
+                for row in store.readRows('observations', field_names + ['SHAPE@XY']):
+                    stage.rows += 1
+                    bits = membership.get(row[id_index], 0) | name_bits.get(row[admin1_index], 0)
+                    if not bits:
+                        continue
+                    bucket_name = iNatExchangeUtils.observationBucket(row[geoprivacy_index],
+                                                                       row[taxon_geoprivacy_index],
+                                                                       row[private_latitude_index])
+                    if bucket_name not in bucket_names:
+                        continue
+                    observation_bits[row[id_index]] = bits
+                    taxon_bits[row[taxon_index]] = taxon_bits.get(row[taxon_index], 0) | bits
+                    send(bits, 'observations_' + bucket_name, row)
+            del membership
+
+            # tables related to observations
+            for table, key_field in iNatExchangeUtils.observation_keys.items():
+                with iNatExchangeUtils.stage('Exporting ' + table, messages) as stage:
+                    fields = store.fields(table)
+                    field_names = [name for name, field_type in fields]
+                    create(table, fields)
+                    key_index = field_names.index(key_field)
+                    taxon_index = field_names.index('taxon_id') if table == 'identifications' else None
+                    for row in store.readRows(table, field_names):
+                        stage.rows += 1
+                        bits = observation_bits.get(row[key_index])
+                        if bits:
+                            send(bits, table, row)
+                            if taxon_index is not None:
+                                taxon_bits[row[taxon_index]] = taxon_bits.get(row[taxon_index], 0) | bits
+
+            # taxa of observations and identifications, then their conservation statuses
+            for table, key_field in (('taxa', 'id'), ('conservation_statuses', 'taxon_id')):
+                with iNatExchangeUtils.stage('Exporting ' + table, messages) as stage:
+                    fields = store.fields(table)
+                    field_names = [name for name, field_type in fields]
+                    create(table, fields)
+                    key_index = field_names.index(key_field)
+                    exported_bits = {}
+                    for row in store.readRows(table, field_names):
+                        stage.rows += 1
+                        bits = taxon_bits.get(row[key_index])
+                        if bits:
+                            send(bits, table, row)
+                            exported_bits[row[key_index]] = bits
+                    # statuses only for taxa actually exported
+                    taxon_bits = exported_bits
+
+            # all records, no subsetting
+            all_bits = sum(jur_bits.values())
+            for table in ('observation_fields', 'users'):
+                with iNatExchangeUtils.stage('Exporting ' + table, messages) as stage:
+                    fields = store.fields(table)
+                    create(table, fields)
+                    for row in store.readRows(table, [name for name, field_type in fields]):
+                        stage.rows += 1
+                        send(all_bits, table, row)
+            flush()
+
+            # wait for writers to index and relate their outputs
+            with iNatExchangeUtils.stage('Finishing ' + str(len(jur_labels)) + ' jurisdictions', messages):
+                for jur_label in writer_labels:
+                    put(jur_label, None)
+                failures = []
+                for process in processes:
+                    process.join()
+                    if process.exitcode != 0:
+                        failures.append(', '.join(jur_label for jur_label in jur_labels
+                                                  if jur_processes[jur_label] is process) +
+                                        ' (exit code ' + str(process.exitcode) + ')')
+                # partial outputs must not look like a finished run
+                if failures:
+                    raise RuntimeError('the jurisdiction writers for ' + '; '.join(failures) + ' failed')
+        finally:
+            store.close()
+            iNatExchangeUtils.finishRun(messages)
+
+        # finish time
+        finish_time = datetime.datetime.now()
+        iNatExchangeUtils.displayMessage(messages, 'Finish time: ' + str(finish_time))
+
+
+# controlling process
+if __name__ == '__main__':
+    import arcpy
+    inbe = iNatBatchExportTool()
+    # hard code parameters for debugging
+    param_project_path = arcpy.Parameter()
+    param_project_path.value = 'D:/GIS/iNatExchange'
+    param_input_label = arcpy.Parameter()
+    param_input_label.value = 'inaturalist-canada-5'
+    param_date_label = arcpy.Parameter()
+    param_date_label.value = '5Dec2025'
+    param_jurisdictions = arcpy.Parameter()
+    param_jurisdictions.value = 'all'
+    param_include_ca_geo_obscured = arcpy.Parameter()
+    param_include_ca_geo_obscured.value = 'true'
+    param_include_ca_taxon_obscured = arcpy.Parameter()
+    param_include_ca_taxon_obscured.value = 'true'
+    param_include_org_obscured = arcpy.Parameter()
+    param_include_org_obscured.value = 'true'
+    param_include_unobscured = arcpy.Parameter()
+    param_include_unobscured.value = 'true'
+    param_store_format = arcpy.Parameter()
+    param_store_format.value = 'File Geodatabase'
+    param_workers = arcpy.Parameter()
+    param_workers.value = None
+    param_csv_compression = arcpy.Parameter()
+    param_csv_compression.value = None
+    parameters = [param_project_path, param_input_label, param_date_label, param_jurisdictions,
+                  param_include_ca_geo_obscured, param_include_ca_taxon_obscured, param_include_org_obscured,
+                  param_include_unobscured, param_store_format, param_workers, param_csv_compression]
+    inbe.runiNatBatchExportTool(parameters, None)
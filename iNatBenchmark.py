@@ -0,0 +1,295 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatBenchmark.py
+# Synthetic iNaturalist.ca extracts at any scale and an end-to-end benchmark of import, jurisdiction export and
+# EBAR export on the GeoPackage (no arcpy) path
+
+# Notes:
+# - extracts are written to <project path>/Input/synthetic-<observations>, with the same ten CSVs the import reads
+# - each run appends one line per stage to <project path>/benchmark_results.csv, so scaling curves and
+#   regressions can be compared between releases
+# - python iNatBenchmark.py <project path> [observations ...] (default 10000 100000)
+
+# import Python packages
+import csv
+import datetime
+import io
+import os
+import platform
+import shutil
+import sys
+import time
+import numpy
+import iNatExchangeUtils
+import iNatLoader
+import iNatSpatial
+import iNatStores
+
+
+# observations generated per chunk
+chunk_size = 500000
+# mean rows per observation in each child table
+child_rates = {'identifications': 1.8, 'comments': 0.3, 'annotations': 0.5, 'observation_field_values': 0.2,
+               'quality_metrics': 0.1}
+# share of observations with each geoprivacy, and of taxa with each taxon_geoprivacy
+geoprivacy_mix = {'': 0.85, 'open': 0.04, 'obscured': 0.09, 'private': 0.02}
+taxon_geoprivacy_mix = {'': 0.9, 'open': 0.02, 'obscured': 0.07, 'private': 0.01}
+# share of obscured/private observations whose true coordinates are shared with iNaturalist.ca
+private_share = 0.85
+# degrees obscured coordinates are moved
+obscure_offset = 0.2
+iconic_taxa = ['Plantae', 'Insecta', 'Aves', 'Fungi', 'Mammalia', 'Reptilia', 'Amphibia', 'Mollusca', 'Arachnida']
+table_fields = {
+    'observations': ['id', 'observed_on', 'time_observed_at', 'user_id', 'created_at', 'quality_grade', 'license',
+                     'url', 'description', 'captive_cultivated', 'place_guess', 'latitude', 'longitude',
+                     'positional_accuracy', 'private_latitude', 'private_longitude', 'public_positional_accuracy',
+                     'geoprivacy', 'taxon_geoprivacy', 'coordinates_obscured', 'place_admin1_name',
+                     'scientific_name', 'common_name', 'iconic_taxon_name', 'taxon_id'],
+    'identifications': ['id', 'observation_id', 'user_id', 'taxon_id', 'category', 'current', 'created_at'],
+    'comments': ['id', 'parent_type', 'parent_id', 'user_id', 'body', 'created_at'],
+    'annotations': ['id', 'resource_type', 'resource_id', 'controlled_attribute_id', 'controlled_value_id',
+                    'user_id', 'created_at'],
+    'observation_field_values': ['id', 'observation_id', 'observation_field_id', 'value', 'user_id', 'created_at'],
+    'quality_metrics': ['id', 'observation_id', 'user_id', 'metric', 'agree', 'created_at'],
+    'observation_fields': ['id', 'name', 'datatype', 'user_id', 'description', 'created_at'],
+    'taxa': ['id', 'ancestry', 'rank_level', 'rank', 'name', 'active'],
+    'conservation_statuses': ['id', 'taxon_id', 'user_id', 'status', 'authority', 'iucn', 'geoprivacy', 'place_id'],
+    'users': ['id', 'login', 'name', 'email', 'created_at']}
+ranks = [(70, 'kingdom'), (60, 'phylum'), (50, 'class'), (40, 'order'), (30, 'family'), (20, 'genus'),
+         (10, 'species')]
+
+
+class Parameter:
+    """Stand-in for arcpy.Parameter when running tools without ArcGIS"""
+    def __init__(self, value=None):
+        self.valueAsText = None if value is None else str(value)
+
+
+def choose(random, mix, count):
+    """Draw count values from a {value: share} mix."""
+    values = list(mix.keys())
+    return numpy.array(values, dtype=object)[random.choice(len(values), count, p=list(mix.values()))]
+
+
+def text(values, decimals=None):
+    """Format a numeric array as CSV text ('' for NaN)."""
+    if decimals is not None:
+        values = numpy.round(values, decimals)
+    formatted = values.astype(str).astype(object)
+    if values.dtype.kind == 'f':
+        formatted[numpy.isnan(values)] = ''
+    return formatted
+
+
+def writeTaxa(path, taxon_count, random):
+    """Write a taxa tree (six children per taxon, ranks by depth) and conservation statuses for 5% of taxa; returns
+    the taxon_geoprivacy of each taxon id."""
+    ancestry = [''] * (taxon_count + 1)
+    depth = [0] * (taxon_count + 1)
+    with io.open(path + '-taxa.csv', 'w', encoding='utf8', newline='') as taxa_file:
+        writer = csv.writer(taxa_file)
+        writer.writerow(table_fields['taxa'])
+        for taxon_id in range(1, taxon_count + 1):
+            parent = taxon_id // 6
+            if parent:
+                ancestry[taxon_id] = (ancestry[parent] + '/' if ancestry[parent] else '') + str(parent)
+                depth[taxon_id] = depth[parent] + 1
+            rank_level, rank = ranks[min(depth[taxon_id], len(ranks) - 1)]
+            writer.writerow([taxon_id, ancestry[taxon_id], rank_level, rank, 'Taxon ' + str(taxon_id), 'true'])
+    taxon_geoprivacy = choose(random, taxon_geoprivacy_mix, taxon_count + 1)
+    with io.open(path + '-conservation_statuses.csv', 'w', encoding='utf8', newline='') as status_file:
+        writer = csv.writer(status_file)
+        writer.writerow(table_fields['conservation_statuses'])
+        for status_id, taxon_id in enumerate(numpy.flatnonzero(random.random(taxon_count + 1) < 0.05), 1):
+            if taxon_id:
+                writer.writerow([status_id, taxon_id, 1, random.choice(['S1', 'S2', 'S3', 'S4']), 'NatureServe',
+                                 random.choice([10, 20, 30, 40]), taxon_geoprivacy[taxon_id],
+                                 random.integers(6712, 6925)])
+    return taxon_geoprivacy
+
+
+def generateExtract(project_path, observations, seed=5):
+    """Write a synthetic extract with observations observations and return its label."""
+    label = 'synthetic-' + str(observations)
+    folder = project_path + '/' + iNatExchangeUtils.input_folder + '/' + label
+    os.makedirs(folder, exist_ok=True)
+    path = folder + '/' + label
+    random = numpy.random.default_rng(seed)
+    user_count = max(50, observations // 20)
+    taxon_count = max(100, min(observations // 10, 200000))
+    taxon_geoprivacy = writeTaxa(path, taxon_count, random)
+    with io.open(path + '-users.csv', 'w', encoding='utf8', newline='') as users_file:
+        writer = csv.writer(users_file)
+        writer.writerow(table_fields['users'])
+        writer.writerows([user_id, 'user' + str(user_id), 'User ' + str(user_id), 'user' + str(user_id) +
+                          '@example.org', '2015-01-01 00:00:00 UTC'] for user_id in range(1, user_count + 1))
+    with io.open(path + '-observation_fields.csv', 'w', encoding='utf8', newline='') as fields_file:
+        writer = csv.writer(fields_file)
+        writer.writerow(table_fields['observation_fields'])
+        writer.writerows([field_id, 'Field ' + str(field_id), random.choice(['text', 'numeric', 'date']), 1,
+                          'Synthetic observation field', '2016-01-01 00:00:00 UTC'] for field_id in range(1, 501))
+
+    files = dict((table, io.open(path + '-' + table + '.csv', 'w', encoding='utf8', newline=''))
+                 for table in ['observations'] + list(child_rates.keys()))
+    writers = dict((table, csv.writer(files[table])) for table in files)
+    for table, writer in writers.items():
+        writer.writerow(table_fields[table])
+    child_ids = dict((table, 1) for table in child_rates)
+    centre_names = numpy.array([iNatExchangeUtils.prov_dict[jurisdiction] for lon, lat, jurisdiction in
+                                iNatSpatial.synthetic_centres] + [''], dtype=object)
+    days = (numpy.datetime64('2025-12-31') - numpy.datetime64('2000-01-01')).astype(int)
+    for first in range(1, observations + 1, chunk_size):
+        count = min(chunk_size, observations + 1 - first)
+        ids = numpy.arange(first, first + count)
+        lon, lat, centre = iNatSpatial.syntheticPoints(count, random)
+        taxon_ids = numpy.minimum(random.zipf(1.3, count), taxon_count)
+        user_ids = random.integers(1, user_count + 1, count)
+        geoprivacy = choose(random, geoprivacy_mix, count)
+        taxon_obscured = taxon_geoprivacy[taxon_ids]
+        obscured = (geoprivacy == 'obscured') | (taxon_obscured == 'obscured') | (taxon_obscured == 'private')
+        hidden = geoprivacy == 'private'
+        shared = (obscured | hidden) & (random.random(count) < private_share)
+        public_lon = numpy.where(obscured, lon + random.uniform(-obscure_offset, obscure_offset, count), lon)
+        public_lat = numpy.where(obscured, lat + random.uniform(-obscure_offset, obscure_offset, count), lat)
+        public_lon[hidden] = numpy.nan
+        public_lat[hidden] = numpy.nan
+        private_lon = numpy.where(shared, lon, numpy.nan)
+        private_lat = numpy.where(shared, lat, numpy.nan)
+        observed_on = (numpy.datetime64('2000-01-01') + random.integers(0, days, count)).astype(str)
+        columns = [text(ids), observed_on, observed_on.astype(object) + ' 12:00:00 UTC', text(user_ids),
+                   observed_on.astype(object) + ' 18:00:00 UTC', choose(random, {'research': 0.6, 'needs_id': 0.35,
+                                                                               'casual': 0.05}, count),
+                   numpy.full(count, 'CC-BY-NC', dtype=object),
+                   'https://www.inaturalist.org/observations/' + text(ids),
+                   numpy.full(count, '', dtype=object), numpy.full(count, 'false', dtype=object),
+                   numpy.full(count, 'Somewhere, Canada', dtype=object), text(public_lat, 6), text(public_lon, 6),
+                   text(random.integers(1, 500, count)), text(private_lat, 6), text(private_lon, 6),
+                   text(numpy.where(obscured, 28000, 0)), geoprivacy, taxon_obscured,
+                   numpy.where(obscured, 'true', 'false').astype(object), centre_names[centre],
+                   'Taxon ' + text(taxon_ids), numpy.full(count, '', dtype=object),
+                   numpy.array(iconic_taxa, dtype=object)[taxon_ids % len(iconic_taxa)], text(taxon_ids)]
+        writers['observations'].writerows(zip(*columns))
+
+        for table, rate in child_rates.items():
+            counts = random.poisson(rate, count)
+            observation_ids = numpy.repeat(ids, counts)
+            child_count = len(observation_ids)
+            child_id = text(numpy.arange(child_ids[table], child_ids[table] + child_count))
+            child_ids[table] += child_count
+            users = text(random.integers(1, user_count + 1, child_count))
+            created = numpy.full(child_count, '2021-06-03 12:00:00 UTC', dtype=object)
+            if table == 'identifications':
+                taxa = numpy.repeat(taxon_ids, counts)
+                changed = random.random(child_count) < 0.1
+                taxa[changed] = numpy.maximum(1, taxa[changed] // 6)
+                rows = zip(child_id, text(observation_ids), users, text(taxa),
+                           choose(random, {'improving': 0.3, 'supporting': 0.6, 'leading': 0.1}, child_count),
+                           numpy.full(child_count, 'true', dtype=object), created)
+            elif table == 'comments':
+                rows = zip(child_id, numpy.full(child_count, 'Observation', dtype=object), text(observation_ids),
+                           users, numpy.full(child_count, 'Nice find, "really" nice', dtype=object), created)
+            elif table == 'annotations':
+                rows = zip(child_id, numpy.full(child_count, 'Observation', dtype=object), text(observation_ids),
+                           text(random.integers(1, 20, child_count)), text(random.integers(1, 40, child_count)),
+                           users, created)
+            elif table == 'observation_field_values':
+                rows = zip(child_id, text(observation_ids), text(random.integers(1, 501, child_count)),
+                           text(random.integers(0, 100, child_count)), users, created)
+            else:
+                rows = zip(child_id, text(observation_ids), users,
+                           choose(random, {'wild': 0.7, 'location': 0.2, 'date': 0.1}, child_count),
+                           choose(random, {'true': 0.8, 'false': 0.2}, child_count), created)
+            writers[table].writerows(rows)
+    for table_file in files.values():
+        table_file.close()
+    return label
+
+
+def runBenchmark(project_path, observations, jurisdictions=None, workers=None, messages=None):
+    """Generate (if needed) and time each stage for an extract of observations observations; returns
+    (stage, seconds, rows) tuples."""
+    if jurisdictions is None:
+        # coastal jurisdictions also need the marine buffers, which are only read with arcpy
+        jurisdictions = 'ON;QC;AC' if iNatSpatial.marineAvailable() else 'AB;SK;YT'
+    import iNatBatchExportTool
+    import iNatEBARExportTool
+    iNatExchangeUtils.project_path = project_path
+    iNatExchangeUtils.output_path = project_path + '/' + iNatExchangeUtils.output_folder
+    os.makedirs(iNatExchangeUtils.output_path, exist_ok=True)
+    results = []
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        rows = function(*args)
+        results.append((stage, time.perf_counter() - start, rows))
+        iNatExchangeUtils.displayMessage(messages, stage + ': ' + str(round(results[-1][1], 2)) + 's')
+        return rows
+
+    def generateStage():
+        generateExtract(project_path, observations)
+        return observations
+
+    label = 'synthetic-' + str(observations)
+    if not os.path.exists(project_path + '/' + iNatExchangeUtils.input_folder + '/' + label):
+        timed('generate', generateStage)
+    iNatExchangeUtils.input_label = label
+    iNatExchangeUtils.input_path = project_path + '/' + iNatExchangeUtils.input_folder + '/' + label
+    iNatExchangeUtils.input_prefix = label + '-'
+    store_path = iNatExchangeUtils.output_path + '/' + label + '.gpkg'
+    if os.path.exists(store_path):
+        os.remove(store_path)
+
+    def importStage():
+        iNatLoader.importExtract(store_path, workers)
+        store = iNatStores.openStore(store_path)
+        count = sum(1 for row in store.readRows('observations', ['id']))
+        store.close()
+        return count
+
+    loaded = timed('import', importStage)
+    date_label = 'bench' + str(observations)
+    for jur_label in jurisdictions.split(';'):
+        shutil.rmtree(iNatExchangeUtils.output_path + '/' + jur_label, ignore_errors=True)
+    parameters = [Parameter(project_path), Parameter(label), Parameter(date_label), Parameter(jurisdictions),
+                  Parameter('true'), Parameter('true'), Parameter('true'), Parameter('true'),
+                  Parameter('GeoPackage'), Parameter(workers), Parameter(None)]
+
+    def exportStage():
+        iNatBatchExportTool.iNatBatchExportTool().runiNatBatchExportTool(parameters, messages)
+        return loaded
+
+    def ebarStage():
+        iNatEBARExportTool.iNatEBARExportTool().runiNatEBARExportTool([Parameter(project_path), Parameter(label),
+                                                                       Parameter(None), Parameter(None)], messages)
+        return loaded
+
+    timed('jurisdiction export', exportStage)
+    timed('ebar export', ebarStage)
+    return results
+
+
+def saveResults(project_path, observations, workers, results):
+    """Append a run's stage timings to benchmark_results.csv in the project folder."""
+    results_path = project_path + '/benchmark_results.csv'
+    new_file = not os.path.exists(results_path)
+    run_time = datetime.datetime.now().isoformat(timespec='seconds')
+    with io.open(results_path, 'a', encoding='utf8', newline='') as results_file:
+        writer = csv.writer(results_file)
+        if new_file:
+            writer.writerow(['run_time', 'observations', 'workers', 'stage', 'seconds', 'rows', 'rows_per_second',
+                             'python', 'platform'])
+        for stage, seconds, rows in results:
+            writer.writerow([run_time, observations, workers or os.cpu_count(), stage, round(seconds, 3), rows,
+                             int(rows / seconds) if seconds else '', platform.python_version(), platform.platform()])
+
+
+# controlling process
+if __name__ == '__main__':
+    # usage: python iNatBenchmark.py <project path> [observations ...]
+    for scale in [int(arg) for arg in sys.argv[2:]] or [10000, 100000]:
+        print('Benchmarking ' + str(scale) + ' observations')
+        saveResults(sys.argv[1], scale, None, runBenchmark(sys.argv[1], scale))
@@ -0,0 +1,182 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatColumnar.py
+# Columnar copy of an iNaturalist.ca extract (compressed Parquet, observations partitioned by place_admin1_name) so
+# that filters and semi-joins read only the columns and partitions they need
+
+# Notes:
+# - needs pyarrow (included with ArcGIS Pro 3), but not arcpy
+# - files are memory mapped when read; the Arrow IPC format (lz4 or uncompressed) decodes with fewer copies than
+#   Parquet, at the cost of larger files
+# - python iNatColumnar.py <input folder> <input label> <output folder> converts an extract and times a read of the
+#   decision columns
+
+# import Python packages
+import sys
+import time
+import pyarrow
+import pyarrow.compute
+import pyarrow.csv
+import pyarrow.dataset
+import pyarrow.fs
+import iNatExchangeUtils
+import iNatJoins
+
+
+# observation columns the export tools need to select and bucket records
+decision_fields = ['id', 'taxon_id', 'geoprivacy', 'taxon_geoprivacy', 'private_latitude', 'place_admin1_name',
+                   'lon', 'lat']
+# observations are partitioned on this field
+partition_field = 'place_admin1_name'
+# Parquet compression (zstd gives the smallest files for iNat text columns) and Arrow IPC compression (None to
+# leave Arrow files uncompressed for zero-copy reads)
+parquet_compression = 'zstd'
+ipc_compression = 'lz4'
+# rows per CSV block read and per row group written
+block_size = 64 << 20
+row_group_rows = 1000000
+# loader types to Arrow types (dates are kept as text, as in observed_on_text)
+arrow_types = {'LONG': pyarrow.int64(), 'DOUBLE': pyarrow.float64(), 'DATE': pyarrow.string()}
+
+
+def columnarPath(label):
+    """Folder holding the columnar copy of the extract with label."""
+    return iNatExchangeUtils.output_path + '/' + label + '_columnar'
+
+
+def fileFormat(file_format):
+    """Dataset file format for 'parquet' or 'arrow' (Arrow IPC)."""
+    if file_format == 'arrow':
+        return pyarrow.dataset.IpcFileFormat()
+    return pyarrow.dataset.ParquetFileFormat()
+
+
+def writeOptions(file_format):
+    """Compressed write options for 'parquet' or 'arrow'."""
+    if file_format == 'arrow':
+        return pyarrow.dataset.IpcFileFormat().make_write_options(compression=ipc_compression)
+    return pyarrow.dataset.ParquetFileFormat().make_write_options(compression=parquet_compression)
+
+
+def openCsvBatches(csv_path):
+    """Open a CSV as a stream of record batches, typing the fields known to the loaders and reading the rest as
+    text."""
+    header = pyarrow.csv.open_csv(csv_path, read_options=pyarrow.csv.ReadOptions(block_size=1 << 16)).schema.names
+    column_types = dict((name, arrow_types.get(iNatExchangeUtils.field_types.get(name, 'TEXT'), pyarrow.string()))
+                        for name in header)
+    return pyarrow.csv.open_csv(csv_path, read_options=pyarrow.csv.ReadOptions(block_size=block_size),
+                                convert_options=pyarrow.csv.ConvertOptions(column_types=column_types,
+                                                                           strings_can_be_null=True))
+
+
+def prepareObservationBatch(batch):
+    """Drop geoprivacy = 'private' observations and add lon/lat, preferring private coordinates (as the loaders
+    do)."""
+    compute = pyarrow.compute
+    table = pyarrow.Table.from_batches([batch])
+    keep = compute.invert(compute.fill_null(compute.equal(table['geoprivacy'], 'private'), False))
+    table = table.filter(keep)
+    table = table.append_column('lon', compute.coalesce(table['private_longitude'], table['longitude']))
+    return table.append_column('lat', compute.coalesce(table['private_latitude'], table['latitude']))
+
+
+def observationBatches(reader):
+    """Yield prepared observation record batches from a CSV batch reader."""
+    for batch in reader:
+        yield from prepareObservationBatch(batch).to_batches()
+
+
+def writeTable(csv_path, out_path, table, file_format='parquet'):
+    """Convert one CSV to a columnar dataset folder (observations partitioned by place_admin1_name) and return the
+    number of rows written."""
+    reader = openCsvBatches(csv_path)
+    if table == 'observations':
+        schema = reader.schema.append(pyarrow.field('lon', pyarrow.float64())).append(
+            pyarrow.field('lat', pyarrow.float64()))
+        data = pyarrow.dataset.Scanner.from_batches(observationBatches(reader), schema=schema)
+        partitioning = pyarrow.dataset.partitioning(pyarrow.schema([(partition_field, pyarrow.string())]),
+                                                    flavor='hive')
+    else:
+        data = reader
+        partitioning = None
+    pyarrow.dataset.write_dataset(data, out_path + '/' + table, format=fileFormat(file_format),
+                                  file_options=writeOptions(file_format), partitioning=partitioning,
+                                  max_rows_per_group=row_group_rows, existing_data_behavior='delete_matching')
+    return openTable(out_path, table, file_format).count_rows()
+
+
+def writeColumnar(out_path, messages=None, file_format='parquet', tables=None):
+    """Write every table of the current extract to a columnar dataset under out_path."""
+    for table in tables or ['observations'] + iNatExchangeUtils.related_tables:
+        start = time.perf_counter()
+        count = writeTable(iNatExchangeUtils.csvPath(table), out_path, table, file_format)
+        iNatExchangeUtils.displayMessage(messages, 'Wrote columnar ' + table + ' (' + str(count) + ' rows) in ' +
+                                         str(round(time.perf_counter() - start, 1)) + 's')
+
+
+def openTable(out_path, table, file_format='parquet'):
+    """Open a table of a columnar copy as a dataset, memory mapping its files."""
+    partitioning = 'hive' if table == 'observations' else None
+    return pyarrow.dataset.dataset(out_path + '/' + table, format=fileFormat(file_format), partitioning=partitioning,
+                                   filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+
+def readColumns(out_path, table, columns, jurisdictions=None, file_format='parquet'):
+    """Read only some columns of a table, and for observations only the partitions of a list of jurisdiction
+    abbreviations (whose place_admin1_name is the province/territory name)."""
+    row_filter = None
+    if jurisdictions and table == 'observations':
+        names = [iNatExchangeUtils.prov_dict[jurisdiction] for jur_label in jurisdictions
+                 for jurisdiction in iNatExchangeUtils.jurisdiction_groups.get(jur_label, [jur_label])]
+        row_filter = pyarrow.compute.field(partition_field).isin(names)
+    return openTable(out_path, table, file_format).to_table(columns=columns, filter=row_filter)
+
+
+def keyValues(column):
+    """Int64 NumPy array of an Arrow integer column (-1 for null), without copying when there are no nulls."""
+    if column.null_count:
+        column = pyarrow.compute.fill_null(column, -1)
+    return column.to_numpy()
+
+
+def semiJoin(out_path, table, key_field, id_set, columns=None, file_format='parquet'):
+    """Return the rows (only columns, if given) of a table whose key_field is in an iNatJoins.IdSet, testing
+    membership a record batch at a time."""
+    read_columns = None if columns is None else list(dict.fromkeys([key_field] + columns))
+    scanner = openTable(out_path, table, file_format).scanner(columns=read_columns)
+    parts = []
+    for batch in scanner.to_batches():
+        mask = id_set.contains(keyValues(batch.column(key_field)))
+        if mask.any():
+            parts.append(batch.filter(pyarrow.array(mask)))
+    result = pyarrow.Table.from_batches(parts, schema=scanner.projected_schema)
+    return result if columns is None else result.select(columns)
+
+
+def observationIds(out_path, jurisdictions, file_format='parquet'):
+    """IdSet of the observations in the partitions of a list of jurisdictions."""
+    ids = readColumns(out_path, 'observations', ['id'], jurisdictions, file_format)['id']
+    return iNatJoins.IdSet(keyValues(ids.combine_chunks()))
+
+
+# controlling process
+if __name__ == '__main__':
+    # usage: python iNatColumnar.py <input folder> <input label> <output folder>
+    iNatExchangeUtils.input_label = sys.argv[2]
+    iNatExchangeUtils.input_path = sys.argv[1] + '/' + sys.argv[2]
+    iNatExchangeUtils.input_prefix = sys.argv[2] + '-'
+    writeColumnar(sys.argv[3])
+    start = time.perf_counter()
+    decisions = readColumns(sys.argv[3], 'observations', decision_fields)
+    print('Read ' + str(decisions.num_rows) + ' rows of ' + str(len(decision_fields)) + ' decision columns in ' +
+          str(round(time.perf_counter() - start, 2)) + 's')
+    start = time.perf_counter()
+    selected = observationIds(sys.argv[3], ['ON'])
+    identifications = semiJoin(sys.argv[3], 'identifications', 'observation_id', selected,
+                               ['id', 'observation_id', 'taxon_id'])
+    print('Semi-joined ' + str(identifications.num_rows) + ' identifications to ' + str(len(selected)) +
+          ' Ontario observations in ' + str(round(time.perf_counter() - start, 2)) + 's')
@@ -0,0 +1,333 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatCsv.py
+# Streaming CSV output written from the same rows that fill the gdb/GeoPackage (replaces TableToTable copies of
+# tables that were just written), with large buffered writes, optional compression and atomic replacement, and the
+# shared CSV reader, which parses the multi-GB extract CSVs in byte range chunks across a process pool
+
+# Notes:
+# - rows go to a temporary file beside the output, which replaces any existing output only when the writer is
+#   closed without error (no Exists/Delete beforehand, and no partial CSV if a run fails)
+# - gzip uses the standard library; zstd needs the zstandard package
+# - chunks end on record boundaries: a newline only ends a record when an even number of quotes precede it, so
+#   quoted newlines in descriptions and comments stay inside their record; quotes are counted across the file in
+#   parallel, and only the few bytes from each nominal chunk start to the next record boundary are scanned serially
+# - the input is memory mapped by every worker, so only byte offsets and parsed columns pass between processes
+# - python iNatCsv.py <csv> [workers] times the chunked reader against a single csv.reader
+
+# import Python packages
+import collections
+import csv
+import datetime
+import gzip
+import io
+import mmap
+import os
+import sys
+import time
+import iNatExchangeUtils
+
+
+# bytes buffered before each write to disk
+buffer_size = 8 << 20
+# compression options and the file extensions they add
+compressions = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+gzip_level = 6
+zstd_level = 3
+# bytes of CSV per parsed chunk (rows are returned a chunk at a time, in file order)
+chunk_size = 32 << 20
+# chunks parsed ahead of the consumer per worker
+chunks_ahead = 2
+# descriptions and comments can exceed the csv module default field limit (sys.maxsize overflows on Windows)
+csv.field_size_limit(min(sys.maxsize, 2147483647))
+
+
+def compressionOption(value):
+    """Normalise a tool parameter value ('None', 'gzip', 'zstd' or empty) to a key of compressions."""
+    if not value or value == 'None':
+        return None
+    if value not in compressions:
+        raise ValueError('Unknown CSV compression ' + value)
+    return value
+
+
+class CsvWriter:
+    """Write a CSV (optionally compressed) to a temporary file and move it into place when closed"""
+    def __init__(self, path, header=None, compression=None):
+        self.path = path + compressions[compression]
+        self.temp_path = self.path + '.tmp'
+        self.rows = 0
+        self.raw = io.open(self.temp_path, 'wb', buffering=buffer_size)
+        if compression == 'gzip':
+            self.stream = gzip.GzipFile(os.path.basename(path), 'wb', gzip_level, self.raw)
+        elif compression == 'zstd':
+            import zstandard
+            self.stream = zstandard.ZstdCompressor(level=zstd_level).stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = None
+        self.text = io.TextIOWrapper(self.stream or self.raw, encoding='utf8', newline='',
+                                     write_through=False)
+        self.writer = csv.writer(self.text)
+        if header is not None:
+            self.writer.writerow(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.rows += 1
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writer.writerow(row)
+            self.rows += 1
+
+    def closeStreams(self):
+        self.text.flush()
+        self.text.detach()
+        if self.stream is not None:
+            self.stream.close()
+        self.raw.close()
+
+    def close(self):
+        """Finish writing and replace any existing output with the new file."""
+        self.closeStreams()
+        os.replace(self.temp_path, self.path)
+        return self.rows
+
+    def abort(self):
+        """Discard the temporary file, leaving any existing output untouched."""
+        try:
+            self.closeStreams()
+        finally:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+
+
+def teeRows(rows, writer, drop_last=False):
+    """Yield rows unchanged while also writing them to a CsvWriter (without the final SHAPE@XY value if
+    drop_last)."""
+    for row in rows:
+        writer.writerow(row[:-1] if drop_last else row)
+        yield row
+
+
+def normaliseDate(text):
+    """Convert observed_on text (usually YYYY-MM-DD) to a datetime, or None if empty or invalid."""
+    if not text:
+        return None
+    try:
+        if len(text) >= 10 and text[4] in '-/' and text[7] in '-/':
+            return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+        return datetime.datetime.strptime(text, '%m/%d/%Y')
+    except ValueError:
+        return None
+
+
+def converter(field_type):
+    """Return a function converting CSV text to a value of field_type (empty text becomes None)."""
+    if field_type == 'LONG':
+        return lambda text: int(text) if text else None
+    if field_type == 'DOUBLE':
+        return lambda text: float(text) if text else None
+    if field_type == 'DATE':
+        return normaliseDate
+    return lambda text: text if text else None
+
+
+def openCsv(csv_path):
+    """Open a CSV and return the file, its header and a row reader."""
+    csv_file = io.open(csv_path, 'r', encoding='utf8', newline='')
+    reader = csv.reader(csv_file)
+    header = next(reader)
+    return csv_file, header, reader
+
+
+def mapFile(csv_path):
+    """Memory map a file read only (None for an empty file, which cannot be mapped)."""
+    with io.open(csv_path, 'rb') as csv_file:
+        if os.fstat(csv_file.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def countQuotes(csv_path, start, end):
+    """Count the quote characters in a byte range of a file (run in a worker process)."""
+    view = mapFile(csv_path)
+    count = 0
+    try:
+        for offset in range(start, end, buffer_size):
+            count += view[offset:min(offset + buffer_size, end)].count(b'"')
+    finally:
+        view.close()
+    return count
+
+
+def recordStart(view, offset, quoted):
+    """Position of the first record starting at or after offset, given whether offset is inside quotes."""
+    position = offset
+    while True:
+        quote = view.find(b'"', position)
+        if quoted:
+            if quote == -1:
+                return len(view)
+            quoted = False
+            position = quote + 1
+            continue
+        newline = view.find(b'\n', position)
+        if newline == -1:
+            return len(view)
+        if quote == -1 or newline < quote:
+            return newline + 1
+        quoted = True
+        position = quote + 1
+
+
+def parseChunk(csv_path, start, end, keep, field_types):
+    """Parse the records in a byte range of a CSV into columns (only the keep indexes, converted to field_types
+    unless that is None) and return them with the number of rows (run in a worker process); blank records are
+    skipped, and short records padded with empty fields (as null values)."""
+    view = mapFile(csv_path)
+    try:
+        text = view[start:end].decode('utf8')
+    finally:
+        view.close()
+    columns = [[] for i in keep]
+    appends = [column.append for column in columns]
+    count = 0
+    reader = csv.reader(io.StringIO(text, newline=''))
+    if field_types is None:
+        converters = [None] * len(keep)
+    else:
+        converters = [converter(field_type) for field_type in field_types]
+    width = max(keep) + 1 if keep else 0
+    padding = [''] * width
+    if keep == list(range(len(keep))):
+        # every field, or the leading fields, without indexing
+        for line in reader:
+            if not line:
+                continue
+            if len(line) < width:
+                line += padding[len(line):]
+            for append, convert, value in zip(appends, converters, line):
+                append(convert(value) if convert else value)
+            count += 1
+    else:
+        for line in reader:
+            if not line:
+                continue
+            if len(line) < width:
+                line += padding[len(line):]
+            for append, convert, i in zip(appends, converters, keep):
+                append(convert(line[i]) if convert else line[i])
+            count += 1
+    return count, columns
+
+
+class ChunkedReader:
+    """Read a CSV as typed column batches parsed in parallel from memory mapped byte ranges, returned in file
+    order"""
+    def __init__(self, csv_path, drop_fields=(), typed=True, workers=None, size=chunk_size):
+        self.csv_path = csv_path
+        self.workers = workers or os.cpu_count()
+        self.size = size
+        csv_file, header, reader = openCsv(csv_path)
+        csv_file.close()
+        self.keep = [i for i, name in enumerate(header) if name not in drop_fields]
+        self.header = [header[i] for i in self.keep]
+        # types as the loaders create them (None to keep the CSV text)
+        self.field_types = [iNatExchangeUtils.field_types.get(name, 'TEXT') for name in self.header] if typed \
+            else None
+        self.rows_read = 0
+
+    def fields(self):
+        """List (name, type) pairs for the columns read."""
+        return list(zip(self.header, self.field_types or ['TEXT'] * len(self.header)))
+
+    def chunkRanges(self, pool=None):
+        """Split the records after the header into byte ranges of about size bytes ending on record boundaries."""
+        view = mapFile(self.csv_path)
+        if view is None:
+            return []
+        try:
+            first = recordStart(view, 0, False)
+            offsets = list(range(first, len(view), self.size)) + [len(view)]
+            segments = list(zip(offsets[:-1], offsets[1:]))
+            # quote parity at each nominal chunk start
+            if pool is None:
+                counts = [countQuotes(self.csv_path, start, end) for start, end in segments]
+            else:
+                counts = list(pool.map(countQuotes, *zip(*[(self.csv_path, start, end) for start, end in segments])))
+            quotes = view[0:first].count(b'"')
+            starts = [first]
+            for offset, count in zip(offsets[1:-1], counts):
+                quotes += count
+                start = recordStart(view, offset, quotes % 2 == 1)
+                if start > starts[-1]:
+                    starts.append(start)
+            ends = starts[1:] + [len(view)]
+            return [(start, end) for start, end in zip(starts, ends) if end > start]
+        finally:
+            view.close()
+
+    def columnBatches(self):
+        """Yield (row count, list of columns) a chunk at a time in file order."""
+        if self.workers == 1:
+            for start, end in self.chunkRanges():
+                count, columns = parseChunk(self.csv_path, start, end, self.keep, self.field_types)
+                self.rows_read += count
+                yield count, columns
+            return
+        with iNatExchangeUtils.processPool(self.workers) as pool:
+            pending = collections.deque()
+            for start, end in self.chunkRanges(pool):
+                pending.append(pool.submit(parseChunk, self.csv_path, start, end, self.keep, self.field_types))
+                if len(pending) >= self.workers * chunks_ahead:
+                    count, columns = pending.popleft().result()
+                    self.rows_read += count
+                    yield count, columns
+            while pending:
+                count, columns = pending.popleft().result()
+                self.rows_read += count
+                yield count, columns
+
+    def rows(self):
+        """Yield row tuples in file order."""
+        for count, columns in self.columnBatches():
+            yield from zip(*columns)
+
+
+def benchmark(csv_path, workers=None):
+    """Time the chunked reader against a single csv.reader pass over the same file."""
+    start = time.perf_counter()
+    csv_file, header, reader = openCsv(csv_path)
+    with csv_file:
+        converters = [converter(iNatExchangeUtils.field_types.get(name, 'TEXT')) for name in header]
+        single = sum(1 for line in reader if [convert(text) for convert, text in zip(converters, line)])
+    single_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reader = ChunkedReader(csv_path, workers=workers)
+    chunked = sum(count for count, columns in reader.columnBatches())
+    chunked_seconds = time.perf_counter() - start
+    print('csv.reader: ' + str(single) + ' rows in ' + str(round(single_seconds, 2)) + 's')
+    print('chunked (' + str(reader.workers) + ' workers): ' + str(chunked) + ' rows in ' +
+          str(round(chunked_seconds, 2)) + 's')
+    if single != chunked:
+        print('ERROR: row counts differ')
+
+
+# controlling process
+if __name__ == '__main__':
+    # usage: python iNatCsv.py <csv> [workers]
+    benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
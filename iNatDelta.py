@@ -0,0 +1,278 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatDelta.py
+# Incremental import that compares a new iNaturalist.ca extract with the previous one (by id plus a hash of each
+# row) and applies only the inserts, updates and deletes to the previous working store
+
+# Notes:
+# - the previous extract's CSVs must still be in the Input folder
+# - changes are applied to a copy of the previous working store, which becomes the new working store only once they
+#   have all been applied, so the previous store is left as it was (delete it when it is no longer needed)
+# - tables without an id field are reloaded in full
+# - the manifest (<input_label>_delta.json in the Output folder) lists the changes and the jurisdictions whose
+#   observations were affected, for the batch export's 'changed' option
+
+# import Python packages
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+import numpy
+import iNatCsv
+import iNatExchangeUtils
+import iNatFrame
+import iNatJoins
+import iNatLoader
+import iNatSpatial
+import iNatStores
+import iNatTaxa
+
+
+# field holding each changed row's link to the tables it affects (observation ids for observation child tables)
+change_keys = dict(iNatExchangeUtils.observation_keys, observations='id', taxa='id', users='id',
+                   observation_fields='id', conservation_statuses='taxon_id')
+# how changed reference rows reach observations: table -> [(scanned table, field matching the changed keys,
+# observation id field)]
+reference_links = {'taxa': [('observations', 'taxon_id', 'id'), ('identifications', 'taxon_id', 'observation_id')],
+                   'users': [('observations', 'user_id', 'id')],
+                   'observation_fields': [('observation_field_values', 'observation_field_id', 'observation_id')]}
+
+
+def manifestPath(label):
+    """Path of the delta manifest written when importing the extract with label."""
+    return iNatExchangeUtils.output_path + '/' + label + '_delta.json'
+
+
+def readManifest(label):
+    """Return the delta manifest for label, or None if that extract was not imported as a delta."""
+    if not os.path.exists(manifestPath(label)):
+        return None
+    with io.open(manifestPath(label), 'r', encoding='utf8') as manifest_file:
+        return json.load(manifest_file)
+
+
+def rowHashes(csv_path, key_field):
+    """Read a CSV once and return sorted int64 ids, their uint64 content hashes and int64 key_field values (-1 if
+    null); ids are the hashes themselves for tables without an id field."""
+    reader = iNatCsv.ChunkedReader(csv_path, typed=False)
+    header = reader.header
+    id_index = header.index('id') if 'id' in header else None
+    key_index = header.index(key_field) if key_field in header else None
+    # int64/uint64 arrays filled a chunk at a time (rather than Python ints for every row) and joined at the end
+    id_chunks = []
+    hash_chunks = []
+    key_chunks = []
+    for count, columns in reader.columnBatches():
+        hashes = numpy.fromiter((int.from_bytes(hashlib.blake2b('\x1f'.join(line).encode('utf8'),
+                                                                digest_size=8).digest(), 'little')
+                                 for line in zip(*columns)), dtype=numpy.uint64, count=count)
+        hash_chunks.append(hashes)
+        if id_index is not None:
+            id_chunks.append(numpy.fromiter(map(int, columns[id_index]), dtype=numpy.int64, count=count))
+        else:
+            id_chunks.append((hashes - numpy.uint64(1 << 63)).view(numpy.int64))
+        if key_index is not None:
+            key_chunks.append(numpy.fromiter((int(key) if key else -1 for key in columns[key_index]),
+                                             dtype=numpy.int64, count=count))
+        else:
+            key_chunks.append(numpy.full(count, -1, dtype=numpy.int64))
+    ids = numpy.concatenate(id_chunks) if id_chunks else numpy.zeros(0, dtype=numpy.int64)
+    hashes = numpy.concatenate(hash_chunks) if hash_chunks else numpy.zeros(0, dtype=numpy.uint64)
+    keys = numpy.concatenate(key_chunks) if key_chunks else numpy.zeros(0, dtype=numpy.int64)
+    order = numpy.argsort(ids, kind='stable')
+    return ids[order], hashes[order], keys[order]
+
+
+def diffHashes(old, new):
+    """Compare the (ids, hashes, keys) of two extracts of a table and return the inserted, updated and deleted ids
+    and the change keys of every changed row (old and new values)."""
+    # identical rows of tables without an id field share an id, and are compared once
+    old_ids, first = numpy.unique(old[0], return_index=True)
+    old_hashes, old_keys = old[1][first], old[2][first]
+    new_ids, first = numpy.unique(new[0], return_index=True)
+    new_hashes, new_keys = new[1][first], new[2][first]
+    common, old_positions, new_positions = numpy.intersect1d(old_ids, new_ids, assume_unique=True,
+                                                             return_indices=True)
+    changed = old_hashes[old_positions] != new_hashes[new_positions]
+    updated = common[changed]
+    inserted_mask = numpy.ones(len(new_ids), dtype=bool)
+    inserted_mask[new_positions] = False
+    deleted_mask = numpy.ones(len(old_ids), dtype=bool)
+    deleted_mask[old_positions] = False
+    keys = numpy.concatenate((new_keys[inserted_mask], old_keys[deleted_mask],
+                              old_keys[old_positions[changed]], new_keys[new_positions[changed]]))
+    return new_ids[inserted_mask], updated, old_ids[deleted_mask], keys[keys >= 0]
+
+
+def copyStore(source, target):
+    """Copy a working store (a GeoPackage file or gdb folder), leaving out gdb lock files."""
+    if os.path.isdir(source):
+        shutil.copytree(source, target, ignore=shutil.ignore_patterns('*.lock'))
+    else:
+        shutil.copy2(source, target)
+
+
+def removeStore(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def insertChanged(csv_path, store, table, id_set, drop_fields=()):
+    """Insert the rows of a CSV whose id is in id_set into an existing table and return the number inserted."""
+    reader = iNatCsv.ChunkedReader(csv_path, () if table == 'observations' else drop_fields)
+    rows = iNatJoins.semiJoin(reader.rows(), reader.header.index('id'), id_set)
+    fields = reader.fields()
+    if table == 'observations':
+        fields += [('lon', 'DOUBLE'), ('lat', 'DOUBLE'), ('observed_on_text', 'TEXT')]
+        field_names = [name for name, field_type in fields] + ['SHAPE@XY']
+        rows = iNatLoader.prepareObservations(reader.header, rows)
+    else:
+        field_names = [name for name, field_type in fields]
+    count = 0
+    for batch in iNatLoader.batches(rows, iNatLoader.batch_size):
+        count += store.insertRows(table, field_names, batch)
+    return count
+
+
+def reloadTable(csv_path, store, table, drop_fields=()):
+    """Replace a table with the new CSV (clustered as at import) and re-create its indexes."""
+    store.delete(table)
+    iNatLoader.loadTable(csv_path, store, table, None, drop_fields)
+    store.addIndexes([(table, [field], index_name) for index_table, field, index_name in
+                      iNatExchangeUtils.import_indexes if index_table == table])
+
+
+def linkedObservations(store, table, key_field, observation_field, id_set):
+    """Observation ids of the rows of a table whose key_field is in id_set."""
+    rows = store.readRows(table, [key_field, observation_field])
+    return iNatJoins.readIds(iNatJoins.semiJoin(rows, 0, id_set), 1)
+
+
+def readMemberships(store, id_set):
+    """Jurisdictions of the observations in id_set, or None if the store has no membership table."""
+    if not store.exists(iNatSpatial.membership_table):
+        return None
+    rows = store.readRows(iNatSpatial.membership_table, ['observation_id', 'jurisdiction'])
+    return set(row[1] for row in iNatJoins.semiJoin(rows, 0, id_set))
+
+
+def expandJurisdictions(jurisdictions):
+    """Add the groups (e.g. AC, CA) containing any of a set of jurisdictions."""
+    expanded = set(jurisdictions)
+    for group, members in iNatExchangeUtils.jurisdiction_groups.items():
+        if expanded.intersection(members):
+            expanded.add(group)
+    return sorted(expanded)
+
+
+def deltaImport(previous_label, store_path, messages=None):
+    """Bring the previous label's working store up to date with the current extract and write the manifest."""
+    stage_start = time.perf_counter()
+    extension = os.path.splitext(store_path)[1]
+    previous_store = iNatExchangeUtils.output_path + '/' + previous_label + extension
+    previous_path = iNatExchangeUtils.project_path + '/' + iNatExchangeUtils.input_folder + '/' + previous_label
+    if not os.path.exists(previous_store):
+        iNatExchangeUtils.displayMessage(messages, 'ERROR: previous working store ' + previous_store +
+                                         ' does not exist')
+        # terminate with error
+        return None
+    if os.path.exists(store_path):
+        iNatExchangeUtils.displayMessage(messages, 'ERROR: working store ' + store_path + ' already exists')
+        # terminate with error
+        return None
+
+    # hash both extracts table by table, keeping the old and new change keys of every changed row
+    tables = ['observations'] + iNatExchangeUtils.related_tables
+    changes = {}
+    for table in tables:
+        old = rowHashes(previous_path + '/' + previous_label + '-' + table + '.csv', change_keys.get(table))
+        new = rowHashes(iNatExchangeUtils.csvPath(table), change_keys.get(table))
+        changes[table] = diffHashes(old, new)
+        inserted, updated, deleted, keys = changes[table]
+        iNatExchangeUtils.displayMessage(messages, table + ': ' + str(len(inserted)) + ' inserted, ' +
+                                         str(len(updated)) + ' updated, ' + str(len(deleted)) + ' deleted')
+
+    # changes are applied to a copy (named with the store's extension, as a gdb must be), replacing any copy left by
+    # a failed run, and the copy becomes the current store once they are all applied
+    delta_store = os.path.splitext(store_path)[0] + '_delta' + extension
+    removeStore(delta_store)
+    copyStore(previous_store, delta_store)
+    store = iNatStores.openStore(delta_store)
+
+    # observations affected by changed rows, directly or through taxa, users and observation fields
+    affected = iNatJoins.IdSet(numpy.concatenate([changes[table][3] for table in changes
+                                                  if table == 'observations' or
+                                                  table in iNatExchangeUtils.observation_keys]))
+    reference_ids = dict((table, iNatJoins.IdSet(changes[table][3])) for table in reference_links)
+    reference_ids['taxa'] = reference_ids['taxa'].union(iNatJoins.IdSet(changes['conservation_statuses'][3]))
+    for table, links in reference_links.items():
+        if len(reference_ids[table]):
+            for scanned, key_field, observation_field in links:
+                affected = affected.union(linkedObservations(store, scanned, key_field, observation_field,
+                                                             reference_ids[table]))
+    jurisdictions = readMemberships(store, affected)
+
+    # apply deletes and updates (delete then re-insert) table by table
+    manifest_tables = {}
+    for table in tables:
+        inserted, updated, deleted, keys = changes[table]
+        drop_fields = ('email', 'name') if table == 'users' else ()
+        csv_file, header, reader = iNatCsv.openCsv(iNatExchangeUtils.csvPath(table))
+        csv_file.close()
+        reloaded = 'id' not in header
+        if reloaded:
+            if len(inserted) or len(deleted):
+                reloadTable(iNatExchangeUtils.csvPath(table), store, table, drop_fields)
+        else:
+            store.deleteRows(table, 'id', numpy.concatenate((updated, deleted)).tolist())
+            if len(inserted) or len(updated):
+                insertChanged(iNatExchangeUtils.csvPath(table), store, table,
+                              iNatJoins.IdSet(numpy.concatenate((inserted, updated))), drop_fields)
+        manifest_tables[table] = {'inserted': len(inserted), 'updated': len(updated), 'deleted': len(deleted),
+                                  'reloaded': reloaded}
+        iNatExchangeUtils.displayMessage(messages, 'Applied ' + table + ' changes')
+    store.close()
+
+    # rejoin only the changed observations to the jurisdiction buffers
+    observations = changes['observations']
+    changed_observations = numpy.concatenate(observations[0:3]).tolist()
+    if jurisdictions is not None and changed_observations:
+        iNatExchangeUtils.displayMessage(messages, 'Updating jurisdiction membership of ' +
+                                         str(len(changed_observations)) + ' observations')
+        iNatSpatial.buildMembership(delta_store, messages, changed_observations)
+        store = iNatStores.openStore(delta_store)
+        jurisdictions.update(readMemberships(store, affected))
+        store.close()
+
+    # names are indexed across taxa and observations, so any change to either rebuilds the name index
+    if any(len(part) for table in ('taxa', 'observations') for part in changes[table][0:3]):
+        iNatTaxa.buildNameIndex(delta_store, messages)
+    # renumbering the tree is cheap, but only needed when taxa change
+    if any(len(part) for part in changes['taxa'][0:3]):
+        iNatTaxa.buildIntervals(delta_store, messages)
+    os.rename(delta_store, store_path)
+    # the frame describes the store as it now is
+    iNatFrame.buildFrame(store_path, messages)
+
+    manifest = {'input_label': iNatExchangeUtils.input_label,
+                'previous_label': previous_label,
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'tables': manifest_tables,
+                'affected_observations': len(affected),
+                # None when the store has no membership table, meaning every jurisdiction must be regenerated
+                'changed_jurisdictions': None if jurisdictions is None else expandJurisdictions(jurisdictions)}
+    with io.open(manifestPath(iNatExchangeUtils.input_label), 'w', encoding='utf8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    iNatExchangeUtils.displayMessage(messages, 'Delta import finished in ' +
+                                     str(round(time.perf_counter() - stage_start, 1)) + 's, ' +
+                                     str(len(affected)) + ' observations affected')
+    return manifest
@@ -7,11 +7,18 @@
 # Program: iNatEBARExportTool.py
 # ArcGIS Python tool for exporting iNaturalist.ca records into CSVs for EBAR import
 
+# Notes:
+# - reads the working gdb with arcpy, or the working GeoPackage without ArcGIS (see iNatBackends)
+
 # import Python packages
-import arcpy
+import iNatBackends
+import iNatCsv
 import iNatExchangeUtils
+import iNatFrame
+import iNatJoins
+import iNatSpatial
+import iNatTaxa
 import datetime
-import os
 
 
 class iNatEBARExportTool:
@@ -26,46 +33,68 @@ class iNatEBARExportTool:
 
         # make variables for parms
         iNatExchangeUtils.displayMessage(messages, 'Processing parameters')
-        tools_path = os.path.dirname(__file__)
         iNatExchangeUtils.project_path = parameters[0].valueAsText
         iNatExchangeUtils.output_path = iNatExchangeUtils.project_path + '/' + iNatExchangeUtils.output_folder
         iNatExchangeUtils.input_label = parameters[1].valueAsText
-        observations = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + '.gdb/observations'
+        iNatExchangeUtils.csv_compression = iNatCsv.compressionOption(parameters[2].valueAsText)
+        # optional list of EBAR species of interest (NATIONAL_SCIENTIFIC_NAME)
+        param_species_list = parameters[3].valueAsText
+        backend = iNatBackends.workingBackend(iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label)
+        work_store = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + backend.extension
+        observations = 'observations'
         # # limit to pre-extracted HBJBL obs
-        # observations = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + '.gdb/observations_hbjbl'
-
-        # export unobscured observations
-        iNatExchangeUtils.displayMessage(messages, 'Exporting observations')
-        arcpy.management.MakeFeatureLayer(tools_path + '/iNatExchangeTools.gdb/JurisdictionBufferWGS84',
-                                          'jurisdictions')
-        # limit to Canada (for iNat Ingestor only)
-        arcpy.management.SelectLayerByAttribute('jurisdictions', 'NEW_SELECTION', 'JurisdictionID NOT IN (14, 15)')
-        arcpy.management.MakeFeatureLayer(observations, 'observations')
-        arcpy.management.SelectLayerByLocation('observations', 'INTERSECT', 'jurisdictions')
-        # # limit to EBAR species of interest
-        # arcpy.management.SelectLayerByAttribute('observations', 'SUBSET_SELECTION',
-        #                                         'scientific_name IN (SELECT NATIONAL_SCIENTIFIC_NAME FROM NSN)')
-        arcpy.management.SelectLayerByAttribute('observations', 'SUBSET_SELECTION',
-                                                'private_latitude IS NULL ' +
-                                                "AND (geoprivacy IS NULL OR geoprivacy <> 'private')")
-        if arcpy.Exists(iNatExchangeUtils.output_path + '/unobscured_for_ebar_import.csv'):
-            arcpy.Delete_management(iNatExchangeUtils.output_path + '/unobscured_for_ebar_import.csv')
-        arcpy.conversion.TableToTable('observations', iNatExchangeUtils.output_path, 'unobscured_for_ebar_import.csv')
-        iNatExchangeUtils.displayMessage(messages, 'Created ' + iNatExchangeUtils.output_path +
-                                         '/unobscured_for_ebar_import.csv')
+        # observations = 'observations_hbjbl'
 
-        # export obscured observations
-        arcpy.management.SelectLayerByLocation('observations', 'INTERSECT', 'jurisdictions')
-        # # limit to EBAR species of interest
-        # arcpy.management.SelectLayerByAttribute('observations', 'SUBSET_SELECTION',
-        #                                         'scientific_name IN (SELECT NATIONAL_SCIENTIFIC_NAME FROM NSN)')
-        arcpy.management.SelectLayerByAttribute('observations', 'SUBSET_SELECTION', 'private_latitude IS NOT NULL ' +
-                                                "AND (geoprivacy IS NULL OR geoprivacy <> 'private')")
-        if arcpy.Exists(iNatExchangeUtils.output_path + '/obscured_for_ebar_import.csv'):
-            arcpy.Delete_management(iNatExchangeUtils.output_path + '/obscured_for_ebar_import.csv')
-        arcpy.conversion.TableToTable('observations', iNatExchangeUtils.output_path, 'obscured_for_ebar_import.csv')
-        iNatExchangeUtils.displayMessage(messages, 'Created ' + iNatExchangeUtils.output_path +
-                                         '/obscured_for_ebar_import.csv')
+        # export observations inside the terrestrial buffers, split into unobscured and obscured as rows are read
+        iNatExchangeUtils.startRun('iNatEBARExport', messages)
+        try:
+            with iNatExchangeUtils.stage('Loading jurisdiction buffers', messages):
+                # prepared polygons come from the geometry cache rather than a buffer layer and location selection
+                # (the gdb buffers with arcpy, selected by JurisdictionID NOT IN (14, 15) as before)
+                index = backend.jurisdictionIndex(messages)
+                canada = backend.canadaJurisdictions()
+            species_names = None
+            if param_species_list:
+                with iNatExchangeUtils.stage('Reading species of interest', messages) as stage:
+                    species_names = iNatTaxa.readSpeciesList(param_species_list)
+                    stage.rows = len(species_names)
+            field_names = [name for name, field_type in backend.fields(work_store, 'observations')]
+            private_latitude_index = field_names.index('private_latitude')
+            scientific_name_index = field_names.index('scientific_name')
+            with iNatExchangeUtils.stage('Exporting observations', messages) as stage:
+                with iNatCsv.CsvWriter(iNatExchangeUtils.output_path + '/unobscured_for_ebar_import.csv', field_names,
+                                       iNatExchangeUtils.csv_compression) as unobscured_writer, \
+                        iNatCsv.CsvWriter(iNatExchangeUtils.output_path + '/obscured_for_ebar_import.csv', field_names,
+                                          iNatExchangeUtils.csv_compression) as obscured_writer:
+                    frame = iNatFrame.loadFrame(work_store, messages) if observations == 'observations' else None
+                    if frame is not None:
+                        # privacy and Canada (for iNat Ingestor only, i.e. its terrestrial buffers) decided as masks
+                        # over the observation frame, then one read of the selected rows
+                        mask = ~frame.isIn('geoprivacy', ['private']) & frame.insideMask(index, canada, (0,))
+                        rows = iNatJoins.semiJoin(backend.readRows(work_store, observations, field_names),
+                                                  field_names.index('id'), frame.selectIds(mask))
+                    else:
+                        rows = backend.readRows(work_store, observations, field_names + ['SHAPE@XY'],
+                                                "geoprivacy IS NULL OR geoprivacy <> 'private'")
+                    # limit to EBAR species of interest, before the spatial test
+                    if species_names is not None:
+                        rows = (row for row in rows if row[scientific_name_index] in species_names)
+                    if frame is None:
+                        # limit to Canada (for iNat Ingestor only), i.e. its terrestrial buffers, testing each
+                        # observation once
+                        rows = (row[:-1] for row in iNatSpatial.insideRows(rows, index, canada, (0,)))
+                    # split by private_latitude as rows are read
+                    for row in rows:
+                        if row[private_latitude_index] is None:
+                            unobscured_writer.writerow(row)
+                        else:
+                            obscured_writer.writerow(row)
+                stage.rows = unobscured_writer.rows + obscured_writer.rows
+            for csv_writer in (unobscured_writer, obscured_writer):
+                iNatExchangeUtils.displayMessage(messages, 'Created ' + csv_writer.path + ' (' + str(csv_writer.rows) +
+                                                 ' rows)')
+        finally:
+            iNatExchangeUtils.finishRun(messages)
 
         # finish time
         finish_time = datetime.datetime.now()
@@ -74,11 +103,16 @@ class iNatEBARExportTool:
 
 # controlling process
 if __name__ == '__main__':
+    import arcpy
     inee = iNatEBARExportTool()
     # hard code parameters for debugging
     param_project_path = arcpy.Parameter()
     param_project_path.value = 'D:/GIS/iNatExchange'
     param_input_label = arcpy.Parameter()
     param_input_label.value = 'inaturalist-canada-5'
-    parameters = [param_project_path, param_input_label]
+    param_csv_compression = arcpy.Parameter()
+    param_csv_compression.value = None
+    param_species_list = arcpy.Parameter()
+    param_species_list.value = None
+    parameters = [param_project_path, param_input_label, param_csv_compression, param_species_list]
     inee.runiNatEBARExportTool(parameters, None)
@@ -7,9 +7,16 @@
 # Program: iNatExchangeUtils.py
 # Code shared by ArcGIS Python tools in the iNatExchange Tools Python Toolbox
 
-
-import arcpy
-
+import concurrent.futures
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
 
 prov_dict = {'CA': 'Canada',
              'AC': 'Atlantic Canada',
@@ -26,6 +33,9 @@ prov_dict = {'CA': 'Canada',
              'YT': 'Yukon',
              'NT': 'Northwest Territories',
              'NU': 'Nunavut'}
+# jurisdictions made up of several provinces/territories
+jurisdiction_groups = {'AC': ['NL', 'NS', 'NB', 'PE'],
+                       'CA': ['NL', 'NS', 'NB', 'PE', 'QC', 'ON', 'MB', 'SK', 'AB', 'BC', 'YT', 'NT', 'NU']}
 # can be overridden in tools via parameters
 project_path = 'D:/GIS/iNatExchange'
 input_folder = 'Input'
@@ -35,10 +45,97 @@ input_prefix = input_label + '-'
 output_folder = 'Output'
 output_path = project_path + '/' + output_folder
 date_label = '3June2021'
+# compression of exported CSVs (None, 'gzip' or 'zstd')
+csv_compression = None
+# profile tool runs with 'cprofile' or 'sampling' (set the INAT_PROFILE environment variable for production runs)
+profile_mode = os.environ.get('INAT_PROFILE')
+# seconds between stack samples when profile_mode is 'sampling'
+sampling_interval = 0.01
+# functions listed in the run report's hot spots
+hot_spot_count = 30
 ## assume gdb is in same folder as tools? how to get it?
 #jur_buffer = 'C:/GIS/iNatExchangeTools/iNatExchangeTools.gdb/JurisdictionBufferWGS84'
 #marine_eez = 'C:/GIS/iNatExchangeTools/iNatExchangeTools.gdb/MarineBufferWGS84'
 
+# types for fields written by the streaming loaders (any field not listed is TEXT)
+field_types = {'id': 'LONG',
+               'user_id': 'LONG',
+               'taxon_id': 'LONG',
+               'observation_id': 'LONG',
+               'resource_id': 'LONG',
+               'parent_id': 'LONG',
+               'observation_field_id': 'LONG',
+               'latitude': 'DOUBLE',
+               'longitude': 'DOUBLE',
+               'private_latitude': 'DOUBLE',
+               'private_longitude': 'DOUBLE',
+               'positional_accuracy': 'DOUBLE',
+               'public_positional_accuracy': 'DOUBLE',
+               'lon': 'DOUBLE',
+               'lat': 'DOUBLE',
+               'observed_on': 'DATE'}
+# tables other than observations in an iNaturalist extract
+related_tables = ['annotations', 'comments', 'conservation_statuses', 'identifications', 'observation_field_values',
+                  'observation_fields', 'quality_metrics', 'taxa', 'users']
+# query and join field indexes added to the working gdb after import
+import_indexes = [('observations', 'id', 'id_idx'),
+                  ('observations', 'place_admin1_name', 'place_admin1_name_idx'),
+                  ('observations', 'geoprivacy', 'geoprivacy_idx'),
+                  ('observations', 'taxon_geoprivacy', 'taxon_geoprivacy_idx'),
+                  ('observations', 'private_latitude', 'private_latitude_idx'),
+                  ('observations', 'scientific_name', 'scientific_name_idx'),
+                  ('annotations', 'resource_id', 'resource_id_idx'),
+                  ('comments', 'parent_id', 'parent_id_idx'),
+                  ('identifications', 'observation_id', 'observation_id_idx'),
+                  ('observation_field_values', 'observation_id', 'observation_id_idx'),
+                  ('quality_metrics', 'observation_id', 'observation_id_idx'),
+                  ('taxa', 'id', 'id_idx'),
+                  ('conservation_statuses', 'taxon_id', 'taxon_id_idx')]
+
+# observation buckets exported for jurisdictions, in output order
+bucket_names = ['ca_geo_obscured', 'ca_taxon_obscured', 'org_obscured', 'unobscured']
+# query and join field indexes added to each jurisdiction output (observations buckets use the observations list)
+export_indexes = {'observations': [('id', 'id_idx'), ('taxon_id', 'taxon_id_idx'), ('user_id', 'user_id_idx')],
+                  'annotations': [('id', 'id_idx'), ('resource_id', 'resource_id_idx')],
+                  'comments': [('id', 'id_idx'), ('parent_id', 'parent_id_idx')],
+                  'identifications': [('id', 'id_idx'), ('observation_id', 'observation_id_idx'),
+                                      ('taxon_id', 'taxon_id_idx'), ('user_id', 'user_id_idx')],
+                  'observation_field_values': [('id', 'id_idx'), ('observation_id', 'observation_id_idx'),
+                                               ('observation_field_id', 'observation_field_id_idx')],
+                  'observation_fields': [('id', 'id_idx'), ('user_id', 'user_id_idx')],
+                  'quality_metrics': [('id', 'id_idx'), ('observation_id', 'observation_id_idx'),
+                                      ('user_id', 'user_id_idx')],
+                  'taxa': [('id', 'id_idx')],
+                  'conservation_statuses': [('id', 'id_idx'), ('taxon_id', 'taxon_id_idx'), ('user_id', 'user_id_idx')],
+                  'users': [('id', 'id_idx')]}
+# related tables subset by observation, and the field holding the observation id (assumes all annotations are
+# resource_type='Observation' and all comments are parent_type='Observation')
+observation_keys = {'annotations': 'resource_id',
+                    'comments': 'parent_id',
+                    'identifications': 'observation_id',
+                    'observation_field_values': 'observation_id',
+                    'quality_metrics': 'observation_id'}
+# tables written sorted (clustered) by their main foreign key, so that the rows related to a record are stored
+# together
+cluster_keys = dict(observation_keys, conservation_statuses='taxon_id')
+# one to many relationships among the tables of a jurisdiction output (origin, destination, primary key, foreign
+# key), and those of each observations table (observations standing for observations_<bucket>)
+relationships = [('taxa', 'conservation_statuses', 'id', 'taxon_id'),
+                 ('users', 'conservation_statuses', 'id', 'user_id'),
+                 ('taxa', 'identifications', 'id', 'taxon_id'),
+                 ('users', 'identifications', 'id', 'user_id'),
+                 ('observation_fields', 'observation_field_values', 'id', 'observation_field_id'),
+                 ('users', 'observation_field_values', 'id', 'user_id'),
+                 ('users', 'observation_fields', 'id', 'user_id'),
+                 ('users', 'quality_metrics', 'id', 'user_id')]
+bucket_relationships = [('observations', 'annotations', 'id', 'resource_id'),
+                        ('observations', 'comments', 'id', 'parent_id'),
+                        ('observations', 'identifications', 'id', 'observation_id'),
+                        ('observations', 'observation_field_values', 'id', 'observation_id'),
+                        ('users', 'observations', 'id', 'user_id'),
+                        ('taxa', 'observations', 'id', 'taxon_id'),
+                        ('observations', 'quality_metrics', 'id', 'observation_id')]
+
 
 def displayMessage(messages, msg):
     """Output message to arcpy message object or to Python standard output."""
@@ -56,6 +153,7 @@ def displayMessage(messages, msg):
 
 
 def checkField(table, field_name):
+    import arcpy
     desc = arcpy.Describe(table)
     for field in desc.fields:
         if field.name == field_name:
@@ -64,8 +162,249 @@ def checkField(table, field_name):
 
 
 def fieldType(table, field_name):
+    import arcpy
     desc = arcpy.Describe(table)
     for field in desc.fields:
         if field.name == field_name:
             return field.type
     return None
+
+
+def outputIndexes(tables):
+    """List the (table, field, index name) export_indexes of a list of output tables (observations_<bucket> tables
+    use the observations list)."""
+    return [(table, field, index_name) for table in tables
+            for field, index_name in export_indexes['observations' if table.startswith('observations_') else table]]
+
+
+def observationBucket(geoprivacy, taxon_geoprivacy, private_latitude):
+    """Return the bucket an observation belongs to (same conditions as the saveBucket where clauses), or None."""
+    if private_latitude is not None:
+        if geoprivacy == 'obscured':
+            return 'ca_geo_obscured'
+        if geoprivacy in (None, 'open') and taxon_geoprivacy in ('obscured', 'private'):
+            return 'ca_taxon_obscured'
+    else:
+        if geoprivacy == 'obscured' or taxon_geoprivacy in ('obscured', 'private'):
+            return 'org_obscured'
+        if geoprivacy in (None, 'open') and taxon_geoprivacy in (None, 'open'):
+            return 'unobscured'
+    return None
+
+
+def setWorkerExecutable():
+    """Make sure worker processes run python.exe rather than ArcGISPro.exe (sys.executable inside the Pro UI)."""
+    if os.path.basename(sys.executable).lower() == 'arcgispro.exe':
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+
+
+def processPool(workers):
+    """Create a process pool with workers processes (all cores if not specified)."""
+    setWorkerExecutable()
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+
+
+def csvPath(table):
+    """Path to the CSV for a table in the current iNaturalist extract."""
+    return input_path + '/' + input_prefix + table + '.csv'
+
+
+def resourceUsage():
+    """Return current RSS, peak RSS, bytes read and bytes written by this process (None where unavailable)."""
+    rss = peak_rss = read_bytes = write_bytes = None
+    try:
+        import psutil
+        process = psutil.Process()
+        memory = process.memory_info()
+        rss = memory.rss
+        # peak working set on Windows
+        peak_rss = getattr(memory, 'peak_wset', None)
+        counters = process.io_counters()
+        read_bytes = getattr(counters, 'read_chars', counters.read_bytes)
+        write_bytes = getattr(counters, 'write_chars', counters.write_bytes)
+    except (ImportError, AttributeError, OSError):
+        pass
+    if peak_rss is None:
+        try:
+            import resource
+            # kilobytes on Linux
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        except ImportError:
+            pass
+    if read_bytes is None and os.path.exists('/proc/self/io'):
+        with open('/proc/self/io') as proc_io:
+            counters = dict(line.split(': ') for line in proc_io.read().splitlines())
+        read_bytes = int(counters['rchar'])
+        write_bytes = int(counters['wchar'])
+    if rss is None and os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return rss, peak_rss, read_bytes, write_bytes
+
+
+class Stage:
+    """Timing, row count and resource use of one (possibly nested) stage of a tool run"""
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.children = []
+        self.start = time.perf_counter()
+        self.start_usage = resourceUsage()
+        self.seconds = None
+        self.end_usage = None
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.start
+        self.end_usage = resourceUsage()
+
+    def report(self):
+        """Return the stage and its children as a dictionary for the JSON run report."""
+        rss, peak_rss, read_bytes, write_bytes = self.end_usage
+        stage = {'name': self.name,
+                 'seconds': round(self.seconds, 3),
+                 'rows': self.rows,
+                 'rows_per_second': int(self.rows / self.seconds) if self.rows and self.seconds else None,
+                 'rss_mb': None if rss is None else round(rss / 1048576, 1),
+                 'peak_rss_mb': None if peak_rss is None else round(peak_rss / 1048576, 1)}
+        if read_bytes is not None and self.start_usage[2] is not None:
+            stage['bytes_read'] = read_bytes - self.start_usage[2]
+            stage['bytes_written'] = write_bytes - self.start_usage[3]
+        if self.children:
+            stage['stages'] = [child.report() for child in self.children]
+        return stage
+
+
+class StackSampler(threading.Thread):
+    """Sample the stack of the thread running a tool (not necessarily the main thread: ArcGIS Pro runs tools on a
+    geoprocessing thread) at intervals, counting the functions running (self) and on the stack (cumulative)"""
+    def __init__(self, interval, thread_id):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = 0
+        self.self_counts = {}
+        self.total_counts = {}
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            seen = set()
+            leaf = True
+            while frame is not None:
+                code = frame.f_code
+                function = os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + '(' + \
+                    code.co_name + ')'
+                if leaf:
+                    self.self_counts[function] = self.self_counts.get(function, 0) + 1
+                    leaf = False
+                if function not in seen:
+                    self.total_counts[function] = self.total_counts.get(function, 0) + 1
+                    seen.add(function)
+                frame = frame.f_back
+
+    def report(self):
+        self.stopping.set()
+        self.join()
+        top = sorted(self.total_counts.items(), key=lambda item: -item[1])[:hot_spot_count]
+        samples = max(self.samples, 1)
+        return [{'function': function, 'self_share': round(self.self_counts.get(function, 0) / samples, 3),
+                 'total_share': round(count / samples, 3)} for function, count in top]
+
+
+class RunReport:
+    """Stages of one tool run, written as JSON next to its outputs"""
+    def __init__(self, tool, messages=None, profile=None, thread_id=None):
+        self.tool = tool
+        self.messages = messages
+        self.start_time = datetime.datetime.now()
+        self.root = Stage(tool)
+        self.stack = [self.root]
+        self.profile = profile
+        self.profiler = None
+        if profile == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profile == 'sampling':
+            self.profiler = StackSampler(sampling_interval, thread_id)
+            self.profiler.start()
+
+    def hotSpots(self, profile_path):
+        """Stop profiling, save cProfile stats beside the report and return the top functions."""
+        if self.profile == 'cprofile':
+            import pstats
+            self.profiler.disable()
+            self.profiler.dump_stats(profile_path)
+            stats = pstats.Stats(self.profiler).stats
+            top = sorted(stats.items(), key=lambda item: -item[1][3])[:hot_spot_count]
+            return [{'function': os.path.basename(filename) + ':' + str(line) + '(' + function + ')',
+                     'calls': calls, 'self_seconds': round(self_seconds, 3), 'total_seconds': round(total_seconds, 3)}
+                    for (filename, line, function), (primitive_calls, calls, self_seconds, total_seconds, callers)
+                    in top]
+        return self.profiler.report()
+
+    def write(self, folder, error=None):
+        """Finish the run and write <tool>_<start time>_report.json to folder, with the exception that stopped the
+        run if any; returns the report path."""
+        self.root.finish()
+        path = folder + '/' + self.tool + '_' + self.start_time.strftime('%Y%m%d_%H%M%S') + '_report.json'
+        report = {'tool': self.tool,
+                  'input_label': input_label,
+                  'start_time': self.start_time.isoformat(timespec='seconds'),
+                  'finish_time': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'profile': self.profile,
+                  'error': None if error is None else type(error).__name__ + ': ' + str(error),
+                  'stages': self.root.report()}
+        if self.profiler is not None:
+            report['hot_spots'] = self.hotSpots(os.path.splitext(path)[0] + '.prof')
+        with io.open(path, 'w', encoding='utf8') as report_file:
+            json.dump(report, report_file, indent=2)
+        return path
+
+
+# report of the tool run in progress (see startRun)
+run_report = None
+
+
+def startRun(tool, messages=None):
+    """Start recording the stages of a tool run (and profiling it if profile_mode is set)."""
+    global run_report
+    # the sampler follows the thread the tool runs on
+    run_report = RunReport(tool, messages, profile_mode, threading.get_ident())
+
+
+@contextlib.contextmanager
+def stage(name, messages=None):
+    """Time a stage of the current run, nested in any enclosing stage; add the rows it handles to the yielded
+    Stage's rows."""
+    displayMessage(messages, name)
+    current = Stage(name)
+    if run_report is not None:
+        run_report.stack[-1].children.append(current)
+        run_report.stack.append(current)
+    try:
+        yield current
+    finally:
+        current.finish()
+        if run_report is not None:
+            run_report.stack.pop()
+        msg = 'Finished ' + name + ' in ' + str(round(current.seconds, 1)) + 's'
+        if current.rows:
+            msg += ' (' + str(current.rows) + ' rows, ' + str(int(current.rows / max(current.seconds, 1e-6))) + \
+                ' rows/s)'
+        displayMessage(messages, msg)
+
+
+def finishRun(messages=None, folder=None):
+    """Write the current run's report to folder (the output folder by default); called from a finally clause, so
+    that failed runs are reported too, with the exception that stopped them."""
+    global run_report
+    if run_report is None:
+        return
+    path = run_report.write(folder or output_path, sys.exc_info()[1])
+    run_report = None
+    displayMessage(messages, 'Run report: ' + path)
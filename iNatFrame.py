@@ -0,0 +1,192 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatFrame.py
+# Compact column arrays of the observation attributes the exports decide on (id, lon, lat, geoprivacy,
+# taxon_geoprivacy, place_admin1_name and whether private coordinates are present), built at import and
+# memory-mapped from disk, so bucket, province and privacy decisions are vectorized masks rather than per-row
+# comparisons
+
+# Notes:
+# - needs NumPy, but not arcpy
+# - saved beside the working store in <working store>_frame, one .npy file per column sorted by id, with the values
+#   of each categorical column in frame.json; categorical codes are uint8 (0 for null, uint16 if a column has more
+#   than 255 values) and private coordinates are a packed bitmap, so an observation takes about 27 bytes
+# - frame.json also records the fingerprint of the working store the frame was built from; the exports ignore a
+#   frame that no longer matches its store and decide row by row instead
+# - python iNatFrame.py <working store> builds the frame and times the bucket and province masks
+
+# import Python packages
+import io
+import itertools
+import json
+import os
+import shutil
+import sys
+import time
+import numpy
+import iNatExchangeUtils
+import iNatPipeline
+import iNatStores
+
+
+# categorical columns, coded by position in their list of values
+category_columns = ['geoprivacy', 'taxon_geoprivacy', 'place_admin1_name']
+# observation fields read to build the frame
+frame_fields = ['id', 'lon', 'lat'] + category_columns + ['private_latitude']
+# rows read per batch when building
+frame_batch_size = 1000000
+
+
+def framePath(store_path):
+    """Folder of the observation frame of a working store."""
+    return os.path.splitext(store_path)[0] + '_frame'
+
+
+def encode(values, lookup):
+    """uint32 codes of a list of values, adding new values to a value -> code lookup (None is always 0)."""
+    return numpy.fromiter((lookup.setdefault(value, len(lookup)) for value in values), dtype=numpy.uint32,
+                          count=len(values))
+
+
+def buildFrame(store_path, messages=None):
+    """Save the observation frame of a working store and return the number of observations."""
+    store = iNatStores.openStore(store_path)
+    lookups = dict((column, {None: 0}) for column in category_columns)
+    parts = dict((column, []) for column in frame_fields)
+    rows = store.readRows('observations', frame_fields)
+    while True:
+        batch = list(itertools.islice(rows, frame_batch_size))
+        if not batch:
+            break
+        columns = list(zip(*batch))
+        parts['id'].append(numpy.array(columns[0], dtype=numpy.int64))
+        parts['lon'].append(numpy.array(columns[1], dtype=numpy.float64))
+        parts['lat'].append(numpy.array(columns[2], dtype=numpy.float64))
+        for position, column in enumerate(category_columns):
+            parts[column].append(encode(columns[3 + position], lookups[column]))
+        parts['private_latitude'].append(numpy.array([value is not None for value in columns[-1]], dtype=bool))
+    store.close()
+    arrays = dict((column, numpy.concatenate(part) if part else numpy.zeros(0)) for column, part in parts.items())
+    order = numpy.argsort(arrays['id'], kind='stable')
+
+    # write to a temporary folder, then replace any existing frame
+    folder = framePath(store_path)
+    temp_folder = folder + '_tmp'
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder)
+    numpy.save(temp_folder + '/id.npy', arrays['id'].astype(numpy.int64)[order])
+    numpy.save(temp_folder + '/lon.npy', arrays['lon'].astype(numpy.float64)[order])
+    numpy.save(temp_folder + '/lat.npy', arrays['lat'].astype(numpy.float64)[order])
+    for column in category_columns:
+        dtype = numpy.uint8 if len(lookups[column]) <= 256 else numpy.uint16
+        numpy.save(temp_folder + '/' + column + '.npy', arrays[column].astype(dtype)[order])
+    numpy.save(temp_folder + '/private.npy', numpy.packbits(arrays['private_latitude'].astype(bool)[order]))
+    categories = dict((column, sorted(lookup, key=lookup.get)) for column, lookup in lookups.items())
+    with io.open(temp_folder + '/frame.json', 'w', encoding='utf8') as frame_file:
+        json.dump({'count': len(order), 'fingerprint': iNatPipeline.pathFingerprint(store_path),
+                   'categories': categories}, frame_file, indent=2)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(temp_folder, folder)
+    iNatExchangeUtils.displayMessage(messages, 'Built observation frame of ' + str(len(order)) + ' observations')
+    return len(order)
+
+
+class ObservationFrame:
+    """Memory-mapped observation columns sorted by id, answering selections with boolean masks"""
+    def __init__(self, folder):
+        with io.open(folder + '/frame.json', 'r', encoding='utf8') as frame_file:
+            frame = json.load(frame_file)
+        self.count = frame['count']
+        self.fingerprint = frame['fingerprint']
+        self.categories = frame['categories']
+        self.ids = numpy.load(folder + '/id.npy', mmap_mode='r')
+        self.lon = numpy.load(folder + '/lon.npy', mmap_mode='r')
+        self.lat = numpy.load(folder + '/lat.npy', mmap_mode='r')
+        self.codes = dict((column, numpy.load(folder + '/' + column + '.npy', mmap_mode='r'))
+                          for column in category_columns)
+        self.private_bits = numpy.load(folder + '/private.npy', mmap_mode='r')
+        self.buckets = None
+
+    def __len__(self):
+        return self.count
+
+    def isIn(self, column, values):
+        """Boolean mask of the observations whose categorical column has any of a list of values (None for
+        null)."""
+        codes = [self.categories[column].index(value) for value in values if value in self.categories[column]]
+        return numpy.isin(self.codes[column], codes)
+
+    def privateCoordinates(self):
+        """Boolean mask of the observations with private coordinates."""
+        return numpy.unpackbits(self.private_bits, count=self.count).astype(bool)
+
+    def bucketCodes(self):
+        """Position in iNatExchangeUtils.bucket_names of the bucket of every observation (-1 for none), with the
+        conditions of iNatExchangeUtils.observationBucket."""
+        if self.buckets is None:
+            private = self.privateCoordinates()
+            geo_obscured = self.isIn('geoprivacy', ['obscured'])
+            geo_open = self.isIn('geoprivacy', [None, 'open'])
+            taxon_hidden = self.isIn('taxon_geoprivacy', ['obscured', 'private'])
+            taxon_open = self.isIn('taxon_geoprivacy', [None, 'open'])
+            # in the order of bucket_names
+            conditions = [private & geo_obscured,
+                          private & geo_open & taxon_hidden,
+                          ~private & (geo_obscured | taxon_hidden),
+                          ~private & geo_open & taxon_open]
+            self.buckets = numpy.select(conditions, list(range(len(conditions))), -1).astype(numpy.int8)
+        return self.buckets
+
+    def lookupBuckets(self, ids):
+        """Bucket codes (as bucketCodes) of an int64 array of observation ids, -1 for ids not in the frame."""
+        buckets = self.bucketCodes()
+        if not self.count:
+            return numpy.full(len(ids), -1, dtype=numpy.int8)
+        positions = numpy.searchsorted(self.ids, ids)
+        positions[positions == self.count] = 0
+        return numpy.where(self.ids[positions] == ids, buckets[positions], -1).astype(numpy.int8)
+
+    def insideMask(self, index, jurisdictions, marine=(0, 1)):
+        """Boolean mask of the observations inside any polygon of a list of jurisdictions and groups of an
+        iNatSpatial.JurisdictionIndex."""
+        return index.containsAny(self.lon, self.lat, jurisdictions, marine)
+
+    def selectIds(self, mask):
+        """iNatJoins.IdSet of the observations in a mask."""
+        import iNatJoins
+        return iNatJoins.IdSet(self.ids[mask])
+
+
+def loadFrame(store_path, messages=None):
+    """ObservationFrame of a working store, or None if it has none or the store has changed since it was built."""
+    folder = framePath(store_path)
+    if not os.path.exists(folder + '/frame.json'):
+        return None
+    frame = ObservationFrame(folder)
+    if frame.fingerprint != iNatPipeline.pathFingerprint(store_path):
+        iNatExchangeUtils.displayMessage(messages, 'Observation frame ' + folder + ' is out of date, deciding row ' +
+                                         'by row (reimport to rebuild it)')
+        return None
+    return frame
+
+
+# controlling process
+if __name__ == '__main__':
+    # usage: python iNatFrame.py <working store>
+    start = time.perf_counter()
+    built = buildFrame(sys.argv[1])
+    print('Built frame of ' + str(built) + ' observations in ' + str(round(time.perf_counter() - start, 2)) + 's')
+    start = time.perf_counter()
+    observation_frame = loadFrame(sys.argv[1])
+    bucket_codes = observation_frame.bucketCodes()
+    print('Decided buckets in ' + str(round((time.perf_counter() - start) * 1000, 1)) + 'ms: ' +
+          str(dict((name, int((bucket_codes == position).sum()))
+                   for position, name in enumerate(iNatExchangeUtils.bucket_names))))
+    start = time.perf_counter()
+    named = observation_frame.isIn('place_admin1_name', ['Ontario'])
+    print('Matched ' + str(int(named.sum())) + ' Ontario observations in ' +
+          str(round((time.perf_counter() - start) * 1000, 1)) + 'ms')
@@ -7,10 +7,19 @@
 # Program: iNatImportTool.py
 # ArcGIS Python tool for importing iNaturalist.ca CSVs into working gdb
 
+# Notes:
+# - without arcpy (see iNatBackends), the CSVs are streamed into a working GeoPackage
+
 # import Python packages
-import arcpy
+import iNatBackends
+import iNatDelta
 import iNatExchangeUtils
+import iNatFrame
+import iNatLoader
+import iNatSpatial
+import iNatTaxa
 import datetime
+import os
 
 
 class iNatImportTool:
@@ -27,102 +36,108 @@ class iNatImportTool:
         iNatExchangeUtils.displayMessage(messages, 'Processing parameters')
         iNatExchangeUtils.project_path = parameters[0].valueAsText
         iNatExchangeUtils.output_path = iNatExchangeUtils.project_path + '/' + iNatExchangeUtils.output_folder
-        if not arcpy.Exists(iNatExchangeUtils.output_path):
-            arcpy.management.CreateFolder(iNatExchangeUtils.project_path, iNatExchangeUtils.output_folder)
+        os.makedirs(iNatExchangeUtils.output_path, exist_ok=True)
         iNatExchangeUtils.input_label = parameters[1].valueAsText
         iNatExchangeUtils.input_path = iNatExchangeUtils.project_path + '/' + iNatExchangeUtils.input_folder + '/' + \
             iNatExchangeUtils.input_label
         iNatExchangeUtils.input_prefix = iNatExchangeUtils.input_label + '-'
-        if not arcpy.Exists(iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + '.gdb'):
-            arcpy.management.CreateFileGDB(iNatExchangeUtils.output_path, iNatExchangeUtils.input_label + '.gdb')
-        arcpy.env.workspace = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + '.gdb'
+        iNatExchangeUtils.startRun('iNatImport', messages)
+        try:
+            param_streaming = parameters[2].valueAsText
+            param_store_format = parameters[3].valueAsText
+            backend = iNatBackends.getBackend()
+            if backend.name == 'open' and param_store_format != 'GeoPackage':
+                iNatExchangeUtils.displayMessage(messages, 'arcpy is not available, importing into a GeoPackage')
+                param_store_format = 'GeoPackage'
+            # related tables are imported by a pool of workers (all cores if not specified)
+            param_workers = int(parameters[4].valueAsText) if parameters[4].valueAsText else None
+            # optional columnar copy of every table, read directly from the CSVs (needs pyarrow)
+            param_columnar = parameters[6].valueAsText
+            if param_columnar == 'true':
+                import iNatColumnar
+                with iNatExchangeUtils.stage('Writing columnar copy', messages):
+                    iNatColumnar.writeColumnar(iNatColumnar.columnarPath(iNatExchangeUtils.input_label), messages)
 
-        # import observations, giving preference to private coordinates where available
-        iNatExchangeUtils.displayMessage(messages, 'Importing observations')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'observations.csv', arcpy.env.workspace, 'obs_temp')
-        iNatExchangeUtils.displayMessage(messages,
-                                         'Plotting observations, preferring private coordinates where available')
-        arcpy.management.AddField('obs_temp', 'lon', 'DOUBLE')
-        arcpy.management.AddField('obs_temp', 'lat', 'DOUBLE')
-        arcpy.management.AddField('obs_temp', 'observed_on_text', 'TEXT')
-        expr = '''
-def get_coord(coord, private_coord):
-    if private_coord:
-        return private_coord
-    else:
-        return coord'''
-        arcpy.management.CalculateField('obs_temp', 'lon', 'get_coord(!longitude!, !private_longitude!)', 'PYTHON3',
-                                        expr)
-        arcpy.management.CalculateField('obs_temp', 'lat', 'get_coord(!latitude!, !private_latitude!)', 'PYTHON3',
-                                        expr)
-        # newer versions of ArcGIS interpret observed_on as Date Only, which Python interprets as Text not as DateTime
-        arcpy.management.CalculateField('obs_temp', 'observed_on_text', '!observed_on!', 'PYTHON3')
-        # arcpy.management.CalculateField('obs_temp', 'observed_on_text', "!observed_on!.strftime('%Y-%m-%d')", 'PYTHON3')
-        arcpy.management.MakeTableView('obs_temp', 'obs_temp_vw', "geoprivacy IS NULL OR geoprivacy <> 'private'")
-        arcpy.management.XYTableToPoint('obs_temp_vw', 'observations', 'lon', 'lat')
-        arcpy.management.Delete('obs_temp_vw')
-        arcpy.management.Delete('obs_temp')
-
-        # import other tables
-        iNatExchangeUtils.displayMessage(messages, 'Importing annotations')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'annotations.csv', arcpy.env.workspace, 'annotations')
-        iNatExchangeUtils.displayMessage(messages, 'Importing comments')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'comments.csv', arcpy.env.workspace, 'comments')
-        iNatExchangeUtils.displayMessage(messages, 'Importing conservation_statuses')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'conservation_statuses.csv', arcpy.env.workspace, 'conservation_statuses')
-        iNatExchangeUtils.displayMessage(messages, 'Importing identifications')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'identifications.csv', arcpy.env.workspace, 'identifications')
-        iNatExchangeUtils.displayMessage(messages, 'Importing observation_field_values')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'observation_field_values.csv', arcpy.env.workspace, 'observation_field_values')
-        iNatExchangeUtils.displayMessage(messages, 'Importing observation_fields')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'observation_fields.csv', arcpy.env.workspace, 'observation_fields')
-        iNatExchangeUtils.displayMessage(messages, 'Importing quality_metrics')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'quality_metrics.csv', arcpy.env.workspace, 'quality_metrics')
-        iNatExchangeUtils.displayMessage(messages, 'Importing taxa')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'taxa.csv', arcpy.env.workspace, 'taxa')
-        iNatExchangeUtils.displayMessage(messages, 'Importing users')
-        arcpy.conversion.TableToTable(iNatExchangeUtils.input_path + '/' + iNatExchangeUtils.input_prefix +
-                                      'users.csv', arcpy.env.workspace, 'users')
-        arcpy.management.DeleteField(arcpy.env.workspace + '/users', 'email')
-        arcpy.management.DeleteField(arcpy.env.workspace + '/users', 'name')
-
-        # add indexes
-        iNatExchangeUtils.displayMessage(messages, 'Indexing query and join fields')
-        arcpy.management.AddIndex('observations', ['id'], 'id_idx')
-        arcpy.management.AddIndex('observations', ['place_admin1_name'], 'place_admin1_name_idx')
-        arcpy.management.AddIndex('observations', ['geoprivacy'], 'geoprivacy_idx')
-        arcpy.management.AddIndex('observations', ['taxon_geoprivacy'], 'taxon_geoprivacy_idx')
-        arcpy.management.AddIndex('observations', ['private_latitude'], 'private_latitude_idx')
-        arcpy.management.AddIndex('observations', ['scientific_name'], 'scientific_name_idx')
-        arcpy.management.AddIndex('annotations', ['resource_id'], 'resource_id_idx')
-        arcpy.management.AddIndex('comments', ['parent_id'], 'parent_id_idx')
-        arcpy.management.AddIndex('identifications', ['observation_id'], 'observation_id_idx')
-        arcpy.management.AddIndex('observation_field_values', ['observation_id'], 'observation_id_idx')
-        arcpy.management.AddIndex('quality_metrics', ['observation_id'], 'observation_id_idx')
-        arcpy.management.AddIndex('taxa', ['id'], 'id_idx')
-        arcpy.management.AddIndex('conservation_statuses', ['taxon_id'], 'taxon_id_idx')
+            # apply only the changes since a previous extract to that extract's working store
+            param_previous_label = parameters[5].valueAsText
+            if param_previous_label:
+                extension = '.gpkg' if param_store_format == 'GeoPackage' else '.gdb'
+                with iNatExchangeUtils.stage('Importing changes since ' + param_previous_label, messages):
+                    iNatDelta.deltaImport(param_previous_label, iNatExchangeUtils.output_path + '/' +
+                                          iNatExchangeUtils.input_label + extension, messages)
+            elif param_streaming == 'true' or param_store_format == 'GeoPackage':
+                self.streamingImport(param_store_format, param_workers, messages)
+            else:
+                self.geoprocessingImport(backend, param_workers, messages)
+        finally:
+            iNatExchangeUtils.finishRun(messages)
 
         # finish time
         finish_time = datetime.datetime.now()
         iNatExchangeUtils.displayMessage(messages, 'Finish time: ' + str(finish_time))
 
+    def geoprocessingImport(self, backend, workers, messages):
+        """Import the CSVs into a working gdb with geoprocessing tools"""
+        store_path = backend.storePath(iNatExchangeUtils.output_path, iNatExchangeUtils.input_label)
+        backend.createStore(store_path)
+
+        # import observations, giving preference to private coordinates where available
+        with iNatExchangeUtils.stage('Importing observations', messages) as stage:
+            stage.rows = backend.importObservations(iNatExchangeUtils.input_path + '/' +
+                                                    iNatExchangeUtils.input_prefix + 'observations.csv', store_path,
+                                                    messages)
+
+        # import other tables concurrently, each into its own staging gdb
+        with iNatExchangeUtils.stage('Importing ' + ', '.join(iNatExchangeUtils.related_tables), messages) as stage:
+            stage.rows = iNatLoader.importTables(iNatExchangeUtils.related_tables, store_path, 'geoprocessing',
+                                                 workers, messages)
+
+        # all indexes in one stage, once every table is loaded
+        with iNatExchangeUtils.stage('Indexing query and join fields', messages) as stage:
+            stage.rows = backend.addIndexes(store_path, iNatExchangeUtils.import_indexes, workers,
+                                            messages)
+
+        # taxon name prefix and clade indexes for species and clade exports
+        with iNatExchangeUtils.stage('Indexing taxa', messages) as stage:
+            stage.rows = iNatTaxa.indexTaxa(store_path, messages)
+
+        # precompute jurisdiction buffer membership so exports don't repeat the spatial selections
+        with iNatExchangeUtils.stage('Computing observation jurisdiction membership', messages):
+            iNatSpatial.buildMembership(store_path, messages)
+
+        # compact observation columns for vectorized bucket, province and privacy decisions (last, as it records the
+        # store's fingerprint)
+        with iNatExchangeUtils.stage('Building observation frame', messages) as stage:
+            stage.rows = iNatFrame.buildFrame(store_path, messages)
+
+    def streamingImport(self, store_format, workers, messages):
+        """Import the CSVs in a single pass each into a working gdb or GeoPackage"""
+        if store_format == 'GeoPackage':
+            store_path = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + '.gpkg'
+        else:
+            store_path = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + '.gdb'
+        iNatLoader.importExtract(store_path, workers, messages)
+
 
 # controlling process
 if __name__ == '__main__':
+    import arcpy
     ini = iNatImportTool()
     # hard code parameters for debugging
     param_project_path = arcpy.Parameter()
     param_project_path.value = 'D:/GIS/iNatExchange'
     param_input_label = arcpy.Parameter()
     param_input_label.value = 'inaturalist-canada-5'
-    parameters = [param_project_path, param_input_label]
+    param_streaming = arcpy.Parameter()
+    param_streaming.value = 'false'
+    param_store_format = arcpy.Parameter()
+    param_store_format.value = 'File Geodatabase'
+    param_workers = arcpy.Parameter()
+    param_workers.value = None
+    param_previous_label = arcpy.Parameter()
+    param_previous_label.value = None
+    param_columnar = arcpy.Parameter()
+    param_columnar.value = 'false'
+    parameters = [param_project_path, param_input_label, param_streaming, param_store_format, param_workers,
+                  param_previous_label, param_columnar]
     ini.runiNatImportTool(parameters, None)
@@ -0,0 +1,314 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatJoins.py
+# Semi-joins that keep the related rows whose key is in a set of selected ids, streaming each table once (replaces
+# the MakeTableView/AddJoin KEEP_COMMON/SelectLayerByAttribute/RemoveJoin round trip)
+
+# Notes:
+# - needs NumPy (included with ArcGIS Pro), but not arcpy
+# - for limited memory, externalSort sorts a table by its key into runs on disk of at most a given number of bytes
+#   each, and mergeJoin streams the merged runs against the sorted selected ids, so memory use depends on the cap
+#   rather than the size of the table (and no index on the key is needed); runs are merged at most merge_fan_in at
+#   a time (in passes through intermediate runs if there are more), reading blocks of a run's rows divided by
+#   merge_fan_in, so the merge also holds about the cap
+# - python iNatJoins.py [child rows] benchmarks the semi-join against the existing join path
+
+# import Python packages
+import csv
+import heapq
+import io
+import itertools
+import operator
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+
+
+# rows classified per vectorized membership test
+batch_size = 100000
+# default memory cap (bytes) of the rows held by externalSort, and the rows sampled to estimate row sizes
+sort_memory = 256 * 1024 * 1024
+sort_sample_rows = 1000
+# runs merged at once; the rows of a run are pickled in this many blocks, one of which is read from each run merged
+merge_fan_in = 64
+# use a bitmap indexed by id (one bit per possible id) when it needs no more bytes per id than the sorted array it
+# replaces (8 bytes per id)
+bitmap_bytes_per_id = 8
+
+
+class IdSet:
+    """Compact set of integer ids supporting vectorized membership tests"""
+    def __init__(self, ids):
+        ids = numpy.unique(numpy.asarray(ids, dtype=numpy.int64))
+        self.ids = ids[ids >= 0]
+        self.bitmap = None
+        if len(self.ids) and (int(self.ids[-1]) + 8) // 8 <= bitmap_bytes_per_id * len(self.ids):
+            # dense ids (iNat ids are sequential), one bit per possible id packed eight to a byte
+            # the ids are sorted and unique, so the bits of each byte are summed over its run of ids
+            byte_indexes = self.ids >> 3
+            starts = numpy.flatnonzero(numpy.concatenate(([True], byte_indexes[1:] != byte_indexes[:-1])))
+            self.bitmap = numpy.zeros((int(self.ids[-1]) + 8) // 8, dtype=numpy.uint8)
+            self.bitmap[byte_indexes[starts]] = numpy.add.reduceat(1 << (self.ids & 7), starts)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, value):
+        return bool(self.contains(numpy.array([-1 if value is None else value], dtype=numpy.int64))[0])
+
+    def union(self, other):
+        return IdSet(numpy.concatenate((self.ids, other.ids)))
+
+    def contains(self, values):
+        """Return a boolean array saying which of an int64 array of values (-1 for null) are in the set."""
+        if self.bitmap is not None:
+            inside = (values >= 0) & (values < 8 * len(self.bitmap))
+            mask = numpy.zeros(len(values), dtype=bool)
+            values = values[inside]
+            mask[inside] = (self.bitmap[values >> 3] >> (values & 7).astype(numpy.uint8)) & 1
+            return mask
+        positions = numpy.searchsorted(self.ids, values)
+        positions[positions == len(self.ids)] = 0
+        return (self.ids[positions] == values) if len(self.ids) else numpy.zeros(len(values), dtype=bool)
+
+
+def keyArray(rows, key_index):
+    """Return an int64 array of the key column of a batch of rows (-1 for null or non-numeric keys)."""
+    keys = [row[key_index] for row in rows]
+    try:
+        # fast path when every key is present (ints from cursors or digits from CSVs)
+        return numpy.array(keys, dtype=numpy.int64)
+    except (TypeError, ValueError):
+        pass
+    array = numpy.empty(len(keys), dtype=numpy.int64)
+    for i, key in enumerate(keys):
+        try:
+            array[i] = int(key)
+        except (TypeError, ValueError):
+            array[i] = -1
+    return array
+
+
+def semiJoin(rows, key_index, id_set, size=batch_size):
+    """Yield the rows whose key_index value is in id_set, testing membership a batch at a time."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        mask = id_set.contains(keyArray(batch, key_index))
+        yield from itertools.compress(batch, mask.tolist())
+
+
+def readIds(rows, key_index=0):
+    """Build an IdSet from a column of rows."""
+    return IdSet(numpy.fromiter((row[key_index] for row in rows if row[key_index] is not None), dtype=numpy.int64))
+
+
+def rowBytes(rows):
+    """Estimated memory used by each of a list of rows (tuple and values)."""
+    sample = rows[:sort_sample_rows]
+    return max(1, sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in sample) // max(1, len(sample)))
+
+
+def sortRun(rows, key_index, nulls=False):
+    """Return the (key, row) pairs of a list of rows sorted by key, dropping rows with null keys (or keeping them
+    first with key -1 if nulls)."""
+    keys = keyArray(rows, key_index)
+    order = numpy.argsort(keys, kind='stable')
+    if not nulls:
+        order = order[keys[order] >= 0]
+    keys = keys.tolist()
+    return [(keys[i], rows[i]) for i in order.tolist()]
+
+
+def writeRun(pairs, run_path, block_rows):
+    """Save an iterable of sorted (key, row) pairs to run_path as pickled blocks of block_rows pairs."""
+    pairs = iter(pairs)
+    with open(run_path, 'wb') as run_file:
+        while True:
+            block = list(itertools.islice(pairs, block_rows))
+            if not block:
+                return
+            pickle.dump(block, run_file, pickle.HIGHEST_PROTOCOL)
+
+
+def readRun(run_path):
+    """Yield the (key, row) pairs of a sorted run."""
+    with open(run_path, 'rb') as run_file:
+        while True:
+            try:
+                block = pickle.load(run_file)
+            except EOFError:
+                return
+            yield from block
+
+
+def mergeRuns(run_paths):
+    """Yield the (key, row) pairs of sorted runs merged in key order."""
+    return heapq.merge(*[readRun(run_path) for run_path in run_paths], key=operator.itemgetter(0))
+
+
+def externalSort(rows, key_index, memory=None, folder=None, nulls=False):
+    """Yield (key, row) pairs of rows in order of their integer key_index value (rows with null keys are dropped,
+    or come first with key -1 if nulls), holding no more than about memory bytes of rows at once: rows are sorted
+    into runs saved in a temporary folder (under folder, if given), which are then merged (merge_fan_in at a time)
+    and deleted."""
+    memory = memory or sort_memory
+    rows = iter(rows)
+    run_folder = tempfile.mkdtemp(prefix='iNatSort_', dir=folder)
+    try:
+        run_paths = []
+        run_rows = None
+        while True:
+            # the first rows read set the run length
+            batch = list(itertools.islice(rows, run_rows or sort_sample_rows))
+            if not batch:
+                break
+            if run_rows is None:
+                run_rows = max(sort_sample_rows, memory // rowBytes(batch))
+                block_rows = max(1, run_rows // merge_fan_in)
+                batch += list(itertools.islice(rows, run_rows - len(batch)))
+                following = next(rows, None)
+                if following is None:
+                    # everything fits in one run, sorted in memory without touching disk
+                    yield from sortRun(batch, key_index, nulls)
+                    return
+                rows = itertools.chain([following], rows)
+            run_paths.append(run_folder + '/run' + str(len(run_paths)) + '.pkl')
+            writeRun(sortRun(batch, key_index, nulls), run_paths[-1], block_rows)
+            del batch
+        # with a block of each run held at once, a merge of up to merge_fan_in runs holds about memory bytes; more
+        # runs are first merged into longer ones
+        merged = 0
+        while len(run_paths) > merge_fan_in:
+            merged_paths = []
+            for start in range(0, len(run_paths), merge_fan_in):
+                merged_paths.append(run_folder + '/merged' + str(merged) + '.pkl')
+                merged += 1
+                writeRun(mergeRuns(run_paths[start:start + merge_fan_in]), merged_paths[-1], block_rows)
+                for run_path in run_paths[start:start + merge_fan_in]:
+                    os.remove(run_path)
+            run_paths = merged_paths
+        yield from mergeRuns(run_paths)
+    finally:
+        shutil.rmtree(run_folder, ignore_errors=True)
+
+
+def mergeJoin(keyed_rows, sorted_keys):
+    """Yield the rows of a stream of (key, row) pairs sorted by key whose key is in an ascending iterable of
+    keys."""
+    keys = iter(sorted_keys)
+    current = next(keys, None)
+    for key, row in keyed_rows:
+        while current is not None and current < key:
+            current = next(keys, None)
+        if current is None:
+            return
+        if current == key:
+            yield row
+
+
+def sortedSemiJoin(rows, key_index, id_set, memory=None, folder=None):
+    """Yield the rows whose key_index value is in id_set, in key order, with memory bounded by the sort (the rows
+    held for a run) and the selected ids (8 bytes each, read in batches as the join advances)."""
+    keys = itertools.chain.from_iterable(id_set.ids[start:start + batch_size].tolist()
+                                         for start in range(0, len(id_set.ids), batch_size))
+    return mergeJoin(externalSort(rows, key_index, memory, folder), keys)
+
+
+def semiJoinCsv(in_csv, out_csv, key_field, id_set):
+    """Copy the rows of a CSV whose key_field is in id_set to another CSV, leaving the text untouched; returns the
+    number of rows written."""
+    count = 0
+    with io.open(in_csv, 'r', encoding='utf8', newline='') as in_file, \
+            io.open(out_csv, 'w', encoding='utf8', newline='') as out_file:
+        reader = csv.reader(in_file)
+        writer = csv.writer(out_file)
+        header = next(reader)
+        writer.writerow(header)
+        for row in semiJoin(reader, header.index(key_field), id_set):
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def benchmark(child_rows=5000000, observations=1000000, selected=100000):
+    """Time the semi-join against the external sort merge-join (16 MB runs), a Python set, an SQLite IN (SELECT) join
+    and, where arcpy is available, the AddJoin/KEEP_COMMON path used by the jurisdiction export."""
+    import sqlite3
+    random = numpy.random.default_rng(5)
+    selected_ids = random.choice(observations, selected, replace=False)
+    keys = random.integers(0, observations, child_rows)
+    rows = [(i, int(key), 'value') for i, key in enumerate(keys)]
+    results = []
+
+    start = time.perf_counter()
+    id_set = IdSet(selected_ids)
+    count = sum(1 for row in semiJoin(rows, 1, id_set))
+    results.append(('IdSet semi-join', count, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    count = sum(1 for row in sortedSemiJoin(rows, 1, IdSet(selected_ids), 16 * 1024 * 1024))
+    results.append(('External sort merge-join', count, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    python_set = set(selected_ids.tolist())
+    count = sum(1 for row in rows if row[1] in python_set)
+    results.append(('Python set', count, time.perf_counter() - start))
+
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE child (id INTEGER, observation_id INTEGER, value TEXT)')
+    connection.execute('CREATE TABLE selected (id INTEGER PRIMARY KEY)')
+    connection.executemany('INSERT INTO child VALUES (?, ?, ?)', rows)
+    connection.executemany('INSERT INTO selected VALUES (?)', ((int(i),) for i in selected_ids))
+    connection.execute('CREATE INDEX observation_id_idx ON child (observation_id)')
+    start = time.perf_counter()
+    count = len(connection.execute('SELECT child.* FROM child WHERE observation_id IN '
+                                   '(SELECT id FROM selected)').fetchall())
+    results.append(('SQLite IN (SELECT) join', count, time.perf_counter() - start))
+
+    try:
+        import arcpy
+    except ImportError:
+        arcpy = None
+    if arcpy:
+        scratch = tempfile.mkdtemp()
+        gdb = arcpy.management.CreateFileGDB(scratch, 'bench.gdb')[0]
+        arcpy.management.CreateTable(gdb, 'child')
+        arcpy.management.AddFields(gdb + '/child', [['observation_id', 'LONG'], ['value', 'TEXT']])
+        with arcpy.da.InsertCursor(gdb + '/child', ['observation_id', 'value']) as cursor:
+            for row in rows:
+                cursor.insertRow(row[1:])
+        arcpy.management.AddIndex(gdb + '/child', ['observation_id'], 'observation_id_idx')
+        arcpy.management.CreateTable(gdb, 'observations_all')
+        arcpy.management.AddField(gdb + '/observations_all', 'id', 'LONG')
+        with arcpy.da.InsertCursor(gdb + '/observations_all', ['id']) as cursor:
+            for observation_id in selected_ids:
+                cursor.insertRow((int(observation_id),))
+        arcpy.management.AddIndex(gdb + '/observations_all', ['id'], 'id_idx')
+        start = time.perf_counter()
+        arcpy.management.MakeTableView(gdb + '/child', 'child_vw')
+        arcpy.management.AddJoin('child_vw', 'observation_id', gdb + '/observations_all', 'id', 'KEEP_COMMON')
+        arcpy.management.SelectLayerByAttribute('child_vw')
+        arcpy.management.RemoveJoin('child_vw', 'observations_all')
+        arcpy.conversion.TableToTable('child_vw', gdb, 'child_subset')
+        count = int(arcpy.management.GetCount(gdb + '/child_subset')[0])
+        results.append(('arcpy AddJoin KEEP_COMMON', count, time.perf_counter() - start))
+
+    for label, count, seconds in results:
+        print(label.ljust(28) + str(count).rjust(10) + ' rows ' + str(round(seconds, 2)).rjust(8) + 's ' +
+              str(int(child_rows / seconds)).rjust(12) + ' rows/s')
+
+
+# controlling process
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -8,13 +8,24 @@
 # ArcGIS Python tool for exporting iNaturalist.ca records into GDB and CSVs for transfer to Provinces or custom
 # jurisdictions (e.g., Parks Canada Agency)
 
+# Notes:
+# - runs with arcpy on the working gdb, or without ArcGIS on the working GeoPackage (see iNatBackends)
+
 # import Python packages
-import arcpy
-import arcpy.management
-import arcpy.conversion
+import iNatBackends
+import iNatCsv
 import iNatExchangeUtils
+import iNatFrame
+import iNatJoins
+import iNatLoader
+import iNatPipeline
+import iNatSpatial
+import iNatTaxa
 import os
 import datetime
+import functools
+import itertools
+import numpy
 
 
 class iNatJurisdictionExportTool:
@@ -34,14 +45,16 @@ class iNatJurisdictionExportTool:
         iNatExchangeUtils.project_path = parameters[0].valueAsText
         iNatExchangeUtils.output_path = iNatExchangeUtils.project_path + '/' + iNatExchangeUtils.output_folder
         iNatExchangeUtils.input_label = parameters[1].valueAsText
-        work_gdb = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + '.gdb'
-        arcpy.env.workspace = work_gdb
+        # arcpy and a working gdb, or the open backend and a working GeoPackage
+        backend = iNatBackends.workingBackend(iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label)
+        work_store = iNatExchangeUtils.output_path + '/' + iNatExchangeUtils.input_label + backend.extension
         iNatExchangeUtils.date_label = parameters[2].valueAsText
-        # need either province parm or both custom parms or species parm
+        # need either province parm or both custom parms or species or clade parm
         param_province = parameters[3].valueAsText
         param_custom_label = parameters[4].valueAsText
         param_custom_polygon = parameters[5].valueAsText
         param_species = parameters[6].valueAsText
+        param_clade = parameters[12].valueAsText
         jur_param_ok = True
         if param_province:
             prov_name = iNatExchangeUtils.prov_dict[param_province]
@@ -55,10 +68,10 @@ class iNatJurisdictionExportTool:
                 # terminate with error
                 return
         if not jur_param_ok:
-            if not param_species:
+            if not param_species and not param_clade:
                 iNatExchangeUtils.displayMessage(messages, 'ERROR: you must select either a Province, or provide a ' +
                                                  'Custom Jurisdiction Label and Polygon, but not both, or provide a ' +
-                                                 'Species')
+                                                 'Species or Clade')
                 # terminate with error
                 return
         # need at least one set of records
@@ -75,338 +88,236 @@ class iNatJurisdictionExportTool:
             iNatExchangeUtils.displayMessage(messages, 'ERROR: you must include at least one set of records')
             # terminate with error
             return
-        arcpy.gp.overwriteOutput = True
-
-        # make folder and gdb for jurisdiction
+        iNatExchangeUtils.csv_compression = iNatCsv.compressionOption(parameters[11].valueAsText)
+        # with a memory limit, related tables are sorted by key on disk and merge-joined to the exported observations
+        join_memory = int(parameters[13].valueAsText) * 1024 * 1024 if parameters[13].valueAsText else None
+        # provinces are also selected by their marine buffers, which a working store imported without arcpy lacks
         if param_province:
-            jur_label = param_province
-            # Atlantic Canada consistes of four provinces
-            if param_province == 'AC':
-                param_province = "'NL', 'NS', 'NB', 'PE'"
-            elif param_province == 'CA':
-                param_province = "'NL', 'NS', 'NB', 'PE', 'QC', 'ON', 'MB', 'SK', 'AB', 'BC', 'YT', 'NT', 'NU'"
+            missing = iNatSpatial.missingMarine(work_store, [param_province])
+            if missing:
+                iNatExchangeUtils.displayMessage(messages, 'ERROR: the marine buffers of ' + ', '.join(missing) +
+                                                 ' are not available (the working store was imported without ' +
+                                                 'arcpy); reimport or export with arcpy')
+                # terminate with error
+                return
+        iNatExchangeUtils.startRun('iNatJurisdictionExport', messages)
+        try:
+
+            # make folder and gdb (or GeoPackage) for jurisdiction
+            if param_province:
+                jur_label = param_province
+                # Atlantic Canada consistes of four provinces, Canada of all provinces and territories
+                # (param_province keeps the code, for the CA test below and the pipeline parameters)
+                jurisdictions = iNatExchangeUtils.jurisdiction_groups.get(param_province, [param_province])
+            elif param_custom_label:
+                jur_label = param_custom_label
+            elif param_species:
+                jur_label = param_species
             else:
-                param_province = "'" + param_province + "'"
-        elif param_custom_label:
-            jur_label = param_custom_label
-        else:
-            jur_label = param_species
-        jur_folder = iNatExchangeUtils.output_path + '/' + jur_label
-        if not arcpy.Exists(jur_folder):
-            arcpy.management.CreateFolder(iNatExchangeUtils.output_path, jur_label)
-        jur_gdb = jur_folder + '/iNat_' + jur_label + '_' + iNatExchangeUtils.date_label + '.gdb'
-        if not arcpy.Exists(jur_gdb):
-            arcpy.management.CreateFileGDB(jur_folder, '/iNat_' + jur_label + '_' +
-                                           iNatExchangeUtils.date_label + '.gdb')
+                jur_label = '_'.join(iNatTaxa.nameList(param_clade))
+            jur_folder = iNatExchangeUtils.output_path + '/' + jur_label
+            os.makedirs(jur_folder, exist_ok=True)
+            jur_store = backend.storePath(jur_folder, 'iNat_' + jur_label + '_' + iNatExchangeUtils.date_label)
+            backend.createStore(jur_store)
 
-        # export observations
-        # for province, those named as being in province, or intersecting 32km terrestrial buffer or 200nm Canadian
-        # EEZ marine buffer
-        # for custom jurisdiction, those intersecting custom polygon
-        iNatExchangeUtils.displayMessage(messages, 'Exporting observations')
-        arcpy.management.MakeFeatureLayer('observations', 'obs_lyr')
-        if param_province:
-            if param_province != 'CA':
-                arcpy.management.SelectLayerByAttribute('obs_lyr', 'NEW_SELECTION', "place_admin1_name in '" + prov_name +
-                                                        "'")
-            arcpy.management.MakeFeatureLayer(tools_path + '/iNatExchangeTools.gdb/JurisdictionBufferWGS84',
-                                              'JurisdictionBuffer')
-            arcpy.management.SelectLayerByAttribute('JurisdictionBuffer', 'NEW_SELECTION',
-                                                    "JurisdictionAbbreviation IN (" + param_province + ")")
-            arcpy.management.SelectLayerByLocation('obs_lyr', 'INTERSECT', 'JurisdictionBuffer',
-                                                   selection_type='ADD_TO_SELECTION')
-            if param_province not in ('SK', 'AB', 'YT'):
-                arcpy.management.MakeFeatureLayer(tools_path + '/iNatExchangeTools.gdb/MarineBufferWGS84',
-                                                  'MarineBuffer')
-                arcpy.management.SelectLayerByAttribute('MarineBuffer', 'NEW_SELECTION',
-                                                        "JurisdictionAbbreviation IN (" + param_province + ")")
-                arcpy.management.SelectLayerByLocation('obs_lyr', 'INTERSECT', 'MarineBuffer',
-                                                       selection_type='ADD_TO_SELECTION')
-        elif param_custom_polygon:
-            arcpy.management.SelectLayerByLocation('obs_lyr', 'INTERSECT', param_custom_polygon)
+            # split into multiple buckets based on parameters
+            # also merge into observations_all for joining to related tables
+            bucket_names = []
+            #if param_include_ca_geo_private == 'true':
+            #    bucket_names.append('ca_geo_private')
+            if param_include_ca_geo_obscured == 'true':
+                bucket_names.append('ca_geo_obscured')
+            #if param_include_ca_taxon_private == 'true':
+            #    bucket_names.append('ca_taxon_private')
+            if param_include_ca_taxon_obscured == 'true':
+                bucket_names.append('ca_taxon_obscured')
+            if param_include_org_obscured == 'true':
+                bucket_names.append('org_obscured')
+            if param_include_unobscured == 'true':
+                bucket_names.append('unobscured')
 
-        # species param used for scientific_name like query
-        if param_species:
-            filter = ''
-            param_species = param_species.replace("'", '')
-            param_species = param_species.split(';')
-            for species in param_species:
-                if len(filter) > 0:
-                    filter += ' OR '
-                filter += "scientific_name LIKE '" + species + "%'"
-            arcpy.management.SelectLayerByAttribute('obs_lyr', 'SUBSET_SELECTION', filter)
+            # the export is a pipeline of checkpointed stages: rerunning after an interruption skips the stages
+            # completed with the same inputs and parameters
+            def csvPath(table):
+                return jur_folder + '/iNat_' + table + '_' + iNatExchangeUtils.date_label + '.csv' + \
+                    iNatCsv.compressions[iNatExchangeUtils.csv_compression]
 
-        # # optional hard-coded handling for taxonomic groups
-        # # filter = 'taxon_id IN (SELECT id FROM taxa WHERE iconic_taxon_id IN (26036, 20978, 49995, 630955))'
-        # filter = "iconic_taxon_name IN ('Insecta', 'Reptilia', 'Amphibia')"
-        # arcpy.management.SelectLayerByAttribute('obs_lyr', 'SUBSET_SELECTION', filter)
+            def outputs(*tables):
+                return [jur_store + '/' + table for table in tables] + [csvPath(table) for table in tables]
 
-        # split into multiple buckets based on parameters
-        # also merge into a temp for joining to related tables
-        merge_list = []
-        #if param_include_ca_geo_private == 'true':
-        #    merge_list.append(self.saveBucket('obs_lyr', 'ca_geo_private',
-        #                                      "geoprivacy = 'private' AND private_latitude IS NOT NULL",
-        #                                      jur_gdb, jur_folder))
-        if param_include_ca_geo_obscured == 'true':
-            merge_list.append(self.saveBucket('obs_lyr', 'ca_geo_obscured',
-                                              "geoprivacy = 'obscured' AND private_latitude IS NOT NULL",
-                                              jur_gdb, jur_folder))
-        #if param_include_ca_taxon_private == 'true':
-        #    merge_list.append(self.saveBucket('obs_lyr', 'ca_taxon_private',
-        #                                      "(geoprivacy = 'open' OR geoprivacy IS NULL) AND taxon_geoprivacy = " +
-        #                                      "'private' AND private_latitude IS NOT NULL", jur_gdb, jur_folder))
-        if param_include_ca_taxon_obscured == 'true':
-            merge_list.append(self.saveBucket('obs_lyr', 'ca_taxon_obscured', "(geoprivacy = 'open' OR geoprivacy " +
-                                              "IS NULL) AND taxon_geoprivacy IN ('obscured', 'private') AND " +
-                                              "private_latitude IS NOT NULL", jur_gdb, jur_folder))
-        if param_include_org_obscured == 'true':
-            merge_list.append(self.saveBucket('obs_lyr', 'org_obscured',
-                                              "(geoprivacy IN ('obscured') OR taxon_geoprivacy IN " +
-                                              "('obscured', 'private')) AND private_latitude IS NULL", jur_gdb,
-                                              jur_folder))
-        if param_include_unobscured == 'true':
-            merge_list.append(self.saveBucket('obs_lyr', 'unobscured',
-                                              "(geoprivacy = 'open' OR geoprivacy IS NULL) AND (taxon_geoprivacy = " +
-                                              "'open' OR taxon_geoprivacy IS NULL) AND private_latitude IS NULL",
-                                              jur_gdb, jur_folder))
-        arcpy.management.Merge(merge_list, jur_gdb + '/observations_all')
-        arcpy.management.AddIndex(jur_gdb + '/observations_all', ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/observations_all', ['taxon_id'], 'taxon_id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/observations_all', ['user_id'], 'user_id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_observations_all_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_observations_all_' + iNatExchangeUtils.date_label + '.csv')
-        arcpy.conversion.TableToTable(jur_gdb + '/observations_all', jur_folder,
-                                      'iNat_observations_all_' + iNatExchangeUtils.date_label + '.csv')
+            def exportObservations():
+                # for province, those named as being in province, or intersecting 32km terrestrial buffer or 200nm
+                # Canadian EEZ marine buffer
+                # for custom jurisdiction, those intersecting custom polygon
+                # for species or clade only, no spatial selection
+                field_names = [name for name, field_type in backend.fields(work_store, 'observations')]
+                rows = backend.selectObservations(work_store, field_names,
+                                                  jurisdictions if param_province else None,
+                                                  prov_name if param_province and param_province != 'CA' else None,
+                                                  param_custom_polygon, messages)
 
-        # annotations - assume all are resource_type='Observation'
-        iNatExchangeUtils.displayMessage(messages, 'Exporting annotations')
-        arcpy.management.MakeTableView('annotations', 'annotations_vw')
-        arcpy.management.AddJoin('annotations_vw', 'resource_id', jur_gdb + '/observations_all', 'id',
-                                 'KEEP_COMMON')
-        arcpy.management.SelectLayerByAttribute('annotations_vw')
-        arcpy.management.RemoveJoin('annotations_vw', 'observations_all')
-        arcpy.conversion.TableToTable('annotations_vw', jur_gdb, 'annotations')
-        arcpy.management.AddIndex(jur_gdb + '/annotations', ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/annotations', ['resource_id'], 'resource_id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_annotations_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_annotations_' + iNatExchangeUtils.date_label + '.csv')
-        arcpy.conversion.TableToTable('annotations_vw', jur_folder, 'iNat_annotations_' +
-                                      iNatExchangeUtils.date_label + '.csv')
+                # species param matched as scientific name prefixes, giving the taxon ids to keep
+                taxon_ids = None
+                if param_species:
+                    with iNatExchangeUtils.stage('Matching species names', messages) as stage:
+                        taxon_ids = iNatTaxa.loadNameIndex(work_store).taxonIds(iNatTaxa.nameList(param_species))
+                        stage.rows = len(taxon_ids)
+                    iNatExchangeUtils.displayMessage(messages, 'Species matched ' + str(len(taxon_ids)) + ' taxa')
 
-        # comments - assume all are parent_type='Observation'
-        iNatExchangeUtils.displayMessage(messages, 'Exporting comments')
-        arcpy.management.MakeTableView('comments', 'comments_vw')
-        arcpy.management.AddJoin('comments_vw', 'parent_id', jur_gdb + '/observations_all', 'id', 'KEEP_COMMON')
-        arcpy.management.SelectLayerByAttribute('comments_vw')
-        arcpy.management.RemoveJoin('comments_vw', 'observations_all')
-        arcpy.conversion.TableToTable('comments_vw', jur_gdb, 'comments')
-        arcpy.management.AddIndex(jur_gdb + '/comments', ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/comments', ['parent_id'], 'parent_id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_comments_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_comments_' + iNatExchangeUtils.date_label + '.csv')
-        arcpy.conversion.TableToTable('comments_vw', jur_folder, 'iNat_comments_' + iNatExchangeUtils.date_label +
-                                      '.csv')
+                # clade param (taxon names or ids) expanded to all descendant taxa by nested interval lookup, narrowing
+                # any species matches
+                if param_clade:
+                    with iNatExchangeUtils.stage('Expanding clades', messages) as stage:
+                        clade_ids = iNatTaxa.cladeIds(work_store, iNatTaxa.nameList(param_clade))
+                        stage.rows = len(clade_ids)
+                    iNatExchangeUtils.displayMessage(messages, 'Clades contain ' + str(len(clade_ids)) + ' taxa')
+                    taxon_ids = clade_ids if taxon_ids is None else taxon_ids & clade_ids
 
-        # identifications
-        iNatExchangeUtils.displayMessage(messages, 'Exporting identifications')
-        arcpy.management.MakeTableView('identifications', 'identifications_vw')
-        arcpy.management.AddJoin('identifications_vw', 'observation_id', jur_gdb + '/observations_all', 'id',
-                                 'KEEP_COMMON')
-        arcpy.management.SelectLayerByAttribute('identifications_vw')
-        arcpy.management.RemoveJoin('identifications_vw', 'observations_all')
-        arcpy.conversion.TableToTable('identifications_vw', jur_gdb, 'identifications')
-        arcpy.management.AddIndex(jur_gdb + '/identifications', ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/identifications', ['observation_id'], 'observation_id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/identifications', ['taxon_id'], 'taxon_id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/identifications', ['user_id'], 'user_id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_identifications_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_identifications_' + iNatExchangeUtils.date_label + '.csv')
-        arcpy.conversion.TableToTable('identifications_vw', jur_folder, 'iNat_identifications_' +
-                                      iNatExchangeUtils.date_label + '.csv')
+                # # optional hard-coded handling for taxonomic groups
+                # # filter = 'taxon_id IN (SELECT id FROM taxa WHERE iconic_taxon_id IN (26036, 20978, 49995, 630955))'
+                # filter = "iconic_taxon_name IN ('Insecta', 'Reptilia', 'Amphibia')"
+                # arcpy.management.SelectLayerByAttribute('obs_lyr', 'SUBSET_SELECTION', filter)
 
-        # observation_field_values
-        iNatExchangeUtils.displayMessage(messages, 'Exporting observation_field_values')
-        arcpy.management.MakeTableView('observation_field_values', 'observation_field_values_vw')
-        arcpy.management.AddJoin('observation_field_values_vw', 'observation_id', jur_gdb + '/observations_all',
-                                 'id', 'KEEP_COMMON')
-        arcpy.management.SelectLayerByAttribute('observation_field_values_vw')
-        arcpy.management.RemoveJoin('observation_field_values_vw', 'observations_all')
-        arcpy.conversion.TableToTable('observation_field_values_vw', jur_gdb, 'observation_field_values')
-        arcpy.management.AddIndex(jur_gdb + '/observation_field_values', ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/observation_field_values', ['observation_id'], 'observation_id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/observation_field_values', ['observation_field_id'],
-                                  'observation_field_id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_observation_field_values_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_observation_field_values_' +iNatExchangeUtils.date_label +
-                                    '.csv')
-        arcpy.conversion.TableToTable('observation_field_values_vw', jur_folder, 'iNat_observation_field_values_' +
-                                      iNatExchangeUtils.date_label + '.csv')
+                return self.saveBuckets(backend, rows, field_names, bucket_names, work_store, jur_store, jur_folder,
+                                        messages, taxon_ids)
 
-        # observation_fields (all records, no subsetting)
-        iNatExchangeUtils.displayMessage(messages, 'Exporting observation_fields')
-        arcpy.conversion.TableToTable('observation_fields', jur_gdb, 'observation_fields')
-        arcpy.management.AddIndex(jur_gdb + '/observation_fields', ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/observation_fields', ['user_id'], 'user_id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_observation_fields_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_observation_fields_' +iNatExchangeUtils.date_label +
-                                    '.csv')
-        arcpy.conversion.TableToTable('observation_fields', jur_folder, 'iNat_observation_fields_' +
-                                      iNatExchangeUtils.date_label + '.csv')
+            def exportByObservation(table, key_field):
+                # tables related to observations, keeping rows for the exported observations
+                return self.exportRelated(backend, work_store, table, key_field,
+                                          backend.readIds(jur_store, 'observations_all', 'id'), jur_store, jur_folder,
+                                          join_memory)
 
-        # quality_metrics
-        iNatExchangeUtils.displayMessage(messages, 'Exporting quality_metrics')
-        arcpy.management.MakeTableView('quality_metrics', 'quality_metrics_vw')
-        arcpy.management.AddJoin('quality_metrics_vw', 'observation_id', jur_gdb + '/observations_all', 'id',
-                                 'KEEP_COMMON')
-        arcpy.management.SelectLayerByAttribute('quality_metrics_vw')
-        arcpy.management.RemoveJoin('quality_metrics_vw', 'observations_all')
-        arcpy.conversion.TableToTable('quality_metrics_vw', jur_gdb, 'quality_metrics')
-        arcpy.management.AddIndex(jur_gdb + '/quality_metrics', ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/quality_metrics', ['observation_id'], 'observation_id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/quality_metrics', ['user_id'], 'user_id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_quality_metrics_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_quality_metrics_' + iNatExchangeUtils.date_label + '.csv')
-        arcpy.conversion.TableToTable('quality_metrics_vw', jur_folder, 'iNat_quality_metrics_' +
-                                      iNatExchangeUtils.date_label + '.csv')
+            def exportTaxa():
+                # taxa of observations and identifications
+                taxon_ids = backend.readIds(jur_store, 'observations_all', 'taxon_id').union(
+                    backend.readIds(jur_store, 'identifications', 'taxon_id'))
+                return self.exportRelated(backend, work_store, 'taxa', 'id', taxon_ids, jur_store, jur_folder,
+                                          join_memory)
 
-        # taxa
-        iNatExchangeUtils.displayMessage(messages, 'Exporting taxa')
-        arcpy.management.MakeTableView('taxa', 'taxa_vw')
-        arcpy.management.AddJoin('taxa_vw', 'id', jur_gdb + '/observations_all', 'taxon_id', 'KEEP_COMMON')
-        arcpy.management.SelectLayerByAttribute('taxa_vw')
-        arcpy.management.RemoveJoin('taxa_vw', 'observations_all')
-        arcpy.management.AddJoin('taxa_vw', 'id', jur_gdb + '/identifications', 'taxon_id', 'KEEP_COMMON')
-        arcpy.management.SelectLayerByAttribute('taxa_vw', 'ADD_TO_SELECTION')
-        arcpy.management.RemoveJoin('taxa_vw', 'identifications')
-        arcpy.conversion.TableToTable('taxa_vw', jur_gdb, 'taxa')
-        arcpy.management.AddIndex(jur_gdb + '/taxa', ['id'], 'id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_taxa_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_taxa_' + iNatExchangeUtils.date_label + '.csv')
-        arcpy.conversion.TableToTable('taxa_vw', jur_folder, 'iNat_taxa_' + iNatExchangeUtils.date_label + '.csv')
+            def exportConservationStatuses():
+                # conservation_statuses of exported taxa
+                return self.exportRelated(backend, work_store, 'conservation_statuses', 'taxon_id',
+                                          backend.readIds(jur_store, 'taxa', 'id'), jur_store, jur_folder, join_memory)
 
-        # conservation_statuses
-        iNatExchangeUtils.displayMessage(messages, 'Exporting conservation_statuses')
-        arcpy.management.MakeTableView('conservation_statuses', 'conservation_statuses_vw')
-        arcpy.management.AddJoin('conservation_statuses_vw', 'taxon_id', jur_gdb + '/taxa', 'id', 'KEEP_COMMON')
-        arcpy.management.SelectLayerByAttribute('conservation_statuses_vw')
-        arcpy.management.RemoveJoin('conservation_statuses_vw', 'taxa')
-        arcpy.conversion.TableToTable('conservation_statuses_vw', jur_gdb, 'conservation_statuses')
-        arcpy.management.AddIndex(jur_gdb + '/conservation_statuses', ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/conservation_statuses', ['taxon_id'], 'taxon_id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/conservation_statuses', ['user_id'], 'user_id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_conservation_statuses_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_conservation_statuses_' + iNatExchangeUtils.date_label +
-                                    '.csv')
-        arcpy.conversion.TableToTable('conservation_statuses_vw', jur_folder, 'iNat_conservation_statuses_' +
-                                      iNatExchangeUtils.date_label + '.csv')
+            def addIndexes():
+                # every output index in one stage, once all tables are written
+                tables = observation_tables + list(iNatExchangeUtils.observation_keys) + \
+                    ['observation_fields', 'taxa', 'conservation_statuses', 'users']
+                return backend.addIndexes(jur_store, iNatExchangeUtils.outputIndexes(tables), None, messages)
 
-        # users (all records, no subsetting)
-        iNatExchangeUtils.displayMessage(messages, 'Exporting users')
-        arcpy.conversion.TableToTable('users', jur_gdb, 'users')
-        arcpy.management.AddIndex(jur_gdb + '/users', ['id'], 'id_idx')
-        if arcpy.Exists(jur_folder + '/iNat_users_' + iNatExchangeUtils.date_label + '.csv'):
-            arcpy.management.Delete(jur_folder + '/iNat_users_' +iNatExchangeUtils.date_label +
-                                    '.csv')
-        arcpy.conversion.TableToTable('users', jur_folder, 'iNat_users_' +iNatExchangeUtils.date_label + '.csv')
+            def addRelationships():
+                backend.createRelationships(jur_store, bucket_names)
 
-        # add relationships to output gdb
-        iNatExchangeUtils.displayMessage(messages, 'Adding relationships to output gdb')
-        arcpy.env.workspace = jur_gdb
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/taxa', jur_gdb + '/conservation_statuses',
-                                                 'taxa_conservation_statuses', 'SIMPLE', 'conservation_statuses',
-                                                 'taxa', 'NONE', 'ONE_TO_MANY', 'NONE', 'id', 'taxon_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/users', jur_gdb + '/conservation_statuses',
-                                                 'users_conservation_statuses', 'SIMPLE', 'conservation_statuses',
-                                                 'users', 'NONE', 'ONE_TO_MANY', 'NONE', 'id', 'user_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/taxa', jur_gdb + '/identifications',
-                                                 'taxa_identifications', 'SIMPLE', 'identifications', 'taxa', 'NONE',
-                                                 'ONE_TO_MANY', 'NONE', 'id', 'taxon_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/users', jur_gdb + '/identifications',
-                                                 'users_identifications', 'SIMPLE', 'identifications', 'users', 'NONE',
-                                                 'ONE_TO_MANY', 'NONE', 'id', 'user_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/observation_fields',
-                                                 jur_gdb + '/observation_field_values',
-                                                 'observation_fields_observation_field_values', 'SIMPLE',
-                                                 'observation_field_values', 'observation_fields', 'NONE',
-                                                 'ONE_TO_MANY', 'NONE', 'id', 'observation_field_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/users', jur_gdb + '/observation_field_values',
-                                                 'users_observation_field_values', 'SIMPLE',
-                                                 'observation_field_values', 'users', 'NONE', 'ONE_TO_MANY', 'NONE',
-                                                 'id', 'user_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/users', jur_gdb + '/observation_fields',
-                                                 'users_observation_fields', 'SIMPLE', 'observation_fields', 'users',
-                                                 'NONE', 'ONE_TO_MANY', 'NONE', 'id', 'user_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/users', jur_gdb + '/quality_metrics',
-                                                 'users_quality_metrics', 'SIMPLE', 'quality_metrics', 'users', 'NONE',
-                                                 'ONE_TO_MANY', 'NONE', 'id', 'user_id')
-        self.createBucketRelationships('all', jur_gdb)
-        #if param_include_ca_geo_private == 'true':
-        #    self.createBucketRelationships('ca_geo_private', jur_gdb)
-        if param_include_ca_geo_obscured == 'true':
-            self.createBucketRelationships('ca_geo_obscured', jur_gdb)
-        #if param_include_ca_taxon_private == 'true':
-        #    self.createBucketRelationships('ca_taxon_private', jur_gdb)
-        if param_include_ca_taxon_obscured == 'true':
-            self.createBucketRelationships('ca_taxon_obscured', jur_gdb)
-        if param_include_org_obscured == 'true':
-            self.createBucketRelationships('org_obscured', jur_gdb)
-        if param_include_unobscured == 'true':
-            self.createBucketRelationships('unobscured', jur_gdb)
+            pipeline = iNatPipeline.Pipeline(jur_folder + '/iNat_' + jur_label + '_' + iNatExchangeUtils.date_label +
+                                             '_pipeline.json', backend.exists, messages)
+            parameters = {'province': param_province, 'custom_polygon': param_custom_polygon, 'species': param_species,
+                          'clade': param_clade, 'buckets': bucket_names,
+                          'csv_compression': iNatExchangeUtils.csv_compression}
+            observation_tables = ['observations_' + bucket_name for bucket_name in bucket_names] + ['observations_all']
+            pipeline.add('Exporting observations', exportObservations, parameters,
+                         [work_store, iNatFrame.framePath(work_store), tools_path + '/iNatExchangeTools.gdb',
+                          param_custom_polygon],
+                         outputs(*observation_tables))
+            for table, key_field in iNatExchangeUtils.observation_keys.items():
+                pipeline.add('Exporting ' + table, functools.partial(exportByObservation, table, key_field), parameters,
+                             [work_store], outputs(table), ['Exporting observations'])
+            # observation_fields and users (all records, no subsetting)
+            pipeline.add('Exporting observation_fields',
+                         functools.partial(self.exportRelated, backend, work_store, 'observation_fields', 'id', None,
+                                           jur_store, jur_folder), parameters, [work_store],
+                         outputs('observation_fields'))
+            pipeline.add('Exporting taxa', exportTaxa, parameters, [work_store], outputs('taxa'),
+                         ['Exporting observations', 'Exporting identifications'])
+            pipeline.add('Exporting conservation_statuses', exportConservationStatuses, parameters, [work_store],
+                         outputs('conservation_statuses'), ['Exporting taxa'])
+            pipeline.add('Exporting users',
+                         functools.partial(self.exportRelated, backend, work_store, 'users', 'id', None, jur_store,
+                                           jur_folder),
+                         parameters, [work_store], outputs('users'))
+            pipeline.add('Indexing output tables', addIndexes, parameters, [], [],
+                         [stage.name for stage in pipeline.stages])
+            # add relationships to output gdb (recorded in the relationships table of an output GeoPackage)
+            pipeline.add('Adding relationships to output gdb', addRelationships, parameters, [],
+                         [jur_store + ('/taxa_conservation_statuses' if backend.name == 'arcpy' else
+                                       '/' + iNatBackends.relationship_table)],
+                         [stage.name for stage in pipeline.stages])
+            pipeline.run()
+        finally:
+            iNatExchangeUtils.finishRun(messages)
 
         # finish time
         finish_time = datetime.datetime.now()
         iNatExchangeUtils.displayMessage(messages, 'Finish time: ' + str(finish_time))
 
-    def saveBucket(this, all_obs_lyr, bucket_name, bucket_condition, jur_gdb, jur_folder):
-        """subset the observations into a bucket and save"""
-        arcpy.management.MakeFeatureLayer(all_obs_lyr, bucket_name + '_lyr', bucket_condition)
-        # save to gdb
-        arcpy.management.CopyFeatures(bucket_name + '_lyr', jur_gdb + '/observations_' + bucket_name)
-        arcpy.management.AddIndex(jur_gdb + '/observations_' + bucket_name, ['id'], 'id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/observations_' + bucket_name, ['taxon_id'], 'taxon_id_idx')
-        arcpy.management.AddIndex(jur_gdb + '/observations_' + bucket_name, ['user_id'], 'observations_user_id_idx')
-        # save to csv
-        csv_name = 'iNat_observations_' + bucket_name + '_' + iNatExchangeUtils.date_label + '.csv'
-        if arcpy.Exists(jur_folder + '/' + csv_name):
-            arcpy.management.Delete(jur_folder + '/' + csv_name)
-        arcpy.conversion.TableToTable(bucket_name + '_lyr', jur_folder, csv_name)
-        # return feature class
-        return jur_gdb + '/observations_' + bucket_name
+    def saveBuckets(this, backend, rows, field_names, bucket_names, work_store, jur_store, jur_folder, messages,
+                    taxon_ids=None):
+        """split selected observation rows (field_names plus SHAPE@XY; only those of a set of taxon_ids, if given)
+        into buckets in a single pass, writing each bucket and observations_all (gdb or GeoPackage and csv) a batch
+        at a time as rows are read, and return the number of observations saved"""
+        tables = ['observations_' + bucket_name for bucket_name in bucket_names] + ['observations_all']
+        csv_writers = {}
+        for table in tables:
+            backend.createTable(jur_store, table, work_store, 'observations', geometry=True)
+            csv_writers[table] = iNatCsv.CsvWriter(jur_folder + '/iNat_' + table + '_' +
+                                                   iNatExchangeUtils.date_label + '.csv', field_names,
+                                                   iNatExchangeUtils.csv_compression)
+        # buckets come from the observation frame's masks when there is one, else from each row's privacy fields
+        frame = iNatFrame.loadFrame(work_store, messages)
+        id_index = field_names.index('id')
+        geoprivacy_index = field_names.index('geoprivacy')
+        taxon_geoprivacy_index = field_names.index('taxon_geoprivacy')
+        private_latitude_index = field_names.index('private_latitude')
+        taxon_index = field_names.index('taxon_id')
+        taxon_set = None if taxon_ids is None else iNatJoins.IdSet(list(taxon_ids))
+        positions = dict((bucket_name, iNatExchangeUtils.bucket_names.index(bucket_name))
+                         for bucket_name in bucket_names)
+        jur = backend.openStore(jur_store)
+        try:
+            for batch in iNatLoader.batches(rows, iNatBackends.insert_size):
+                if frame is not None:
+                    buckets = frame.lookupBuckets(iNatJoins.keyArray(batch, id_index))
+                else:
+                    buckets = numpy.array([positions.get(iNatExchangeUtils.observationBucket(
+                        row[geoprivacy_index], row[taxon_geoprivacy_index], row[private_latitude_index]), -1)
+                        for row in batch], dtype=numpy.int8)
+                keep = numpy.isin(buckets, list(positions.values()))
+                if taxon_set is not None:
+                    keep &= taxon_set.contains(iNatJoins.keyArray(batch, taxon_index))
+                for table, mask in [('observations_' + bucket_name, keep & (buckets == position))
+                                    for bucket_name, position in positions.items()] + [('observations_all', keep)]:
+                    table_rows = list(itertools.compress(batch, mask.tolist()))
+                    if table_rows:
+                        jur.insertRows(table, field_names + ['SHAPE@XY'], table_rows)
+                        csv_writers[table].writerows(row[:-1] for row in table_rows)
+        except Exception:
+            for table in tables:
+                csv_writers[table].abort()
+            raise
+        else:
+            for table in tables:
+                csv_writers[table].close()
+        finally:
+            jur.close()
+        for table in tables:
+            iNatExchangeUtils.displayMessage(messages, 'Saved ' + str(csv_writers[table].rows) + ' ' + table)
+        return csv_writers['observations_all'].rows
 
-    def createBucketRelationships(this, bucket_name, jur_gdb):
-        """create relationship classes for an observations feature class"""
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/observations_' + bucket_name, jur_gdb + '/annotations',
-                                                 'observations_' + bucket_name + '_annotations', 'SIMPLE',
-                                                 'annotations', 'observations_' + bucket_name, 'NONE', 'ONE_TO_MANY',
-                                                 'NONE', 'id', 'resource_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/observations_' + bucket_name, jur_gdb + '/comments',
-                                                 'observations_' + bucket_name + '_comments', 'SIMPLE', 'comments',
-                                                 'observations_' + bucket_name, 'NONE', 'ONE_TO_MANY', 'NONE', 'id',
-                                                 'parent_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/observations_' + bucket_name, jur_gdb +
-                                                 '/identifications', 'observations_' + bucket_name +
-                                                 '_identifications', 'SIMPLE', 'identifications', 'observations_' +
-                                                 bucket_name, 'NONE', 'ONE_TO_MANY', 'NONE', 'id', 'observation_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/observations_' + bucket_name, jur_gdb +
-                                                 '/observation_field_values', 'observations_' + bucket_name +
-                                                 '_observation_field_values', 'SIMPLE', 'observation_field_values',
-                                                 'observations_' + bucket_name, 'NONE', 'ONE_TO_MANY', 'NONE', 'id',
-                                                 'observation_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/users', jur_gdb + '/observations_' + bucket_name,
-                                                 'users_observations_' + bucket_name, 'SIMPLE', 'observations_' +
-                                                 bucket_name, 'users', 'NONE', 'ONE_TO_MANY', 'NONE', 'id', 'user_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/taxa', jur_gdb + '/observations_' + bucket_name,
-                                                 'taxa_observations_' + bucket_name, 'SIMPLE', 'observations_' +
-                                                 bucket_name, 'taxa', 'NONE', 'ONE_TO_MANY', 'NONE', 'id', 'taxon_id')
-        arcpy.management.CreateRelationshipClass(jur_gdb + '/observations_' + bucket_name, jur_gdb +
-                                                 '/quality_metrics', 'observations_' + bucket_name +
-                                                 '_quality_metrics', 'SIMPLE', 'quality_metrics', 'observations_' +
-                                                 bucket_name, 'NONE', 'ONE_TO_MANY', 'NONE', 'id', 'observation_id')
+    def exportRelated(this, backend, work_store, table, key_field, id_set, jur_store, jur_folder, join_memory=None):
+        """subset a related table to the rows whose key_field is in id_set (a semi-join read in one pass, or, with a
+        join_memory limit in bytes, an external sort and merge-join; all rows if id_set is None) and save to gdb (or
+        GeoPackage) and csv as rows are read, returning the number of rows saved"""
+        field_names = [name for name, field_type in backend.fields(work_store, table)]
+        backend.createTable(jur_store, table, work_store, table)
+        rows = backend.joinRows(work_store, table, key_field, id_set, join_memory, jur_folder)
+        count = backend.exportRows(rows, jur_store, table, field_names,
+                                   jur_folder + '/iNat_' + table + '_' + iNatExchangeUtils.date_label + '.csv',
+                                   iNatExchangeUtils.csv_compression)
+        return count
 
 
 # controlling process
 if __name__ == '__main__':
+    import arcpy
     inje = iNatJurisdictionExportTool()
     # hard code parameters for debugging
     param_project_path = arcpy.Parameter()
@@ -436,6 +347,12 @@ if __name__ == '__main__':
     param_include_org_obscured.value = 'true'
     param_include_unobscured = arcpy.Parameter()
     param_include_unobscured.value = 'true'
+    param_csv_compression = arcpy.Parameter()
+    param_csv_compression.value = None
+    param_clade = arcpy.Parameter()
+    param_clade.value = None # 'Testudines' # 47795
+    param_join_memory = arcpy.Parameter()
+    param_join_memory.value = None
     # for prov in ['QC', 'ON', 'MB', 'SK', 'AB', 'BC', 'YT', 'NT', 'NU']: #['AC']:
     #     param_province.value = prov
     #     parameters = [param_project_path, param_input_label, param_date_label, param_province, param_custom_label,
@@ -444,5 +361,6 @@ if __name__ == '__main__':
     #     inje.runiNatJurisdictionExportTool(parameters, None)
     parameters = [param_project_path, param_input_label, param_date_label, param_province, param_custom_label,
                   param_custom_polygon, param_species, param_include_ca_geo_obscured,
-                  param_include_ca_taxon_obscured, param_include_org_obscured, param_include_unobscured]
+                  param_include_ca_taxon_obscured, param_include_org_obscured, param_include_unobscured,
+                  param_csv_compression, param_clade, param_join_memory]
     inje.runiNatJurisdictionExportTool(parameters, None)
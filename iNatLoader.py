@@ -0,0 +1,230 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatLoader.py
+# Streaming loaders that copy iNaturalist.ca CSVs into a working store in a single pass
+
+# Notes:
+# - tables with a cluster key (iNatExchangeUtils.cluster_keys, e.g. identifications by observation_id) are written
+#   sorted by it through iNatJoins.externalSort, so the rows related to a record are stored together
+# - tables are loaded without indexes; buildIndexes then creates them all in one stage once loading is done
+
+# import Python packages
+import concurrent.futures
+import itertools
+import os
+import sys
+import time
+import iNatCsv
+import iNatExchangeUtils
+import iNatJoins
+import iNatStores
+
+
+# default number of rows per insert batch
+batch_size = 100000
+
+
+def tableFields(header, drop_fields=()):
+    """List (name, type) pairs for the CSV header fields that will be loaded."""
+    return [(name, iNatExchangeUtils.field_types.get(name, 'TEXT')) for name in header if name not in drop_fields]
+
+
+def batches(rows, size):
+    """Split an iterable of rows into lists of at most size rows."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def prepareObservations(header, rows):
+    """Yield observation rows (typed by the reader) with lon, lat, observed_on_text and SHAPE@XY appended, preferring
+    private coordinates where available and skipping geoprivacy = 'private'."""
+    geoprivacy = header.index('geoprivacy')
+    latitude = header.index('latitude')
+    longitude = header.index('longitude')
+    private_latitude = header.index('private_latitude')
+    private_longitude = header.index('private_longitude')
+    observed_on = header.index('observed_on')
+    for row in rows:
+        if row[geoprivacy] == 'private':
+            continue
+        row = list(row)
+        lon = row[private_longitude] if row[private_longitude] is not None else row[longitude]
+        lat = row[private_latitude] if row[private_latitude] is not None else row[latitude]
+        # newer versions of ArcGIS interpret observed_on as Date Only, so also keep the normalised text
+        observed_on_text = row[observed_on].strftime('%Y-%m-%d') if row[observed_on] else None
+        row.extend((lon, lat, observed_on_text, (lon, lat) if lon is not None and lat is not None else None))
+        yield row
+
+
+def loadObservations(csv_path, store, messages=None, size=batch_size, workers=None):
+    """Load the observations CSV into a point table in a single pass, parsing it in parallel chunks, and return the
+    number of rows loaded."""
+    reader = iNatCsv.ChunkedReader(csv_path, workers=workers)
+    fields = reader.fields() + [('lon', 'DOUBLE'), ('lat', 'DOUBLE'), ('observed_on_text', 'TEXT')]
+    store.createTable('observations', fields, geometry=True)
+    field_names = [name for name, field_type in fields] + ['SHAPE@XY']
+    count = 0
+    for batch in batches(prepareObservations(reader.header, reader.rows()), size):
+        count += store.insertRows('observations', field_names, batch)
+        iNatExchangeUtils.displayMessage(messages, 'Loaded ' + str(count) + ' observations')
+    return count
+
+
+def loadTable(csv_path, store, table, messages=None, drop_fields=(), size=batch_size, workers=1):
+    """Load a CSV into a table in a single pass, sorted by the table's cluster key if it has one, and return the
+    number of rows loaded (parsed in this process by default, as tables are already loaded concurrently)."""
+    reader = iNatCsv.ChunkedReader(csv_path, drop_fields, workers=workers)
+    fields = reader.fields()
+    store.createTable(table, fields)
+    rows = reader.rows()
+    cluster_key = iNatExchangeUtils.cluster_keys.get(table)
+    if cluster_key in reader.header:
+        # sorted in runs on disk beside the store, keeping rows without a key (first)
+        rows = (row for key, row in iNatJoins.externalSort(rows, reader.header.index(cluster_key),
+                                                           folder=os.path.dirname(store.path), nulls=True))
+    count = 0
+    for batch in batches(rows, size):
+        count += store.insertRows(table, [name for name, field_type in fields], batch)
+    iNatExchangeUtils.displayMessage(messages, 'Loaded ' + str(count) + ' ' + table)
+    return count
+
+
+def importTableWorker(csv_path, store_path, table, method, drop_fields=()):
+    """Import one CSV into its own store (run in a worker process); returns table, rows and seconds."""
+    start = time.perf_counter()
+    if method == 'streaming':
+        store = iNatStores.openStore(store_path)
+        count = loadTable(csv_path, store, table, None, drop_fields)
+        store.close()
+    else:
+        import iNatBackends
+        count = iNatBackends.ArcpyBackend().importTable(csv_path, store_path, table, drop_fields)
+    return table, count, time.perf_counter() - start
+
+
+def indexWorker(store_path, indexes):
+    """Create a list of (table, fields, index name) indexes in a store (run in a worker process); returns the
+    number of indexes and seconds."""
+    start = time.perf_counter()
+    store = iNatStores.openStore(store_path)
+    store.addIndexes(indexes)
+    store.close()
+    return len(indexes), time.perf_counter() - start
+
+
+def buildIndexes(store_path, indexes, workers=None, messages=None):
+    """Create a list of (table, field, index name) indexes once all tables are loaded: a gdb's tables are indexed
+    concurrently, one worker per table, and a GeoPackage's in one transaction sorted on several threads; returns the
+    number of indexes."""
+    stage_start = time.perf_counter()
+    by_table = {}
+    for table, field, index_name in indexes:
+        by_table.setdefault(table, []).append((table, [field], index_name))
+    if workers == 1 or len(by_table) < 2 or os.path.splitext(store_path)[1].lower() == '.gpkg':
+        store = iNatStores.openStore(store_path)
+        store.addIndexes([index for table_indexes in by_table.values() for index in table_indexes], workers)
+        store.close()
+    else:
+        with iNatExchangeUtils.processPool(min(workers or os.cpu_count(), len(by_table))) as pool:
+            futures = dict((pool.submit(indexWorker, store_path, table_indexes), table)
+                           for table, table_indexes in by_table.items())
+            for future in concurrent.futures.as_completed(futures):
+                count, seconds = future.result()
+                iNatExchangeUtils.displayMessage(messages, 'Indexed ' + futures[future] + ' (' + str(count) +
+                                                 ' indexes) in ' + str(round(seconds, 1)) + 's')
+    iNatExchangeUtils.displayMessage(messages, 'Built ' + str(len(indexes)) + ' indexes on ' + str(len(by_table)) +
+                                     ' tables in ' + str(round(time.perf_counter() - stage_start, 1)) + 's')
+    return len(indexes)
+
+
+def importTables(tables, store_path, method, workers, messages=None):
+    """Import tables concurrently, each into a staging store that is then consolidated into store_path; returns the
+    number of rows imported."""
+    stage_start = time.perf_counter()
+    total = 0
+    extension = os.path.splitext(store_path)[1]
+    jobs = []
+    for table in tables:
+        drop_fields = ('email', 'name') if table == 'users' else ()
+        staging_path = os.path.dirname(store_path) + '/staging_' + table + extension
+        jobs.append((iNatExchangeUtils.csvPath(table), staging_path, table, method, drop_fields))
+    if workers == 1:
+        # no pool, import straight into the working store
+        for csv_path, staging_path, table, method, drop_fields in jobs:
+            table, count, seconds = importTableWorker(csv_path, store_path, table, method, drop_fields)
+            iNatExchangeUtils.displayMessage(messages, 'Imported ' + table + ' (' + str(count) + ' rows) in ' +
+                                             str(round(seconds, 1)) + 's')
+            total += count
+        return total
+    store = iNatStores.openStore(store_path)
+    with iNatExchangeUtils.processPool(workers) as pool:
+        futures = dict((pool.submit(importTableWorker, *job), job[1]) for job in jobs)
+        for future in concurrent.futures.as_completed(futures):
+            table, count, seconds = future.result()
+            total += count
+            iNatExchangeUtils.displayMessage(messages, 'Imported ' + table + ' (' + str(count) + ' rows) in ' +
+                                             str(round(seconds, 1)) + 's')
+            # consolidate as each table finishes, while the others are still loading
+            store.consolidate(futures[future], table)
+    store.close()
+    iNatExchangeUtils.displayMessage(messages, 'Imported ' + str(len(tables)) + ' tables in ' +
+                                     str(round(time.perf_counter() - stage_start, 1)) + 's')
+    return total
+
+
+def importExtract(store_path, workers=None, messages=None):
+    """Import every CSV of the current extract into a working gdb or GeoPackage in a single pass each, then index
+    and compute jurisdiction membership and the observation frame."""
+    import iNatFrame
+    import iNatSpatial
+    import iNatTaxa
+    store = iNatStores.openStore(store_path)
+
+    # observations are read once, plotted with private coordinates where available and written in batches
+    with iNatExchangeUtils.stage('Streaming observations into ' + store_path, messages) as stage:
+        stage.rows = loadObservations(iNatExchangeUtils.csvPath('observations'), store, messages,
+                                      workers=workers)
+
+    # import other tables concurrently, each into its own staging store
+    with iNatExchangeUtils.stage('Streaming ' + ', '.join(iNatExchangeUtils.related_tables), messages) as stage:
+        stage.rows = importTables(iNatExchangeUtils.related_tables, store_path, 'streaming', workers, messages)
+
+    store.close()
+
+    # all indexes in one stage, once every table is loaded
+    with iNatExchangeUtils.stage('Indexing query and join fields', messages) as stage:
+        stage.rows = buildIndexes(store_path, iNatExchangeUtils.import_indexes, workers, messages)
+
+    # taxon name prefix and clade indexes for species and clade exports
+    with iNatExchangeUtils.stage('Indexing taxa', messages) as stage:
+        stage.rows = iNatTaxa.indexTaxa(store_path, messages)
+
+    # precompute jurisdiction buffer membership so exports don't repeat the spatial selections
+    with iNatExchangeUtils.stage('Computing observation jurisdiction membership', messages):
+        iNatSpatial.buildMembership(store_path, messages)
+
+    # compact observation columns for vectorized bucket, province and privacy decisions (last, as it records the
+    # store's fingerprint)
+    with iNatExchangeUtils.stage('Building observation frame', messages) as stage:
+        stage.rows = iNatFrame.buildFrame(store_path, messages)
+
+
+# controlling process
+if __name__ == '__main__':
+    # usage: python iNatLoader.py <observations.csv> <store.gpkg>
+    start = time.perf_counter()
+    gpkg = iNatStores.openStore(sys.argv[2])
+    loaded = loadObservations(sys.argv[1], gpkg)
+    gpkg.addIndex('observations', ['id'], 'id_idx')
+    gpkg.close()
+    elapsed = time.perf_counter() - start
+    print('Loaded ' + str(loaded) + ' observations in ' + str(round(elapsed, 1)) + 's (' +
+          str(int(loaded / elapsed)) + ' rows/s)')
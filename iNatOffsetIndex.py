@@ -0,0 +1,207 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatOffsetIndex.py
+# Byte offset index of the raw extract CSVs, keyed by observation (and taxon and user) id, so one observation and
+# all its related rows can be read straight from the CSVs in milliseconds, for QA or questions about a record,
+# without importing the extract or scanning the files
+
+# Notes:
+# - needs NumPy, but not arcpy
+# - each table's index is a pair of .npy arrays (keys and the byte offsets of their rows, sorted by key then
+#   offset) in <label>_offsets beside the CSVs, memory mapped when opened, so a lookup is a binary search plus one
+#   read per row; index.json records each CSV's header and fingerprint, and tables whose CSV has changed since the
+#   index was built are rebuilt by buildIndex and refused by lookups
+# - records are found as iNatCsv.ChunkedReader finds chunk boundaries: a newline ends a record only after an even
+#   number of quotes, so quoted newlines stay inside their record; chunks are indexed in parallel
+# - python iNatOffsetIndex.py <input folder> <input label> [observation id] builds (or updates) the index, then
+#   prints the observation and its related rows and the lookup time
+
+# import Python packages
+import csv
+import io
+import json
+import os
+import sys
+import time
+import numpy
+import iNatCsv
+import iNatExchangeUtils
+import iNatPipeline
+
+
+# key field of each indexed table: tables related to observations by their observation key, and those referenced by
+# observations by id
+index_keys = dict(iNatExchangeUtils.observation_keys, observations='id', taxa='id', users='id')
+# observation fields followed to the taxa and users tables
+reference_fields = {'taxa': 'taxon_id', 'users': 'user_id'}
+
+
+def indexPath(input_folder, input_label):
+    """Folder of the offset index of an extract."""
+    return input_folder + '/' + input_label + '/' + input_label + '_offsets'
+
+
+def extractCsv(input_folder, input_label, table):
+    return input_folder + '/' + input_label + '/' + input_label + '-' + table + '.csv'
+
+
+def recordEnds(view, start, end):
+    """Offsets just past the newlines that end records in a byte range starting on a record boundary."""
+    chunk = numpy.frombuffer(view, dtype=numpy.uint8, count=end - start, offset=start)
+    quotes = numpy.flatnonzero(chunk == ord('"'))
+    newlines = numpy.flatnonzero(chunk == ord('\n'))
+    # a newline ends a record when an even number of quotes precede it within the range
+    even = numpy.searchsorted(quotes, newlines) % 2 == 0
+    return newlines[even] + start + 1
+
+
+def offsetChunk(csv_path, start, end, key_index):
+    """Return the int64 keys and byte offsets of the rows in a byte range of a CSV, leaving out rows without a key
+    (run in a worker process)."""
+    count, columns = iNatCsv.parseChunk(csv_path, start, end, [key_index], None)
+    view = iNatCsv.mapFile(csv_path)
+    try:
+        ends = recordEnds(view, start, end)
+    finally:
+        view.close()
+    starts = numpy.concatenate(([start], ends[ends < end])).astype(numpy.int64)
+    if len(starts) != count:
+        raise ValueError('found ' + str(len(starts)) + ' record starts but parsed ' + str(count) + ' rows in bytes ' +
+                         str(start) + '-' + str(end) + ' of ' + csv_path)
+    keys = numpy.array([int(key) if key else -1 for key in columns[0]], dtype=numpy.int64)
+    keep = keys >= 0
+    return keys[keep], starts[keep]
+
+
+def indexTable(csv_path, key_field, pool=None):
+    """Return the header of a CSV and its keys and row offsets, sorted by key then offset."""
+    reader = iNatCsv.ChunkedReader(csv_path, typed=False)
+    key_index = reader.header.index(key_field)
+    ranges = reader.chunkRanges(pool)
+    if pool is None:
+        parts = [offsetChunk(csv_path, start, end, key_index) for start, end in ranges]
+    else:
+        parts = list(pool.map(offsetChunk, *zip(*[(csv_path, start, end, key_index) for start, end in ranges]))) \
+            if ranges else []
+    keys = numpy.concatenate([part[0] for part in parts]) if parts else numpy.zeros(0, dtype=numpy.int64)
+    offsets = numpy.concatenate([part[1] for part in parts]) if parts else numpy.zeros(0, dtype=numpy.int64)
+    order = numpy.lexsort((offsets, keys))
+    return reader.header, keys[order], offsets[order]
+
+
+def buildIndex(input_folder, input_label, workers=None, messages=None):
+    """Index every table of an extract whose CSV is new or has changed since it was last indexed, and return the
+    number of rows indexed."""
+    folder = indexPath(input_folder, input_label)
+    os.makedirs(folder, exist_ok=True)
+    tables = {}
+    if os.path.exists(folder + '/index.json'):
+        with io.open(folder + '/index.json', 'r', encoding='utf8') as index_file:
+            tables = json.load(index_file)['tables']
+    indexed = 0
+    with iNatExchangeUtils.processPool(workers) as pool:
+        for table, key_field in index_keys.items():
+            csv_path = extractCsv(input_folder, input_label, table)
+            if not os.path.exists(csv_path):
+                continue
+            fingerprint = iNatPipeline.pathFingerprint(csv_path)
+            if table in tables and tables[table]['fingerprint'] == fingerprint:
+                continue
+            with iNatExchangeUtils.stage('Indexing ' + table + ' by ' + key_field, messages) as stage:
+                header, keys, offsets = indexTable(csv_path, key_field, pool if workers != 1 else None)
+                numpy.save(folder + '/' + table + '_keys.npy', keys)
+                numpy.save(folder + '/' + table + '_offsets.npy', offsets)
+                tables[table] = {'key_field': key_field, 'header': header, 'fingerprint': fingerprint}
+                stage.rows = len(keys)
+            indexed += len(keys)
+            # saved after each table, so an interrupted build keeps the tables already indexed
+            with io.open(folder + '/index.json.tmp', 'w', encoding='utf8') as index_file:
+                json.dump({'input_label': input_label, 'tables': tables}, index_file, indent=2)
+            os.replace(folder + '/index.json.tmp', folder + '/index.json')
+    return indexed
+
+
+class OffsetIndex:
+    """Memory-mapped key and offset arrays of an extract's CSVs, reading the rows of any key directly from the
+    files"""
+    def __init__(self, input_folder, input_label):
+        folder = indexPath(input_folder, input_label)
+        with io.open(folder + '/index.json', 'r', encoding='utf8') as index_file:
+            self.tables = json.load(index_file)['tables']
+        self.keys = {}
+        self.offsets = {}
+        self.views = {}
+        for table in self.tables:
+            csv_path = extractCsv(input_folder, input_label, table)
+            if iNatPipeline.pathFingerprint(csv_path) != self.tables[table]['fingerprint']:
+                raise ValueError(csv_path + ' has changed since it was indexed (run buildIndex again)')
+            self.keys[table] = numpy.load(folder + '/' + table + '_keys.npy', mmap_mode='r')
+            self.offsets[table] = numpy.load(folder + '/' + table + '_offsets.npy', mmap_mode='r')
+            self.views[table] = iNatCsv.mapFile(csv_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def rowOffsets(self, table, key):
+        """Byte offsets of the rows of a table with key, in file order."""
+        keys = self.keys[table]
+        return self.offsets[table][numpy.searchsorted(keys, key, 'left'):numpy.searchsorted(keys, key, 'right')]
+
+    def readRow(self, table, offset):
+        """Read the row starting at a byte offset as a dict of field name to CSV text."""
+        view = self.views[table]
+        view.seek(int(offset))
+        # csv.reader asks for more lines while a quoted field is open
+        reader = csv.reader(iter(lambda: view.readline().decode('utf8'), ''))
+        return dict(zip(self.tables[table]['header'], next(reader)))
+
+    def rows(self, table, key):
+        """Rows (dicts) of a table with key."""
+        if table not in self.tables:
+            return []
+        return [self.readRow(table, offset) for offset in self.rowOffsets(table, key).tolist()]
+
+    def lookup(self, observation_id):
+        """Return the observation with an id and its related rows as a dict of table to list of row dicts (an empty
+        dict if the observation is not in the extract)."""
+        observations = self.rows('observations', observation_id)
+        if not observations:
+            return {}
+        found = {'observations': observations}
+        for table in iNatExchangeUtils.observation_keys:
+            found[table] = self.rows(table, observation_id)
+        for table, field in reference_fields.items():
+            value = observations[0].get(field)
+            found[table] = self.rows(table, int(value)) if value else []
+        return found
+
+    def close(self):
+        for view in self.views.values():
+            if view is not None:
+                view.close()
+        self.views = {}
+
+
+# controlling process
+if __name__ == '__main__':
+    # usage: python iNatOffsetIndex.py <input folder> <input label> [observation id]
+    start = time.perf_counter()
+    built = buildIndex(sys.argv[1], sys.argv[2])
+    print('Indexed ' + str(built) + ' rows in ' + str(round(time.perf_counter() - start, 1)) + 's')
+    if len(sys.argv) > 3:
+        with OffsetIndex(sys.argv[1], sys.argv[2]) as offset_index:
+            start = time.perf_counter()
+            observation = offset_index.lookup(int(sys.argv[3]))
+            elapsed = time.perf_counter() - start
+            for found_table, found_rows in observation.items():
+                for found_row in found_rows:
+                    print(found_table + ': ' + json.dumps(found_row))
+            print('Looked up ' + str(sum(len(found_rows) for found_rows in observation.values())) + ' rows in ' +
+                  str(round(elapsed * 1000, 2)) + 'ms')
@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatPipeline.py
+# Checkpointed pipeline of named stages, so that rerunning an interrupted export skips the stages already completed
+# with the same inputs and parameters and rebuilds only the stale ones
+
+# Notes:
+# - each stage's fingerprint hashes its parameters, the fingerprints of its input paths (file sizes and modification
+#   times, through every file of a folder such as a gdb) and the completion tokens of the stages it depends on
+# - a stage is skipped when its fingerprint matches the one saved when it last completed and all its outputs exist;
+#   otherwise it runs (and should replace its outputs), and gets a new completion token, which makes every stage
+#   that depends on it stale in turn
+# - the state is saved as JSON after every completed stage, replacing the file atomically
+
+# import Python packages
+import hashlib
+import io
+import json
+import os
+import uuid
+import iNatExchangeUtils
+
+
+def pathFingerprint(path):
+    """Hash of the sizes and modification times of a file, or of every file under a folder (the text of the path
+    alone if it does not exist, such as a layer name); a feature class in a gdb is fingerprinted by its gdb."""
+    digest = hashlib.blake2b(str(path).encode('utf8'), digest_size=16)
+    while path and not os.path.exists(path) and os.path.dirname(path) not in ('', path):
+        path = os.path.dirname(path)
+    if path and os.path.isdir(path):
+        for folder, folder_names, file_names in os.walk(path):
+            folder_names.sort()
+            for file_name in sorted(file_names):
+                # locks come and go while a gdb is open
+                if file_name.endswith('.lock'):
+                    continue
+                stat = os.stat(os.path.join(folder, file_name))
+                digest.update((os.path.relpath(os.path.join(folder, file_name), path) + '|' + str(stat.st_size) +
+                               '|' + str(stat.st_mtime_ns)).encode('utf8'))
+    elif path and os.path.isfile(path):
+        stat = os.stat(path)
+        digest.update((str(stat.st_size) + '|' + str(stat.st_mtime_ns)).encode('utf8'))
+    return digest.hexdigest()
+
+
+class PipelineStage:
+    """A named step with its function, parameters, input paths, outputs and the stages it depends on"""
+    def __init__(self, name, function, parameters=None, inputs=(), outputs=(), depends=()):
+        self.name = name
+        self.function = function
+        self.parameters = parameters
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.depends = list(depends)
+
+
+class Pipeline:
+    """Stages run in the order added, skipping those whose saved fingerprint is current"""
+    def __init__(self, state_path, exists=os.path.exists, messages=None):
+        self.state_path = state_path
+        self.exists = exists
+        self.messages = messages
+        self.stages = []
+        self.state = {}
+        if os.path.exists(state_path):
+            with io.open(state_path, 'r', encoding='utf8') as state_file:
+                self.state = json.load(state_file)
+        # input paths are fingerprinted once per run, as several stages share them
+        self.path_fingerprints = {}
+
+    def add(self, name, function, parameters=None, inputs=(), outputs=(), depends=()):
+        """Add a stage; function takes no arguments and may return a row count for the run report."""
+        names = [stage.name for stage in self.stages]
+        for depend in depends:
+            if depend not in names:
+                raise ValueError('Stage ' + name + ' depends on ' + depend + ', which has not been added')
+        self.stages.append(PipelineStage(name, function, parameters, inputs, outputs, depends))
+
+    def fingerprint(self, stage):
+        """Hash of a stage's parameters, input paths and the completion tokens of the stages it depends on."""
+        for path in stage.inputs:
+            if path not in self.path_fingerprints:
+                self.path_fingerprints[path] = pathFingerprint(path)
+        parts = {'parameters': stage.parameters,
+                 'inputs': [self.path_fingerprints[path] for path in stage.inputs],
+                 'depends': [self.state.get(depend, {}).get('token') for depend in stage.depends]}
+        return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode('utf8'),
+                               digest_size=16).hexdigest()
+
+    def current(self, stage, fingerprint):
+        """Whether a stage completed with this fingerprint and its outputs are still there."""
+        saved = self.state.get(stage.name)
+        return saved is not None and saved['fingerprint'] == fingerprint and \
+            all(self.exists(output) for output in stage.outputs)
+
+    def save(self):
+        temp_path = self.state_path + '.tmp'
+        with io.open(temp_path, 'w', encoding='utf8') as state_file:
+            json.dump(self.state, state_file, indent=2)
+        os.replace(temp_path, self.state_path)
+
+    def run(self):
+        """Run every stale stage in order and return the names of the stages run."""
+        ran = []
+        for stage in self.stages:
+            fingerprint = self.fingerprint(stage)
+            if self.current(stage, fingerprint):
+                iNatExchangeUtils.displayMessage(self.messages, 'Skipping ' + stage.name + ' (up to date)')
+                continue
+            # forget the stage until it completes, so an interrupted stage reruns
+            self.state.pop(stage.name, None)
+            self.save()
+            with iNatExchangeUtils.stage(stage.name, self.messages) as run_stage:
+                run_stage.rows = stage.function() or 0
+            self.state[stage.name] = {'fingerprint': fingerprint, 'token': uuid.uuid4().hex}
+            self.save()
+            ran.append(stage.name)
+        return ran
@@ -1,31 +1,148 @@
-import io
-import csv
-
-#encoding = 'mbcs' # mbcs encoding is Windows ANSI, which is the default for param_data_file_encoding
-encoding = 'utf8'
-infile = io.open("D:\\GIS\\iNatExchange\\Input\\inaturalist-canada-5\\inaturalist-canada-5-observations.csv", 'r', encoding=encoding)
-outfile = io.open("D:\\GIS\\iNatExchange\\Input\\inaturalist-canada-5\\inaturalist-canada-5-observations-nopriv-first10.csv", 'w', encoding=encoding, newline='')
-#outfile = io.open("D:\\GIS\\iNatExchange\\Input\\inaturalist-canada-5\\inaturalist-canada-5-observations-nopriv.csv", 'w', encoding=encoding, newline='')
-reader = csv.DictReader(infile)
-writer = csv.DictWriter(outfile, reader.fieldnames)
-writer.writeheader()
-
-count = 0
-skipped = 0
-for file_line in reader:
-    count += 1
-    if count % 10000 == 0:
-        print('Processing ' + str(count))
-    if file_line['geoprivacy'] == 'private':
-        skipped += 1
-        if skipped % 100 == 0:
-            print('Skipped ' + str(skipped))
-    else:
-        writer.writerow(file_line)
-    if count == 10:
-        break
-
-print('Processed ' + str(count))
-print('Skipped ' + str(skipped))
-outfile.close()
-infile.close()
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatSemiAnnualCleaning.py
+# Pre-processing of a semi-annual iNaturalist.ca extract into a cleaned extract (by default without geoprivacy =
+# 'private' observations or user emails and names) that the iNat Import Tool reads like any other
+
+# Notes:
+# - each table's cleaning is a pipeline of row filter and column projection steps applied to row tuples as they are
+#   read, so memory use does not grow with the file; tables are cleaned concurrently, one per worker process
+# - steps are (name, arguments...) tuples looked up in steps, so they can be sent to the workers and listed in
+#   cleaning_rules
+# - the ids of the observations dropped are collected as they are skipped, and the related tables (those keyed by
+#   observation, per observation_keys) then drop their rows for those ids, so observations are cleaned first
+#   (alongside the tables that do not depend on them) and the related tables once it is done
+# - python iNatSemiAnnualCleaning.py <input folder> <input label> <output label> [workers] [row limit]
+
+# import Python packages
+import concurrent.futures
+import itertools
+import os
+import sys
+import time
+import iNatCsv
+import iNatExchangeUtils
+
+
+def dropRows(header, rows, field, value, key_field=None, dropped=None):
+    """Skip the rows whose field has value, adding their key_field values to the dropped set (if given)."""
+    index = header.index(field)
+    if key_field is None or dropped is None:
+        return header, (row for row in rows if row[index] != value)
+    key_index = header.index(key_field)
+
+    def kept():
+        for row in rows:
+            if row[index] == value:
+                dropped.add(row[key_index])
+            else:
+                yield row
+    return header, kept()
+
+
+def dropKeys(header, rows, field, keys):
+    """Skip the rows whose field is one of a set of keys (such as the ids of the observations dropped)."""
+    index = header.index(field)
+    return header, (row for row in rows if row[index] not in keys)
+
+
+def projectColumns(header, rows, fields):
+    """Keep only fields, in that order."""
+    indexes = [header.index(field) for field in fields]
+    return list(fields), (tuple(row[i] for i in indexes) for row in rows)
+
+
+def dropColumns(header, rows, fields):
+    """Remove fields (those that are present)."""
+    return projectColumns(header, rows, [field for field in header if field not in fields])
+
+
+def keepColumns(header, rows, fields):
+    """Restrict to the fields in use (those that are present)."""
+    return projectColumns(header, rows, [field for field in fields if field in header])
+
+
+def limitRows(header, rows, count):
+    """Stop after count rows (for trial runs)."""
+    return header, itertools.islice(rows, count)
+
+
+# pipeline steps by name
+steps = {'drop_rows': dropRows, 'drop_keys': dropKeys, 'drop_columns': dropColumns, 'keep_columns': keepColumns,
+         'limit': limitRows}
+# steps that record the keys of the rows they drop
+recording_steps = ['drop_rows']
+# steps applied to each table (the ids of the observations dropped are also dropped from the related tables)
+cleaning_rules = {'observations': [('drop_rows', 'geoprivacy', 'private', 'id')],
+                  'users': [('drop_columns', ['email', 'name'])]}
+
+
+def pipeline(header, rows, rules, dropped=None):
+    """Chain the steps of a list of (name, arguments...) rules over a header and row iterator, adding the keys of the
+    rows that recording steps drop to the dropped set (if given)."""
+    for name, *arguments in rules:
+        if name in recording_steps:
+            header, rows = steps[name](header, rows, *arguments, dropped=dropped)
+        else:
+            header, rows = steps[name](header, rows, *arguments)
+    return header, rows
+
+
+def cleanTable(in_path, out_path, rules):
+    """Stream one CSV through a pipeline into a new CSV (run in a worker process); returns rows read, rows written,
+    seconds and the set of keys of the rows dropped by recording steps."""
+    start = time.perf_counter()
+    dropped = set()
+    reader = iNatCsv.ChunkedReader(in_path, typed=False, workers=1)
+    header, rows = pipeline(reader.header, reader.rows(), rules, dropped)
+    with iNatCsv.CsvWriter(out_path, header) as writer:
+        writer.writerows(rows)
+    return reader.rows_read, writer.rows, time.perf_counter() - start, dropped
+
+
+def cleanExtract(input_folder, input_label, output_label, workers=None, limit=None, messages=None):
+    """Clean every table of an extract into a new extract with output_label and return the rows written."""
+    def job(table, extra_rules=()):
+        rules = cleaning_rules.get(table, []) + list(extra_rules) + ([('limit', limit)] if limit else [])
+        return (input_folder + '/' + input_label + '/' + input_label + '-' + table + '.csv',
+                input_folder + '/' + output_label + '/' + output_label + '-' + table + '.csv', rules)
+
+    os.makedirs(input_folder + '/' + output_label, exist_ok=True)
+    written = 0
+    with iNatExchangeUtils.stage('Cleaning ' + input_label + ' into ' + output_label, messages) as stage, \
+            iNatExchangeUtils.processPool(workers) as pool:
+        # observations first, with the tables that do not depend on it; the related tables once its dropped ids are
+        # known
+        futures = dict((pool.submit(cleanTable, *job(table)), table) for table in
+                       ['observations'] + [table for table in iNatExchangeUtils.related_tables
+                                           if table not in iNatExchangeUtils.observation_keys])
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                table = futures.pop(future)
+                read, table_written, seconds, dropped = future.result()
+                stage.rows += read
+                written += table_written
+                iNatExchangeUtils.displayMessage(messages, 'Cleaned ' + table + ': ' + str(read) + ' rows read, ' +
+                                                 str(table_written) + ' written in ' + str(round(seconds, 1)) +
+                                                 's (' + str(int(read / max(seconds, 1e-6))) + ' rows/s)')
+                if table == 'observations':
+                    dropped = frozenset(dropped)
+                    for related, key in iNatExchangeUtils.observation_keys.items():
+                        futures[pool.submit(cleanTable, *job(related, [('drop_keys', key, dropped)]))] = related
+    return written
+
+
+# controlling process
+if __name__ == '__main__':
+    # usage: python iNatSemiAnnualCleaning.py <input folder> <input label> <output label> [workers] [row limit]
+    iNatExchangeUtils.startRun('iNatSemiAnnualCleaning')
+    try:
+        cleanExtract(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else None,
+                     int(sys.argv[5]) if len(sys.argv) > 5 else None)
+    finally:
+        iNatExchangeUtils.finishRun(folder=sys.argv[1])
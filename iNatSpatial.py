@@ -0,0 +1,640 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatSpatial.py
+# Observation to jurisdiction membership, computed once per import so that exports can use attribute lookups
+# instead of repeated point-in-polygon selections
+
+# Notes:
+# - each polygon has a grid mask classifying every cell as inside, outside or boundary (crossed by an edge); points
+#   in inside or outside cells are decided by looking up their cell, and only points in boundary cells get an exact
+#   test, so results are identical to testing every point exactly; INAT_GRID_CELL_SIZE sets the cell size in degrees
+#   (smaller cells leave fewer points in boundary cells, but take longer to build and more memory)
+# - membership is computed with the masks plus an arcpy spatial join of the points in boundary cells for a working
+#   gdb, or with the masks plus a NumPy point in polygon engine (no arcpy needed) for a GeoPackage
+# - the engine reads CanadianJurisdictionsBuffered.shp directly; the marine buffers are only in
+#   iNatExchangeTools.gdb, so they are read with arcpy when it is available
+# - without arcpy, membership covers the terrestrial buffers only; whether a membership table includes the marine
+#   buffers is recorded beside it, and missingMarine lets the exports refuse jurisdictions whose marine buffers a
+#   selection would leave out rather than export them short
+# - the prepared polygons (edges, grids, bounding boxes and interior/exterior cell masks) are cached in
+#   geometry_caches, keyed by the size and modification time of the source files, so later runs load them instead of
+#   reading and preparing the buffers again; any change to the sources rebuilds the cache
+# - python iNatSpatial.py [points] [checked points] benchmarks the engine on a synthetic Canada-wide point cloud
+
+# import Python packages
+import importlib.util
+import itertools
+import os
+import pickle
+import struct
+import sys
+import time
+import numpy
+import iNatExchangeUtils
+import iNatPipeline
+
+
+tools_path = os.path.dirname(os.path.abspath(__file__))
+jurisdiction_buffer = tools_path + '/iNatExchangeTools.gdb/JurisdictionBufferWGS84'
+marine_buffer = tools_path + '/iNatExchangeTools.gdb/MarineBufferWGS84'
+membership_table = 'observation_jurisdictions'
+membership_fields = [('observation_id', 'LONG'), ('jurisdiction', 'TEXT'), ('marine', 'LONG')]
+# one row recording whether the membership table includes the marine buffers
+membership_info_table = membership_table + '_info'
+# jurisdictions without a marine buffer
+inland_jurisdictions = ['SK', 'AB', 'YT']
+# same terrestrial buffers as a shapefile, readable without arcpy
+jurisdiction_shapefile = tools_path + '/CanadianJurisdictionsBuffered.shp'
+shapefile_abbreviation = 'Jurisdic_1'
+# gdb terrestrial buffers in Canada (leaving out US and MX), which the shapefile holds as the CA group
+canada_where = 'JurisdictionID NOT IN (14, 15)'
+# width/height in degrees of the grid cells used to skip edge tests for points well inside or outside a polygon
+grid_cell_size = float(os.environ.get('INAT_GRID_CELL_SIZE', 0.1))
+# grid mask cell states
+cell_outside = 0
+cell_inside = 1
+cell_boundary = 2
+# prepared polygons saved by loadJurisdictions for each source of terrestrial buffers, and the version of their
+# format
+geometry_caches = {jurisdiction_shapefile: tools_path + '/iNatExchangeTools_geometry.cache',
+                   jurisdiction_buffer: tools_path + '/iNatExchangeTools_geometry_gdb.cache'}
+geometry_cache_version = 2
+# points classified per batch
+classify_batch_size = 1000000
+# rows filtered per batch by insideRows (whole observation rows, so fewer than classify_batch_size)
+filter_batch_size = 100000
+# cities around which synthetic observations cluster (lon, lat, jurisdiction)
+synthetic_centres = [(-123.1, 49.3, 'BC'), (-114.1, 51.0, 'AB'), (-113.5, 53.5, 'AB'), (-106.7, 52.1, 'SK'),
+                     (-97.1, 49.9, 'MB'), (-79.4, 43.7, 'ON'), (-75.7, 45.4, 'ON'), (-73.6, 45.5, 'QC'),
+                     (-71.2, 46.8, 'QC'), (-66.6, 45.9, 'NB'), (-63.6, 44.6, 'NS'), (-63.1, 46.2, 'PE'),
+                     (-52.7, 47.6, 'NL'), (-135.1, 60.7, 'YT'), (-114.4, 62.5, 'NT'), (-68.5, 63.7, 'NU')]
+# polygons loaded by loadJurisdictions (once per process and source)
+jurisdiction_indexes = {}
+
+
+def membershipWhere(jurisdictions):
+    """SQL where clause selecting observations in any of a list of jurisdiction abbreviations."""
+    return 'id IN (SELECT observation_id FROM ' + membership_table + ' WHERE jurisdiction IN (' + \
+        ', '.join("'" + jurisdiction + "'" for jurisdiction in jurisdictions) + '))'
+
+
+def marineAvailable():
+    """Whether the marine buffers can be read (they need arcpy)."""
+    return importlib.util.find_spec('arcpy') is not None
+
+
+def saveMembershipInfo(store, marine):
+    store.createTable(membership_info_table, [('marine', 'LONG')])
+    store.insertRows(membership_info_table, ['marine'], [(1 if marine else 0,)])
+
+
+def membershipMarine(store):
+    """Whether the membership table of a store includes the marine buffers, as recorded when it was built (tables
+    built before this was recorded include them if the store is a gdb, always joined with arcpy)."""
+    if store.exists(membership_info_table):
+        return bool(next(iter(store.readRows(membership_info_table, ['marine'])))[0])
+    return os.path.splitext(store.path)[1] == '.gdb'
+
+
+def missingMarine(store_path, jurisdictions):
+    """Jurisdictions of a list (groups expanded) whose marine buffers a selection from a working store would leave
+    out: its membership table was built without them, or it has none and they cannot be read."""
+    import iNatStores
+    coastal = [jurisdiction for group in jurisdictions
+               for jurisdiction in iNatExchangeUtils.jurisdiction_groups.get(group, [group])
+               if jurisdiction not in inland_jurisdictions]
+    if not coastal:
+        return []
+    store = iNatStores.openStore(store_path)
+    try:
+        marine = membershipMarine(store) if store.exists(membership_table) else marineAvailable()
+    finally:
+        store.close()
+    return [] if marine else sorted(set(coastal))
+
+
+def readShapefile(shp_path, name_field=None):
+    """Return (name, rings) for each polygon in a shapefile, where rings is a list of (n, 2) coordinate arrays (names
+    are '' without a name_field)."""
+    names = None
+    if name_field:
+        with open(os.path.splitext(shp_path)[0] + '.dbf', 'rb') as dbf_file:
+            dbf = dbf_file.read()
+        record_count, header_length, record_length = struct.unpack('<IHH', dbf[4:12])
+        fields = []
+        position = 32
+        while dbf[position] != 0x0D:
+            fields.append((dbf[position:position + 11].split(b'\0')[0].decode(), dbf[position + 16]))
+            position += 32
+        offset = 1 + sum(length for name, length in fields[:[name for name, length in fields].index(name_field)])
+        length = dict(fields)[name_field]
+        names = [dbf[header_length + i * record_length + offset:header_length + i * record_length + offset +
+                     length].decode('utf8').strip() for i in range(record_count)]
+    with open(shp_path, 'rb') as shp_file:
+        shp = shp_file.read()
+    polygons = []
+    position = 100
+    while position < len(shp):
+        content_length = struct.unpack('>i', shp[position + 4:position + 8])[0] * 2
+        content = shp[position + 8:position + 8 + content_length]
+        position += 8 + content_length
+        if struct.unpack('<i', content[0:4])[0] != 5:
+            # null shape
+            polygons.append([])
+            continue
+        part_count, point_count = struct.unpack('<ii', content[36:44])
+        parts = list(numpy.frombuffer(content, '<i4', part_count, 44)) + [point_count]
+        points = numpy.frombuffer(content, '<f8', point_count * 2, 44 + 4 * part_count).reshape(-1, 2)
+        polygons.append([points[parts[i]:parts[i + 1]] for i in range(part_count)])
+    return list(zip(names or [''] * len(polygons), polygons))
+
+
+def readFeatureClass(feature_class, name_field):
+    """Return (name, rings) for each polygon in a feature class (needs arcpy)."""
+    import arcpy
+    polygons = []
+    with arcpy.da.SearchCursor(feature_class, [name_field, 'SHAPE@']) as cursor:
+        for name, shape in cursor:
+            rings = []
+            for part in shape:
+                ring = []
+                # interior rings follow the exterior ring, separated by None
+                for point in list(part) + [None]:
+                    if point is None:
+                        if ring:
+                            rings.append(numpy.array(ring))
+                        ring = []
+                    else:
+                        ring.append((point.X, point.Y))
+            polygons.append((name, rings))
+    return polygons
+
+
+class PolygonGrid:
+    """Point in polygon tests against one multipart polygon with holes. A grid of cells covers the polygon; cells
+    no edge passes through are wholly inside or outside (the mask), so only points in the few boundary cells are
+    tested against edges, and only against the edges passing through their own cell."""
+    def __init__(self, name, marine, rings, cell_size=grid_cell_size):
+        self.name = name
+        self.marine = marine
+        self.cell_size = cell_size
+        closed = [ring if (ring[0] == ring[-1]).all() else numpy.vstack((ring, ring[:1])) for ring in rings
+                  if len(ring) > 2]
+        edges = numpy.concatenate([numpy.hstack((ring[:-1], ring[1:])) for ring in closed])
+        edges = edges[(edges[:, 0] != edges[:, 2]) | (edges[:, 1] != edges[:, 3])]
+        self.x0, self.y0, self.x1, self.y1 = [numpy.ascontiguousarray(column) for column in edges.T]
+        # window of whole cells, aligned to a grid starting at 0, 0
+        self.col0 = int(numpy.floor(min(self.x0.min(), self.x1.min()) / cell_size))
+        self.row0 = int(numpy.floor(min(self.y0.min(), self.y1.min()) / cell_size))
+        self.cols = int(numpy.floor(max(self.x0.max(), self.x1.max()) / cell_size)) - self.col0 + 1
+        self.rows = int(numpy.floor(max(self.y0.max(), self.y1.max()) / cell_size)) - self.row0 + 1
+        self.bbox = (float(min(self.x0.min(), self.x1.min())), float(min(self.y0.min(), self.y1.min())),
+                     float(max(self.x0.max(), self.x1.max())), float(max(self.y0.max(), self.y1.max())))
+        self.corner = self.cornerParity().ravel()
+        self.cellEdges()
+        self.mask = numpy.where(self.edge_start[1:] > self.edge_start[:-1], cell_boundary,
+                                self.corner).astype(numpy.uint8)
+
+    def cornerParity(self):
+        """Whether the bottom right corner of each cell is inside, by crossing number along each row's bottom."""
+        x_right = (self.col0 + numpy.arange(1, self.cols + 1)) * self.cell_size
+        corner = numpy.zeros((self.rows, self.cols), dtype=bool)
+        for row in range(self.rows):
+            y = (self.row0 + row) * self.cell_size
+            straddle = (self.y0 > y) != (self.y1 > y)
+            x0, y0, x1, y1 = self.x0[straddle], self.y0[straddle], self.x1[straddle], self.y1[straddle]
+            crossings = numpy.sort(x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+            corner[row] = (len(crossings) - numpy.searchsorted(crossings, x_right, 'right')) % 2 == 1
+        return corner
+
+    def cellEdges(self):
+        """List the edges touching each cell (edges are split into pieces no longer than a cell, and each piece's
+        slightly expanded bounding box marks the cells it touches)."""
+        size = self.cell_size
+        dx = self.x1 - self.x0
+        dy = self.y1 - self.y0
+        pieces = numpy.maximum(1, numpy.ceil(numpy.maximum(abs(dx), abs(dy)) / size)).astype(numpy.int64)
+        edge = numpy.repeat(numpy.arange(len(self.x0)), pieces)
+        step = numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(pieces) - pieces, pieces)
+        t0 = step / pieces[edge]
+        t1 = (step + 1) / pieces[edge]
+        px0, px1 = self.x0[edge] + t0 * dx[edge], self.x0[edge] + t1 * dx[edge]
+        py0, py1 = self.y0[edge] + t0 * dy[edge], self.y0[edge] + t1 * dy[edge]
+        epsilon = size * 1e-6
+        col_low = numpy.floor((numpy.minimum(px0, px1) - epsilon) / size).astype(numpy.int64) - self.col0
+        col_high = numpy.floor((numpy.maximum(px0, px1) + epsilon) / size).astype(numpy.int64) - self.col0
+        row_low = numpy.floor((numpy.minimum(py0, py1) - epsilon) / size).astype(numpy.int64) - self.row0
+        row_high = numpy.floor((numpy.maximum(py0, py1) + epsilon) / size).astype(numpy.int64) - self.row0
+        keys = []
+        for col_offset in range(3):
+            for row_offset in range(3):
+                use = (col_low + col_offset <= col_high) & (row_low + row_offset <= row_high)
+                col = numpy.clip(col_low[use] + col_offset, 0, self.cols - 1)
+                row = numpy.clip(row_low[use] + row_offset, 0, self.rows - 1)
+                keys.append((row * self.cols + col) * len(self.x0) + edge[use])
+        keys = numpy.unique(numpy.concatenate(keys))
+        cells = keys // len(self.x0)
+        self.cell_edge = keys % len(self.x0)
+        self.edge_start = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(cells,
+                                                                              minlength=self.rows * self.cols))))
+
+    def cells(self, x, y):
+        """Return the positions of the points (float arrays of lon and lat) inside the grid and their cells."""
+        with numpy.errstate(invalid='ignore'):
+            col = numpy.floor(x / self.cell_size) - self.col0
+            row = numpy.floor(y / self.cell_size) - self.row0
+            points = numpy.flatnonzero((col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows))
+        return points, row[points].astype(numpy.int64) * self.cols + col[points].astype(numpy.int64)
+
+    def cellStates(self, x, y):
+        """Return the mask state of each point's cell (cell_outside for points beyond the grid)."""
+        states = numpy.full(len(x), cell_outside, dtype=numpy.uint8)
+        points, cells = self.cells(x, y)
+        states[points] = self.mask[cells]
+        return states
+
+    def contains(self, x, y):
+        """Return a boolean array saying which points (float arrays of lon and lat) are inside the polygon."""
+        inside = numpy.zeros(len(x), dtype=bool)
+        points, cells = self.cells(x, y)
+        states = self.mask[cells]
+        inside[points[states == cell_inside]] = True
+
+        # crossing parity from the cell's bottom right corner: along the row to the cell's right side, then down
+        # that side to the corner, counting only the edges in the cell
+        tested = states == cell_boundary
+        points, cells = points[tested], cells[tested]
+        row, col = numpy.divmod(cells, self.cols)
+        counts = self.edge_start[cells + 1] - self.edge_start[cells]
+        pair_point = numpy.repeat(numpy.arange(len(points)), counts)
+        offsets = numpy.arange(len(pair_point)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        pair_edge = self.cell_edge[numpy.repeat(self.edge_start[cells], counts) + offsets]
+        px = x[points][pair_point]
+        py = y[points][pair_point]
+        x_right = ((self.col0 + col + 1) * self.cell_size)[pair_point]
+        y_bottom = ((self.row0 + row) * self.cell_size)[pair_point]
+        x0, y0, x1, y1 = self.x0[pair_edge], self.y0[pair_edge], self.x1[pair_edge], self.y1[pair_edge]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            across = ((y0 > py) != (y1 > py)) & (x_cross > px) & (x_cross <= x_right)
+            y_cross = y0 + (x_right - x0) * (y1 - y0) / (x1 - x0)
+            down = ((x0 > x_right) != (x1 > x_right)) & (y_cross > y_bottom) & (y_cross <= py)
+        crossings = numpy.bincount(pair_point, weights=across.astype(numpy.int64) + down, minlength=len(points))
+        inside[points] = self.corner[cells] ^ (crossings.astype(numpy.int64) % 2 == 1)
+        return inside
+
+
+class JurisdictionIndex:
+    """Terrestrial and marine jurisdiction buffer polygons for classifying batches of points"""
+    def __init__(self, polygons):
+        self.polygons = polygons
+        # positions of the polygons of each jurisdiction and group (e.g. AC, CA)
+        self.positions = {}
+        for position, polygon in enumerate(polygons):
+            self.positions.setdefault(polygon.name, []).append(position)
+        for group, members in iNatExchangeUtils.jurisdiction_groups.items():
+            self.positions[group] = sorted(position for member in members
+                                           for position in self.positions.get(member, []))
+
+    def hasMarine(self):
+        return any(polygon.marine for polygon in self.polygons)
+
+    def select(self, jurisdictions, marine=(0, 1)):
+        """Polygons of a list of jurisdictions and groups, terrestrial and/or marine."""
+        positions = sorted(set(position for jurisdiction in jurisdictions
+                               for position in self.positions.get(jurisdiction, [])))
+        return [self.polygons[position] for position in positions if self.polygons[position].marine in marine]
+
+    def bbox(self, jurisdictions, marine=(0, 1)):
+        """Bounding box (xmin, ymin, xmax, ymax) of the polygons of a list of jurisdictions and groups."""
+        boxes = numpy.array([polygon.bbox for polygon in self.select(jurisdictions, marine)])
+        return tuple(boxes[:, :2].min(axis=0).tolist() + boxes[:, 2:].max(axis=0).tolist())
+
+    def containsAny(self, x, y, jurisdictions, marine=(0, 1)):
+        """Return a boolean array saying which points are inside any polygon of a list of jurisdictions and
+        groups; each polygon tests only the points inside its bounding box not already found inside."""
+        inside = numpy.zeros(len(x), dtype=bool)
+        for polygon in self.select(jurisdictions, marine):
+            xmin, ymin, xmax, ymax = polygon.bbox
+            with numpy.errstate(invalid='ignore'):
+                points = numpy.flatnonzero(~inside & (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+            inside[points] = polygon.contains(x[points], y[points])
+        return inside
+
+    def classifyMask(self, x, y):
+        """Classify points by the masks alone: return arrays of point and polygon positions for every point in an
+        inside cell of a polygon, and a boolean array of the points in a boundary cell of any polygon (whose
+        memberships need an exact test)."""
+        point_parts = []
+        polygon_parts = []
+        boundary = numpy.zeros(len(x), dtype=bool)
+        for position, polygon in enumerate(self.polygons):
+            states = polygon.cellStates(x, y)
+            points = numpy.flatnonzero(states == cell_inside)
+            point_parts.append(points)
+            polygon_parts.append(numpy.full(len(points), position, dtype=numpy.int64))
+            boundary |= states == cell_boundary
+        return numpy.concatenate(point_parts), numpy.concatenate(polygon_parts), boundary
+
+    def classify(self, x, y):
+        """Return arrays of point and polygon positions for every point inside every polygon (points can be in
+        several overlapping buffers)."""
+        point_parts = []
+        polygon_parts = []
+        for position, polygon in enumerate(self.polygons):
+            points = numpy.flatnonzero(polygon.contains(x, y))
+            point_parts.append(points)
+            polygon_parts.append(numpy.full(len(points), position, dtype=numpy.int64))
+        return numpy.concatenate(point_parts), numpy.concatenate(polygon_parts)
+
+
+def cacheKey(terrestrial):
+    """Identity of the polygons loadJurisdictions would build from a source of terrestrial buffers: the cache
+    format, grid cell size, source file sizes and modification times, and whether the marine buffers can be
+    read."""
+    marine = marineAvailable()
+    sources = [terrestrial]
+    if terrestrial == jurisdiction_shapefile:
+        sources.append(os.path.splitext(jurisdiction_shapefile)[0] + '.dbf')
+    if marine:
+        sources.append(marine_buffer)
+    return {'version': geometry_cache_version, 'cell_size': grid_cell_size, 'marine': marine,
+            'sources': [iNatPipeline.pathFingerprint(path) for path in sources]}
+
+
+def readCache(cache_path, key):
+    """Cached JurisdictionIndex if the cache was saved with key, otherwise None."""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached_key, index = pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    return index if cached_key == key else None
+
+
+def saveCache(cache_path, key, index, messages=None):
+    """Save a JurisdictionIndex with its key, replacing the cache atomically."""
+    temp_path = cache_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as cache_file:
+            pickle.dump((key, index), cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as error:
+        iNatExchangeUtils.displayMessage(messages, 'WARNING: could not save jurisdiction geometry cache (' +
+                                         str(error) + ')')
+
+
+def loadJurisdictions(messages=None, terrestrial=jurisdiction_shapefile):
+    """Load the jurisdiction buffer polygons (terrestrial from the shapefile, or from the gdb with arcpy) from the
+    geometry cache, or read them and build their grids (and cache them) if the sources have changed, once per
+    process."""
+    if terrestrial in jurisdiction_indexes:
+        return jurisdiction_indexes[terrestrial]
+    start = time.perf_counter()
+    key = cacheKey(terrestrial)
+    index = readCache(geometry_caches[terrestrial], key)
+    if index is not None:
+        iNatExchangeUtils.displayMessage(messages, 'Loaded ' + str(len(index.polygons)) +
+                                         ' cached jurisdiction buffers in ' +
+                                         str(round((time.perf_counter() - start) * 1000)) + 'ms')
+        jurisdiction_indexes[terrestrial] = index
+        return index
+    if terrestrial == jurisdiction_shapefile:
+        sources = [(name, 0, rings) for name, rings in readShapefile(terrestrial, shapefile_abbreviation)]
+    else:
+        sources = [(name, 0, rings) for name, rings in readFeatureClass(terrestrial, 'JurisdictionAbbreviation')]
+    if key['marine']:
+        sources += [(name, 1, rings) for name, rings in readFeatureClass(marine_buffer, 'JurisdictionAbbreviation')]
+    else:
+        iNatExchangeUtils.displayMessage(messages, 'WARNING: marine buffers need arcpy, only terrestrial ' +
+                                         'membership will be computed (exports of jurisdictions with marine ' +
+                                         'buffers will be refused)')
+    index = JurisdictionIndex([PolygonGrid(name, marine, rings) for name, marine, rings in sources if rings])
+    saveCache(geometry_caches[terrestrial], key, index, messages)
+    iNatExchangeUtils.displayMessage(messages, 'Indexed ' + str(len(sources)) + ' jurisdiction buffers in ' +
+                                     str(round(time.perf_counter() - start, 1)) + 's')
+    jurisdiction_indexes[terrestrial] = index
+    return index
+
+
+def insideRows(rows, index, jurisdictions, marine=(0, 1), xy_index=-1):
+    """Yield the rows whose (x, y) point (e.g. SHAPE@XY, None if null) is inside any polygon of a list of
+    jurisdictions and groups, classifying batches of rows."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, filter_batch_size))
+        if not batch:
+            break
+        points = numpy.array([row[xy_index] or (numpy.nan, numpy.nan) for row in batch], dtype=numpy.float64)
+        for position in numpy.flatnonzero(index.containsAny(points[:, 0], points[:, 1], jurisdictions, marine)):
+            yield batch[position]
+
+
+def polygonIndex(polygon_path):
+    """JurisdictionIndex of every polygon of a custom polygon shapefile (or feature class, with arcpy), all named
+    custom, for insideRows(rows, index, ['custom'])."""
+    if os.path.splitext(polygon_path)[1].lower() == '.shp':
+        sources = readShapefile(polygon_path)
+    else:
+        sources = readFeatureClass(polygon_path, 'OID@')
+    return JurisdictionIndex([PolygonGrid('custom', 0, rings) for name, rings in sources if rings])
+
+
+def membershipRows(index, ids, x, y):
+    """Yield (observation_id, jurisdiction, marine) rows for arrays of observation ids and coordinates."""
+    points, polygons = index.classify(x, y)
+    for point, polygon in zip(points.tolist(), polygons.tolist()):
+        yield ids[point], index.polygons[polygon].name, index.polygons[polygon].marine
+
+
+def buildMembershipVectorized(store_path, messages=None, observation_ids=None):
+    """Classify observations against the jurisdiction buffers with the NumPy engine and save the memberships as
+    an indexed table (same table and options as buildMembership)."""
+    import iNatJoins
+    import iNatStores
+    index = loadJurisdictions(messages)
+    store = iNatStores.openStore(store_path)
+    rows = store.readRows('observations', ['id', 'lon', 'lat'])
+    if observation_ids is None:
+        store.createTable(membership_table, membership_fields)
+    else:
+        store.deleteRows(membership_table, 'observation_id', observation_ids)
+        rows = iNatJoins.semiJoin(rows, 0, iNatJoins.IdSet(list(observation_ids)))
+    count = 0
+    field_names = [name for name, field_type in membership_fields]
+    while True:
+        batch = list(itertools.islice(rows, classify_batch_size))
+        if not batch:
+            break
+        ids = [row[0] for row in batch]
+        x = numpy.array([numpy.nan if row[1] is None else row[1] for row in batch], dtype=numpy.float64)
+        y = numpy.array([numpy.nan if row[2] is None else row[2] for row in batch], dtype=numpy.float64)
+        count += store.insertRows(membership_table, field_names, membershipRows(index, ids, x, y))
+        iNatExchangeUtils.displayMessage(messages, 'Saved ' + str(count) + ' memberships')
+    if observation_ids is None:
+        store.addIndex(membership_table, ['observation_id'], 'observation_id_idx')
+        store.addIndex(membership_table, ['jurisdiction'], 'jurisdiction_idx')
+    # an update without the marine buffers leaves the whole table without them
+    marine = index.hasMarine() and (observation_ids is None or membershipMarine(store))
+    saveMembershipInfo(store, marine)
+    store.close()
+
+
+def buildMembership(work_gdb, messages=None, observation_ids=None):
+    """Join observations to the terrestrial and marine jurisdiction buffers (each observation can fall in several
+    overlapping buffers) and save the matches as an indexed membership table; if observation_ids are given, only
+    those observations are (re)joined and their rows replaced. Observations in inside or outside cells of every
+    buffer's mask are decided by the masks; only those in a boundary cell are spatially joined."""
+    if os.path.splitext(work_gdb)[1] == '.gpkg':
+        buildMembershipVectorized(work_gdb, messages, observation_ids)
+        return
+    import arcpy
+    import iNatJoins
+    import iNatStores
+    # masks of the same gdb buffers the spatial join uses, so the results are identical
+    index = loadJurisdictions(messages, jurisdiction_buffer)
+    store = iNatStores.FileGdbStore(work_gdb)
+    field_names = [name for name, field_type in membership_fields]
+    if observation_ids is None:
+        store.createTable(membership_table, membership_fields)
+    else:
+        store.deleteRows(membership_table, 'observation_id', observation_ids)
+    boundary_ids = []
+    count = 0
+    with arcpy.da.SearchCursor(work_gdb + '/observations', ['id', 'SHAPE@XY']) as cursor:
+        rows = cursor if observation_ids is None else \
+            iNatJoins.semiJoin(cursor, 0, iNatJoins.IdSet(list(observation_ids)))
+        while True:
+            batch = list(itertools.islice(rows, classify_batch_size))
+            if not batch:
+                break
+            ids = [row[0] for row in batch]
+            points = numpy.array([row[1] or (numpy.nan, numpy.nan) for row in batch], dtype=numpy.float64)
+            inside, polygons, boundary = index.classifyMask(points[:, 0], points[:, 1])
+            # a point in any boundary cell gets all its memberships from the join
+            decided = ~boundary[inside]
+            count += store.insertRows(membership_table, field_names,
+                                      ((ids[point], index.polygons[polygon].name, index.polygons[polygon].marine)
+                                       for point, polygon in zip(inside[decided].tolist(),
+                                                                 polygons[decided].tolist())))
+            boundary_ids.extend(ids[point] for point in numpy.flatnonzero(boundary).tolist())
+    iNatExchangeUtils.displayMessage(messages, 'Saved ' + str(count) + ' memberships from the grid masks, ' +
+                                     str(len(boundary_ids)) + ' observations in boundary cells')
+
+    store.createTable('membership_ids', [('id', 'LONG')])
+    store.insertRows('membership_ids', ['id'], ((boundary_id,) for boundary_id in boundary_ids))
+    observations = 'membership_obs_lyr'
+    arcpy.management.MakeFeatureLayer(work_gdb + '/observations', observations,
+                                      'id IN (SELECT id FROM membership_ids)')
+    join_output = work_gdb + '/membership_temp'
+    for buffer, marine in ((jurisdiction_buffer, 0), (marine_buffer, 1)):
+        iNatExchangeUtils.displayMessage(messages, 'Joining observations to ' + os.path.basename(buffer))
+        # keep only the two fields needed rather than every observation field
+        field_mappings = arcpy.FieldMappings()
+        for table, field in ((observations, 'id'), (buffer, 'JurisdictionAbbreviation')):
+            field_map = arcpy.FieldMap()
+            field_map.addInputField(table, field)
+            field_mappings.addFieldMap(field_map)
+        arcpy.analysis.SpatialJoin(observations, buffer, join_output, 'JOIN_ONE_TO_MANY', 'KEEP_COMMON',
+                                   field_mappings, 'INTERSECT')
+        with arcpy.da.SearchCursor(join_output, ['id', 'JurisdictionAbbreviation']) as cursor:
+            count = store.insertRows(membership_table, field_names, ((row[0], row[1], marine) for row in cursor))
+        iNatExchangeUtils.displayMessage(messages, 'Saved ' + str(count) + ' memberships')
+        arcpy.management.Delete(join_output)
+    arcpy.management.Delete(observations)
+    store.delete('membership_ids')
+    if observation_ids is None:
+        store.addIndex(membership_table, ['observation_id'], 'observation_id_idx')
+        store.addIndex(membership_table, ['jurisdiction'], 'jurisdiction_idx')
+    saveMembershipInfo(store, True)
+
+
+def bruteForceContains(polygon, x, y):
+    """Crossing number test of points against every edge of a PolygonGrid (slow, used to check the grid)."""
+    inside = numpy.zeros(len(x), dtype=bool)
+    for start in range(0, len(polygon.x0), 2000):
+        x0, y0 = polygon.x0[start:start + 2000, None], polygon.y0[start:start + 2000, None]
+        x1, y1 = polygon.x1[start:start + 2000, None], polygon.y1[start:start + 2000, None]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            crossing = ((y0 > y) != (y1 > y)) & (x0 + (y - y0) * (x1 - x0) / (y1 - y0) > x)
+        inside ^= numpy.bitwise_xor.reduce(crossing, axis=0)
+    return inside
+
+
+def syntheticPoints(count, random):
+    """Return lon and lat arrays of count synthetic observations (80% around cities near the southern border, as with
+    real observations, the rest spread over the buffers' extent), and the position in synthetic_centres of each
+    clustered point (-1 for spread points)."""
+    clustered = int(count * 0.8)
+    centres = numpy.array([(lon, lat) for lon, lat, jurisdiction in synthetic_centres])
+    centre = random.integers(0, len(centres), clustered)
+    x = numpy.concatenate((centres[centre, 0] + random.normal(0, 1.5, clustered),
+                           random.uniform(-141.7, -52.2, count - clustered)))
+    y = numpy.concatenate((centres[centre, 1] + random.normal(0, 1.0, clustered),
+                           random.uniform(41.4, 83.9, count - clustered)))
+    return x, y, numpy.concatenate((centre, numpy.full(count - clustered, -1)))
+
+
+def benchmark(points=5000000, checked=20000):
+    """Time the engine on a synthetic Canada-wide point cloud (most points near the southern border, as with real
+    observations), check a sample against a brute force crossing number test and, where arcpy is available,
+    against SelectLayerByLocation INTERSECT counts."""
+    random = numpy.random.default_rng(9)
+    start = time.perf_counter()
+    index = loadJurisdictions()
+    build_seconds = time.perf_counter() - start
+    x, y = syntheticPoints(points, random)[:2]
+    start = time.perf_counter()
+    memberships = 0
+    for batch in range(0, points, classify_batch_size):
+        memberships += len(index.classify(x[batch:batch + classify_batch_size],
+                                          y[batch:batch + classify_batch_size])[0])
+    seconds = time.perf_counter() - start
+    print('Indexed ' + str(len(index.polygons)) + ' polygons in ' + str(round(build_seconds, 2)) + 's')
+    print('Classified ' + str(points) + ' points (' + str(memberships) + ' memberships) in ' +
+          str(round(seconds, 2)) + 's (' + str(int(points / seconds)) + ' points/s)')
+    boundary = index.classifyMask(x[:classify_batch_size], y[:classify_batch_size])[2]
+    print(str(grid_cell_size) + ' degree cells: ' + str(round(boundary.mean() * 100, 2)) +
+          '% of points in a boundary cell, ' + str(sum(polygon.mask.size for polygon in index.polygons)) +
+          ' cells')
+
+    sample_x, sample_y = x[:checked], y[:checked]
+    mismatches = 0
+    for polygon in index.polygons:
+        mismatches += int((polygon.contains(sample_x, sample_y) != bruteForceContains(polygon, sample_x,
+                                                                                      sample_y)).sum())
+    print('Brute force check of ' + str(checked) + ' points: ' + str(mismatches) + ' mismatches')
+
+    try:
+        import arcpy
+    except ImportError:
+        return
+    arcpy.env.overwriteOutput = True
+    sample = arcpy.management.CreateFeatureclass('memory', 'sample_points', 'POINT',
+                                                 spatial_reference=arcpy.SpatialReference(4326))[0]
+    with arcpy.da.InsertCursor(sample, ['SHAPE@XY']) as cursor:
+        for point in zip(sample_x.tolist(), sample_y.tolist()):
+            cursor.insertRow([point])
+    arcpy.management.MakeFeatureLayer(sample, 'sample_lyr')
+    for polygon in index.polygons:
+        buffer = marine_buffer if polygon.marine else jurisdiction_buffer
+        arcpy.management.MakeFeatureLayer(buffer, 'buffer_lyr', "JurisdictionAbbreviation = '" + polygon.name + "'")
+        arcpy.management.SelectLayerByLocation('sample_lyr', 'INTERSECT', 'buffer_lyr')
+        arcpy_count = int(arcpy.management.GetCount('sample_lyr')[0])
+        engine_count = int(polygon.contains(sample_x, sample_y).sum())
+        print(polygon.name + (' marine' if polygon.marine else '') + ': arcpy ' + str(arcpy_count) + ', engine ' +
+              str(engine_count))
+        arcpy.management.Delete('buffer_lyr')
+
+
+# controlling process
+if __name__ == '__main__':
+    # run from the imported module, so the geometry cache holds iNatSpatial classes rather than __main__ ones
+    import iNatSpatial
+    iNatSpatial.benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,313 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatStores.py
+# Working stores (file gdb or GeoPackage) written and read by the streaming loaders
+
+# Notes:
+# - field types use the arcpy names (LONG, DOUBLE, TEXT, DATE)
+# - the SHAPE@XY token (as in arcpy.da cursors) reads/writes point geometry as an (x, y) tuple
+# - GeoPackageStore needs only the Python standard library, so it runs without ArcGIS
+
+# import Python packages
+import datetime
+import os
+import sqlite3
+import struct
+
+
+# GeoPackage application_id ('GPKG') and version 1.2
+gpkg_application_id = 1196444487
+gpkg_user_version = 10200
+gpkg_geometry_column = 'shape'
+sqlite_types = {'LONG': 'INTEGER',
+                'DOUBLE': 'DOUBLE',
+                'TEXT': 'TEXT',
+                'DATE': 'DATE'}
+
+
+def openStore(path):
+    """Open a working store, choosing the implementation from the path extension."""
+    if path.lower().endswith('.gpkg'):
+        return GeoPackageStore(path)
+    return FileGdbStore(path)
+
+
+def encodePoint(xy, srs_id=4326):
+    """Encode an (x, y) tuple as a GeoPackage geometry blob (no envelope, little endian WKB)."""
+    if xy is None or xy[0] is None or xy[1] is None:
+        return None
+    return struct.pack('<2sBBi', b'GP', 0, 1, srs_id) + struct.pack('<BIdd', 1, 1, xy[0], xy[1])
+
+
+def decodePoint(blob):
+    """Decode a GeoPackage point geometry blob written by encodePoint into an (x, y) tuple."""
+    if blob is None:
+        return None
+    flags = blob[3]
+    # skip header and optional envelope (envelope indicator in bits 1-3)
+    offset = 8 + (0, 32, 48, 48, 64)[(flags >> 1) & 7]
+    return struct.unpack_from('<dd', blob, offset + 5)
+
+
+class GeoPackageStore:
+    """Working store in a GeoPackage (SQLite) database"""
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path)
+        self.connection = sqlite3.connect(path)
+        # bulk loading settings; the store is rebuilt from the CSVs if a load is interrupted
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA journal_mode = MEMORY')
+        if new:
+            self.createMetadata()
+
+    def createMetadata(self):
+        """Create the minimal GeoPackage metadata tables."""
+        conn = self.connection
+        conn.execute('PRAGMA application_id = ' + str(gpkg_application_id))
+        conn.execute('PRAGMA user_version = ' + str(gpkg_user_version))
+        conn.execute('CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, '
+                     'organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, '
+                     'definition TEXT NOT NULL, description TEXT)')
+        conn.executemany('INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                         [('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', None),
+                          ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None),
+                          ('WGS 84 geodetic', 4326, 'EPSG', 4326,
+                           'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+                           'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]', None)])
+        conn.execute('CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, '
+                     'identifier TEXT UNIQUE, description TEXT DEFAULT \'\', '
+                     'last_change DATETIME NOT NULL DEFAULT (strftime(\'%Y-%m-%dT%H:%M:%fZ\', \'now\')), '
+                     'min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER)')
+        conn.execute('CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, '
+                     'geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, '
+                     'm TINYINT NOT NULL, PRIMARY KEY (table_name, column_name))')
+        conn.commit()
+
+    def exists(self, table):
+        cursor = self.connection.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?',
+                                         ('table', table))
+        return cursor.fetchone() is not None
+
+    def delete(self, table):
+        self.connection.execute('DROP TABLE IF EXISTS "' + table + '"')
+        self.connection.execute('DELETE FROM gpkg_contents WHERE table_name = ?', (table,))
+        self.connection.execute('DELETE FROM gpkg_geometry_columns WHERE table_name = ?', (table,))
+        self.connection.commit()
+
+    def createTable(self, table, fields, geometry=False):
+        """Create a table (or point table if geometry) from a list of (name, type) pairs, replacing any existing."""
+        if self.exists(table):
+            self.delete(table)
+        columns = ['fid INTEGER PRIMARY KEY AUTOINCREMENT']
+        if geometry:
+            columns.append(gpkg_geometry_column + ' POINT')
+        for name, field_type in fields:
+            columns.append('"' + name + '" ' + sqlite_types[field_type])
+        self.connection.execute('CREATE TABLE "' + table + '" (' + ', '.join(columns) + ')')
+        self.connection.execute('INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) '
+                                'VALUES (?, ?, ?, ?)', (table, 'features' if geometry else 'attributes', table,
+                                                        4326 if geometry else None))
+        if geometry:
+            self.connection.execute('INSERT INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, ?, ?)',
+                                    (table, gpkg_geometry_column, 'POINT', 4326, 0, 0))
+        self.connection.commit()
+
+    def fields(self, table):
+        """List (name, type) pairs for the attribute fields of a table."""
+        arcpy_types = dict((sqlite_type, field_type) for field_type, sqlite_type in sqlite_types.items())
+        fields = []
+        for column in self.connection.execute('PRAGMA table_info("' + table + '")'):
+            if column[1] not in ('fid', gpkg_geometry_column):
+                fields.append((column[1], arcpy_types.get(column[2], 'TEXT')))
+        return fields
+
+    def columnNames(self, field_names):
+        """Map field names (including SHAPE@XY) to quoted column names."""
+        return ', '.join(gpkg_geometry_column if name == 'SHAPE@XY' else '"' + name + '"' for name in field_names)
+
+    def insertRows(self, table, field_names, rows):
+        """Insert an iterable of row tuples in a single transaction and return the number of rows inserted."""
+        shape_index = field_names.index('SHAPE@XY') if 'SHAPE@XY' in field_names else None
+        date_types = dict(self.fields(table))
+        date_indexes = [i for i, name in enumerate(field_names) if date_types.get(name) == 'DATE']
+        if shape_index is not None or date_indexes:
+            rows = self.adaptRows(rows, shape_index, date_indexes)
+        sql = 'INSERT INTO "' + table + '" (' + self.columnNames(field_names) + ') VALUES (' + \
+            ', '.join('?' * len(field_names)) + ')'
+        before = self.connection.total_changes
+        with self.connection:
+            self.connection.executemany(sql, rows)
+        return self.connection.total_changes - before
+
+    def adaptRows(self, rows, shape_index, date_indexes):
+        """Convert SHAPE@XY tuples to geometry blobs and dates to ISO text."""
+        for row in rows:
+            row = list(row)
+            if shape_index is not None:
+                row[shape_index] = encodePoint(row[shape_index])
+            for i in date_indexes:
+                if isinstance(row[i], (datetime.date, datetime.datetime)):
+                    row[i] = row[i].strftime('%Y-%m-%d')
+            yield row
+
+    def readRows(self, table, field_names=None, where=None):
+        """Yield row tuples, optionally limited to fields and a SQL where clause."""
+        if not field_names:
+            field_names = [name for name, field_type in self.fields(table)]
+        sql = 'SELECT ' + self.columnNames(field_names) + ' FROM "' + table + '"'
+        if where:
+            sql += ' WHERE ' + where
+        cursor = self.connection.execute(sql)
+        if 'SHAPE@XY' in field_names:
+            shape_index = field_names.index('SHAPE@XY')
+            for row in cursor:
+                row = list(row)
+                row[shape_index] = decodePoint(row[shape_index])
+                yield tuple(row)
+        else:
+            yield from cursor
+
+    def deleteRows(self, table, key_field, ids):
+        """Delete the rows whose key_field is in an iterable of ids and return the number deleted."""
+        conn = self.connection
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS delete_ids (id INTEGER PRIMARY KEY)')
+        with conn:
+            conn.execute('DELETE FROM temp.delete_ids')
+            conn.executemany('INSERT OR IGNORE INTO temp.delete_ids VALUES (?)', ((int(key),) for key in ids))
+            cursor = conn.execute('DELETE FROM "' + table + '" WHERE "' + key_field +
+                                  '" IN (SELECT id FROM temp.delete_ids)')
+        return cursor.rowcount
+
+    def indexSql(self, table, fields, index_name):
+        # SQLite index names are per database rather than per table
+        return 'CREATE INDEX IF NOT EXISTS "' + table + '_' + index_name + '" ON "' + table + '" (' + \
+            ', '.join('"' + field + '"' for field in fields) + ')'
+
+    def addIndex(self, table, fields, index_name):
+        self.connection.execute(self.indexSql(table, fields, index_name))
+        self.connection.commit()
+
+    def addIndexes(self, indexes, workers=None):
+        """Create a list of (table, fields, index name) indexes in one transaction, with SQLite sorting on several
+        threads (SQLite has one writer at a time, so indexes are not built by concurrent processes)."""
+        self.connection.execute('PRAGMA threads = ' + str(workers or os.cpu_count()))
+        with self.connection:
+            for table, fields, index_name in indexes:
+                self.connection.execute(self.indexSql(table, fields, index_name))
+
+    def consolidate(self, staging_path, table):
+        """Copy a table and its indexes from a staging GeoPackage into this store, then delete the staging file."""
+        if self.exists(table):
+            self.delete(table)
+        conn = self.connection
+        conn.execute('ATTACH DATABASE ? AS staging', (staging_path,))
+        try:
+            with conn:
+                schema = conn.execute('SELECT type, sql FROM staging.sqlite_master WHERE tbl_name = ? AND '
+                                      'sql IS NOT NULL ORDER BY type DESC', (table,)).fetchall()
+                # table first, then rows, then indexes so they are built once over the loaded rows
+                conn.execute(schema[0][1])
+                conn.execute('INSERT INTO main."' + table + '" SELECT * FROM staging."' + table + '"')
+                for object_type, sql in schema[1:]:
+                    conn.execute(sql)
+                conn.execute('INSERT INTO main.gpkg_contents SELECT * FROM staging.gpkg_contents '
+                             'WHERE table_name = ?', (table,))
+                conn.execute('INSERT INTO main.gpkg_geometry_columns SELECT * FROM staging.gpkg_geometry_columns '
+                             'WHERE table_name = ?', (table,))
+        finally:
+            conn.execute('DETACH DATABASE staging')
+        os.remove(staging_path)
+
+    def close(self):
+        self.connection.close()
+
+
+class FileGdbStore:
+    """Working store in a file geodatabase, written and read through arcpy.da cursors"""
+    def __init__(self, path):
+        import arcpy
+        self.arcpy = arcpy
+        self.path = path
+        if not arcpy.Exists(path):
+            arcpy.management.CreateFileGDB(os.path.dirname(path), os.path.basename(path))
+
+    def exists(self, table):
+        return self.arcpy.Exists(self.path + '/' + table)
+
+    def delete(self, table):
+        if self.exists(table):
+            self.arcpy.management.Delete(self.path + '/' + table)
+
+    def createTable(self, table, fields, geometry=False):
+        """Create a table (or point feature class if geometry) from a list of (name, type) pairs, replacing any
+        existing."""
+        self.delete(table)
+        if geometry:
+            self.arcpy.management.CreateFeatureclass(self.path, table, 'POINT',
+                                                     spatial_reference=self.arcpy.SpatialReference(4326))
+        else:
+            self.arcpy.management.CreateTable(self.path, table)
+        # match the text field length TableToTable uses for CSV imports
+        self.arcpy.management.AddFields(self.path + '/' + table,
+                                        [[name, field_type, name, 8000 if field_type == 'TEXT' else None]
+                                         for name, field_type in fields])
+
+    def fields(self, table):
+        """List (name, type) pairs for the attribute fields of a table."""
+        arcpy_types = {'Integer': 'LONG', 'SmallInteger': 'LONG', 'BigInteger': 'LONG', 'OID': 'LONG',
+                       'Double': 'DOUBLE', 'Single': 'DOUBLE', 'Date': 'DATE', 'DateOnly': 'DATE'}
+        fields = []
+        for field in self.arcpy.ListFields(self.path + '/' + table):
+            if field.type not in ('OID', 'Geometry', 'GlobalID') and field.name.lower() not in ('shape_length',
+                                                                                              'shape_area'):
+                fields.append((field.name, arcpy_types.get(field.type, 'TEXT')))
+        return fields
+
+    def insertRows(self, table, field_names, rows):
+        """Insert an iterable of row tuples and return the number of rows inserted."""
+        count = 0
+        with self.arcpy.da.InsertCursor(self.path + '/' + table, field_names) as cursor:
+            for row in rows:
+                cursor.insertRow(row)
+                count += 1
+        return count
+
+    def readRows(self, table, field_names=None, where=None):
+        """Yield row tuples, optionally limited to fields and a SQL where clause."""
+        if not field_names:
+            field_names = [name for name, field_type in self.fields(table)]
+        with self.arcpy.da.SearchCursor(self.path + '/' + table, field_names, where) as cursor:
+            yield from cursor
+
+    def deleteRows(self, table, key_field, ids):
+        """Delete the rows whose key_field is in an iterable of ids and return the number deleted."""
+        ids = set(ids)
+        count = 0
+        with self.arcpy.da.UpdateCursor(self.path + '/' + table, [key_field]) as cursor:
+            for row in cursor:
+                if row[0] in ids:
+                    cursor.deleteRow()
+                    count += 1
+        return count
+
+    def addIndex(self, table, fields, index_name):
+        self.arcpy.management.AddIndex(self.path + '/' + table, fields, index_name)
+
+    def addIndexes(self, indexes, workers=None):
+        """Create a list of (table, fields, index name) indexes."""
+        for table, fields, index_name in indexes:
+            self.addIndex(table, fields, index_name)
+
+    def consolidate(self, staging_path, table):
+        """Copy a table (including its indexes) from a staging gdb into this store, then delete the staging gdb."""
+        self.delete(table)
+        self.arcpy.management.Copy(staging_path + '/' + table, self.path + '/' + table)
+        self.arcpy.management.Delete(staging_path)
+
+    def close(self):
+        pass
@@ -0,0 +1,242 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: iNatTaxa.py
+# Taxon name prefix index, built at import, that turns a list of species (name prefixes) into the set of taxon ids
+# they match (replaces OR-chained scientific_name LIKE 'X%' clauses evaluated against every observation), and a
+# nested interval encoding of the taxa tree that turns a clade into the set of its descendant taxon ids
+
+# Notes:
+# - needs NumPy (included with ArcGIS Pro), but not arcpy
+# - names are matched without regard to case; each prefix is found by binary search of the sorted names, so a
+#   lookup takes O(log n) plus the number of matching names
+# - each taxon is numbered in depth-first order of the tree given by taxa.ancestry (ancestor ids from the root,
+#   separated by /), and its interval runs to the number of its last descendant, so the descendants of a clade are
+#   one contiguous slice of the taxa sorted by interval start
+# - a species list (e.g. EBAR species of interest) is a CSV with a NATIONAL_SCIENTIFIC_NAME column, a text file
+#   of one name per line, or a table with that field (read with arcpy)
+# - python iNatTaxa.py <working store> <species;species...> prints the taxon ids matched
+
+# import Python packages
+import bisect
+import csv
+import io
+import os
+import sys
+import time
+import numpy
+import iNatExchangeUtils
+import iNatStores
+
+
+# table of sorted (casefolded) taxon names and their ids in the working store
+name_table = 'taxon_names'
+name_fields = [('name_key', 'TEXT'), ('taxon_id', 'LONG')]
+# table of the nested interval of each taxon in the working store
+interval_table = 'taxon_intervals'
+interval_fields = [('taxon_id', 'LONG'), ('interval_start', 'LONG'), ('interval_end', 'LONG')]
+# field of the scientific names in a species list table
+species_list_field = 'NATIONAL_SCIENTIFIC_NAME'
+# sorts after any character in a taxon name, closing the range of names starting with a prefix
+prefix_end = '\U0010ffff'
+
+
+def nameKey(name):
+    """Case-insensitive key of a taxon name."""
+    return name.casefold()
+
+
+def nameList(param_names):
+    """Split a multivalue Species or Clade parameter (names separated by semicolons, possibly quoted) into
+    names."""
+    return [name.strip() for name in param_names.replace("'", '').split(';') if name.strip()]
+
+
+def readSpeciesList(list_path):
+    """Set of the scientific names in a species list, for exact name lookups."""
+    if os.path.splitext(list_path)[1].lower() not in ('.csv', '.txt'):
+        import arcpy
+        with arcpy.da.SearchCursor(list_path, [species_list_field]) as cursor:
+            return set(row[0].strip() for row in cursor if row[0] and row[0].strip())
+    with io.open(list_path, 'r', encoding='utf-8-sig', newline='') as list_file:
+        rows = list(csv.reader(list_file))
+    column = 0
+    if rows and species_list_field in rows[0]:
+        column = rows[0].index(species_list_field)
+        rows = rows[1:]
+    return set(row[column].strip() for row in rows if len(row) > column and row[column].strip())
+
+
+class PrefixIndex:
+    """Sorted taxon names with the taxon id of each, answering name prefix queries by binary search"""
+    def __init__(self, pairs):
+        pairs = sorted(set(pairs))
+        self.names = [name_key for name_key, taxon_id in pairs]
+        self.taxon_ids = numpy.array([taxon_id for name_key, taxon_id in pairs], dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.names)
+
+    def nameRange(self, prefix):
+        """Start and end positions of the names starting with prefix."""
+        key = nameKey(prefix)
+        return bisect.bisect_left(self.names, key), bisect.bisect_left(self.names, key + prefix_end)
+
+    def nameIds(self, names):
+        """Set of the taxon ids with any of a list of exact names."""
+        ids = set()
+        for name in names:
+            key = nameKey(name)
+            start, end = bisect.bisect_left(self.names, key), bisect.bisect_right(self.names, key)
+            ids.update(self.taxon_ids[start:end].tolist())
+        return ids
+
+    def taxonIds(self, prefixes):
+        """Set of the taxon ids whose name starts with any of a list of prefixes."""
+        parts = [self.taxon_ids[start:end] for start, end in map(self.nameRange, prefixes)]
+        if not parts:
+            return set()
+        return set(numpy.unique(numpy.concatenate(parts)).tolist())
+
+
+def namePairs(store):
+    """Yield (name key, taxon id) for every taxon name and observation scientific_name in a store."""
+    for name, taxon_id in store.readRows('taxa', ['name', 'id']):
+        if name and taxon_id is not None:
+            yield nameKey(name), taxon_id
+    # observations keep the name they were identified with, which can differ from the current taxa name
+    for name, taxon_id in store.readRows('observations', ['scientific_name', 'taxon_id']):
+        if name and taxon_id is not None:
+            yield nameKey(name), taxon_id
+
+
+def buildNameIndex(store_path, messages=None):
+    """Save the sorted distinct taxon names of a working store to its taxon_names table and return the number of
+    names."""
+    store = iNatStores.openStore(store_path)
+    index = PrefixIndex(namePairs(store))
+    store.createTable(name_table, name_fields)
+    count = store.insertRows(name_table, [name for name, field_type in name_fields],
+                             zip(index.names, index.taxon_ids.tolist()))
+    store.addIndex(name_table, ['name_key'], 'name_key_idx')
+    store.close()
+    iNatExchangeUtils.displayMessage(messages, 'Indexed ' + str(count) + ' taxon names')
+    return count
+
+
+def nestedIntervals(taxa):
+    """Return (taxon id, interval start, interval end) for an iterable of (taxon id, ancestry), numbering taxa
+    depth first; taxa whose parent is missing are treated as roots."""
+    parents = {}
+    for taxon_id, ancestry in taxa:
+        parents[taxon_id] = int(ancestry.rsplit('/', 1)[-1]) if ancestry else None
+    children = {}
+    roots = []
+    for taxon_id in sorted(parents):
+        parent = parents[taxon_id]
+        if parent in parents:
+            children.setdefault(parent, []).append(taxon_id)
+        else:
+            roots.append(taxon_id)
+    intervals = []
+    # iterative depth first walk (iNat ancestries are too deep for comfortable recursion); a taxon's start is its
+    # position in intervals, and its end is filled in once all its descendants have been numbered
+    for root in roots:
+        stack = [(root, None)]
+        while stack:
+            taxon_id, start = stack.pop()
+            if start is not None:
+                intervals[start][2] = len(intervals) - 1
+                continue
+            stack.append((taxon_id, len(intervals)))
+            intervals.append([taxon_id, len(intervals), None])
+            stack.extend((child, None) for child in reversed(children.get(taxon_id, [])))
+    return [tuple(interval) for interval in intervals]
+
+
+def buildIntervals(store_path, messages=None):
+    """Save the nested interval of every taxon of a working store to its taxon_intervals table and return the
+    number of taxa."""
+    store = iNatStores.openStore(store_path)
+    intervals = nestedIntervals(store.readRows('taxa', ['id', 'ancestry']))
+    store.createTable(interval_table, interval_fields)
+    count = store.insertRows(interval_table, [name for name, field_type in interval_fields], intervals)
+    store.addIndex(interval_table, ['taxon_id'], 'taxon_id_idx')
+    store.close()
+    iNatExchangeUtils.displayMessage(messages, 'Encoded ' + str(count) + ' taxa as nested intervals')
+    return count
+
+
+def indexTaxa(store_path, messages=None):
+    """Build the name and nested interval indexes of a working store and return the number of names indexed."""
+    count = buildNameIndex(store_path, messages)
+    buildIntervals(store_path, messages)
+    return count
+
+
+class CladeIndex:
+    """Taxa in depth-first order, answering descendant queries with one slice per clade"""
+    def __init__(self, intervals):
+        intervals = sorted(intervals, key=lambda interval: interval[1])
+        self.taxon_ids = numpy.array([interval[0] for interval in intervals], dtype=numpy.int64)
+        self.ranges = dict((taxon_id, (start, end)) for taxon_id, start, end in intervals)
+
+    def __len__(self):
+        return len(self.taxon_ids)
+
+    def descendantIds(self, clade_ids):
+        """Set of the taxon ids in any of a list of clades (each clade including its own taxon)."""
+        ids = set()
+        for clade_id in clade_ids:
+            if clade_id in self.ranges:
+                start, end = self.ranges[clade_id]
+                ids.update(self.taxon_ids[start:end + 1].tolist())
+        return ids
+
+
+def loadNameIndex(store_path):
+    """PrefixIndex of a working store, read from its taxon_names table (or built from taxa and observations if the
+    store was imported without one)."""
+    store = iNatStores.openStore(store_path)
+    if store.exists(name_table):
+        index = PrefixIndex(store.readRows(name_table, [name for name, field_type in name_fields]))
+    else:
+        index = PrefixIndex(namePairs(store))
+    store.close()
+    return index
+
+
+def loadCladeIndex(store_path):
+    """CladeIndex of a working store, read from its taxon_intervals table (or computed from taxa if the store was
+    imported without one)."""
+    store = iNatStores.openStore(store_path)
+    if store.exists(interval_table):
+        index = CladeIndex(store.readRows(interval_table, [name for name, field_type in interval_fields]))
+    else:
+        index = CladeIndex(nestedIntervals(store.readRows('taxa', ['id', 'ancestry'])))
+    store.close()
+    return index
+
+
+def cladeIds(store_path, clades):
+    """Set of the taxon ids in a list of clades, each given as a taxon id or an exact taxon name."""
+    clade_ids = set(int(clade) for clade in clades if clade.isdigit())
+    names = [clade for clade in clades if not clade.isdigit()]
+    if names:
+        clade_ids.update(loadNameIndex(store_path).nameIds(names))
+    return loadCladeIndex(store_path).descendantIds(clade_ids)
+
+
+# controlling process
+if __name__ == '__main__':
+    # usage: python iNatTaxa.py <working store> <species;species...>
+    start = time.perf_counter()
+    name_index = loadNameIndex(sys.argv[1])
+    print('Loaded ' + str(len(name_index)) + ' taxon names in ' + str(round(time.perf_counter() - start, 2)) + 's')
+    start = time.perf_counter()
+    matched = name_index.taxonIds(nameList(sys.argv[2]))
+    print('Matched ' + str(len(matched)) + ' taxa in ' + str(round((time.perf_counter() - start) * 1000, 3)) + 'ms')
+    print(sorted(matched))
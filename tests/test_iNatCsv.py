@@ -0,0 +1,77 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: test_iNatCsv.py
+# Tests of the chunked CSV reader on edge-case records
+
+# import Python packages
+import csv
+import io
+import iNatCsv
+
+
+# a header, a blank record, a short record, a quoted newline and a quoted comma
+edge_text = ('id,description,user_id\n'
+             '1,first,10\n'
+             '\n'
+             '2,short\n'
+             '3,"two\nlines",30\n'
+             '4,"a, b",40\n')
+edge_rows = [('1', 'first', '10'), ('2', 'short', ''), ('3', 'two\nlines', '30'), ('4', 'a, b', '40')]
+
+
+def writeCsv(tmp_path, text):
+    csv_path = str(tmp_path / 'edge.csv')
+    with io.open(csv_path, 'w', encoding='utf8', newline='') as csv_file:
+        csv_file.write(text)
+    return csv_path
+
+
+def testParseChunkSkipsBlankAndPadsShortRecords(tmp_path):
+    csv_path = writeCsv(tmp_path, edge_text)
+    start = len('id,description,user_id\n')
+    count, columns = iNatCsv.parseChunk(csv_path, start, len(edge_text.encode('utf8')), [0, 1, 2], None)
+    assert count == 4
+    assert [len(column) for column in columns] == [4, 4, 4]
+    assert list(zip(*columns)) == edge_rows
+
+
+def testParseChunkSubsetOfFields(tmp_path):
+    csv_path = writeCsv(tmp_path, edge_text)
+    start = len('id,description,user_id\n')
+    count, columns = iNatCsv.parseChunk(csv_path, start, len(edge_text.encode('utf8')), [0, 2], ['LONG', 'LONG'])
+    assert count == 4
+    assert columns == [[1, 2, 3, 4], [10, None, 30, 40]]
+
+
+def testChunkedReaderTypedAndDropped(tmp_path):
+    csv_path = writeCsv(tmp_path, edge_text)
+    reader = iNatCsv.ChunkedReader(csv_path, drop_fields=['description'], workers=1)
+    assert reader.header == ['id', 'user_id']
+    assert list(reader.rows()) == [(1, 10), (2, None), (3, 30), (4, 40)]
+    assert reader.rows_read == 4
+
+
+def testChunkedReaderMatchesCsvReader(tmp_path):
+    # many small chunks, so chunk boundaries fall inside quoted newlines and quoted quotes
+    lines = ['id,description,user_id']
+    for i in range(500):
+        lines.append(str(i) + ',"line ""' + str(i) + '""\nnext\nlast",' + str(i % 7))
+        if i % 50 == 0:
+            lines.append('')
+    csv_path = writeCsv(tmp_path, '\n'.join(lines) + '\n')
+    with io.open(csv_path, 'r', encoding='utf8', newline='') as csv_file:
+        expected = [tuple(line) for line in list(csv.reader(csv_file))[1:] if line]
+    for workers in (1, 2):
+        reader = iNatCsv.ChunkedReader(csv_path, typed=False, workers=workers, size=97)
+        assert len(reader.chunkRanges()) > 10
+        assert list(reader.rows()) == expected
+        assert reader.rows_read == len(expected)
+
+
+def testChunkedReaderEmptyFile(tmp_path):
+    csv_path = writeCsv(tmp_path, 'id,user_id\n')
+    assert list(iNatCsv.ChunkedReader(csv_path, workers=1).rows()) == []
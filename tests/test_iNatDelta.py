@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: test_iNatDelta.py
+# Tests of the row hashing and comparison behind the delta import
+
+# import Python packages
+import io
+import numpy
+import iNatDelta
+
+
+def writeCsv(tmp_path, name, text):
+    csv_path = str(tmp_path / name)
+    with io.open(csv_path, 'w', encoding='utf8', newline='') as csv_file:
+        csv_file.write(text)
+    return csv_path
+
+
+def hashes(ids, digests, keys):
+    return (numpy.array(ids, dtype=numpy.int64), numpy.array(digests, dtype=numpy.uint64),
+            numpy.array(keys, dtype=numpy.int64))
+
+
+def testDiffHashes():
+    old = hashes([1, 2, 3, 4], [10, 20, 30, 40], [100, 200, 300, 400])
+    new = hashes([2, 3, 4, 5], [20, 31, 40, 50], [200, 301, 400, 500])
+    inserted, updated, deleted, keys = iNatDelta.diffHashes(old, new)
+    assert inserted.tolist() == [5]
+    assert updated.tolist() == [3]
+    assert deleted.tolist() == [1]
+    assert sorted(keys.tolist()) == [100, 300, 301, 500]
+
+
+def testDiffHashesRepeatedIds():
+    # identical rows of a table without an id field share an id
+    old = hashes([4, 4, 5, 6], [7, 7, 8, 9], [-1, -1, 1, 2])
+    new = hashes([4, 6, 6, 7], [7, 9, 9, 10], [-1, 2, 2, 3])
+    inserted, updated, deleted, keys = iNatDelta.diffHashes(old, new)
+    assert (inserted.tolist(), updated.tolist(), deleted.tolist()) == ([7], [], [5])
+    assert sorted(keys.tolist()) == [1, 3]
+
+
+def testRowHashes(tmp_path):
+    old = iNatDelta.rowHashes(writeCsv(tmp_path, 'old.csv', 'id,observation_id,body\n3,30,c\n1,10,a\n2,,b\n'),
+                              'observation_id')
+    new = iNatDelta.rowHashes(writeCsv(tmp_path, 'new.csv', 'id,observation_id,body\n1,10,a\n2,,B\n4,40,d\n'),
+                              'observation_id')
+    assert old[0].tolist() == [1, 2, 3]
+    assert old[2].tolist() == [10, -1, 30]
+    assert old[1].dtype == numpy.uint64
+    inserted, updated, deleted, keys = iNatDelta.diffHashes(old, new)
+    assert (inserted.tolist(), updated.tolist(), deleted.tolist()) == ([4], [2], [3])
+    assert sorted(keys.tolist()) == [30, 40]
+
+
+def testRowHashesWithoutIds(tmp_path):
+    text = 'taxon_id,status\n5,S1\n5,S1\n6,S2\n'
+    ids, digests, keys = iNatDelta.rowHashes(writeCsv(tmp_path, 'statuses.csv', text), 'taxon_id')
+    assert len(ids) == 3
+    # ids are the hashes themselves, so identical rows share one
+    assert len(set(ids.tolist())) == 2
+    assert (ids.view(numpy.uint64) == digests ^ numpy.uint64(1 << 63)).all()
+    assert sorted(keys.tolist()) == [5, 5, 6]
@@ -0,0 +1,93 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: test_iNatJoins.py
+# Tests of the id sets and joins against plain Python sets and sorts
+
+# import Python packages
+import numpy
+import pytest
+import iNatJoins
+
+
+@pytest.mark.parametrize('ids, bitmap', [([3, 5, 8, 13, 21], True), ([0, 7, 8, 15, 16], True),
+                                         ([2, 10 ** 12, 7, 2], False), ([], False)])
+def testIdSetContains(ids, bitmap):
+    id_set = iNatJoins.IdSet(ids + [-1])
+    assert (id_set.bitmap is not None) == bitmap
+    assert len(id_set) == len(set(ids))
+    values = numpy.array(list(range(-2, 30)) + [10 ** 12, 10 ** 12 + 1], dtype=numpy.int64)
+    assert id_set.contains(values).tolist() == [int(value) in ids for value in values]
+    assert None not in id_set
+    assert all(i in id_set for i in ids)
+
+
+def testIdSetBitmapNoLargerThanSortedIds():
+    ids = numpy.random.default_rng(2).choice(10 ** 6, 20000, replace=False)
+    id_set = iNatJoins.IdSet(ids)
+    assert id_set.bitmap is not None
+    assert id_set.bitmap.nbytes <= id_set.ids.nbytes
+    values = numpy.arange(-1, 10 ** 6 + 10, dtype=numpy.int64)
+    assert (id_set.contains(values) == numpy.isin(values, ids)).all()
+
+
+def testIdSetUnion():
+    union = iNatJoins.IdSet([1, 2, 3]).union(iNatJoins.IdSet([3, 400000]))
+    assert union.ids.tolist() == [1, 2, 3, 400000]
+
+
+def testSemiJoin():
+    rows = [(i, str(i % 17) if i % 5 else None if i % 2 else 'x') for i in range(1000)]
+    id_set = iNatJoins.IdSet([0, 3, 16, 99])
+    expected = [row for row in rows if row[1] is not None and row[1] != 'x' and int(row[1]) in (0, 3, 16)]
+    assert list(iNatJoins.semiJoin(rows, 1, id_set, size=64)) == expected
+
+
+def sortRows(count=20000):
+    random = numpy.random.default_rng(4)
+    keys = random.integers(0, 5000, count).tolist()
+    return [(i, None if i % 97 == 0 else keys[i], 'row ' + str(i)) for i in range(count)]
+
+
+def expectedSort(rows, nulls=False):
+    # stable by key, nulls first with key -1 if kept
+    keyed = [(-1 if row[1] is None else row[1], row) for row in rows if nulls or row[1] is not None]
+    return sorted(keyed, key=lambda pair: pair[0])
+
+
+def testExternalSortInMemory(tmp_path):
+    rows = sortRows(500)
+    assert list(iNatJoins.externalSort(rows, 1, folder=str(tmp_path))) == expectedSort(rows)
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize('fan_in', [64, 3])
+@pytest.mark.parametrize('nulls', [False, True])
+def testExternalSortRuns(tmp_path, monkeypatch, fan_in, nulls):
+    # a cap of a few thousand rows gives several runs, and a fan-in of 3 intermediate merge passes
+    monkeypatch.setattr(iNatJoins, 'merge_fan_in', fan_in)
+    rows = sortRows()
+    result = list(iNatJoins.externalSort(iter(rows), 1, memory=200000, folder=str(tmp_path), nulls=nulls))
+    assert [key for key, row in result] == [key for key, row in expectedSort(rows, nulls)]
+    assert sorted(row for key, row in result) == sorted(row for key, row in expectedSort(rows, nulls))
+    # runs are deleted
+    assert list(tmp_path.iterdir()) == []
+
+
+def testMergeJoin():
+    keyed_rows = [(1, 'a'), (2, 'b'), (2, 'c'), (5, 'd'), (7, 'e'), (9, 'f')]
+    assert list(iNatJoins.mergeJoin(keyed_rows, [0, 2, 3, 7])) == ['b', 'c', 'e']
+    assert list(iNatJoins.mergeJoin(keyed_rows, [])) == []
+    assert list(iNatJoins.mergeJoin([], [1, 2])) == []
+
+
+def testSortedSemiJoin(tmp_path):
+    rows = sortRows()
+    id_set = iNatJoins.IdSet(range(0, 5000, 7))
+    result = list(iNatJoins.sortedSemiJoin(iter(rows), 1, id_set, memory=200000, folder=str(tmp_path)))
+    expected = [row for key, row in expectedSort(rows) if key % 7 == 0]
+    assert [row[1] for row in result] == [row[1] for row in expected]
+    assert sorted(result) == sorted(expected)
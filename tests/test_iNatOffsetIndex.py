@@ -0,0 +1,70 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: test_iNatOffsetIndex.py
+# Tests of the offset index lookups of an observation and its related rows
+
+# import Python packages
+import io
+import os
+import pytest
+import iNatOffsetIndex
+
+
+extract = {'observations': 'id,taxon_id,user_id,description\n'
+                           '20,7,3,"two\nlines, one comma"\n'
+                           '10,8,,plain\n'
+                           '30,,4,"quoted ""word"""\n',
+           'identifications': 'id,observation_id,taxon_id\n1,10,8\n2,20,7\n3,10,9\n4,,7\n5,20,7\n',
+           'comments': 'id,parent_id,body\n1,20,"first\nsecond"\n2,30,\n',
+           'taxa': 'id,name\n7,Castor canadensis\n8,Picea glauca\n',
+           'users': 'id,login\n3,someone\n4,"someone, else"\n'}
+
+
+def writeExtract(tmp_path, tables):
+    folder = str(tmp_path)
+    os.makedirs(folder + '/test', exist_ok=True)
+    for table, text in tables.items():
+        with io.open(iNatOffsetIndex.extractCsv(folder, 'test', table), 'w', encoding='utf8',
+                     newline='') as csv_file:
+            csv_file.write(text)
+    return folder
+
+
+def testLookup(tmp_path):
+    folder = writeExtract(tmp_path, extract)
+    assert iNatOffsetIndex.buildIndex(folder, 'test', workers=1) == 3 + 4 + 2 + 2 + 2
+    with iNatOffsetIndex.OffsetIndex(folder, 'test') as offset_index:
+        found = offset_index.lookup(20)
+        assert found['observations'] == [{'id': '20', 'taxon_id': '7', 'user_id': '3',
+                                          'description': 'two\nlines, one comma'}]
+        assert [row['id'] for row in found['identifications']] == ['2', '5']
+        assert found['comments'] == [{'id': '1', 'parent_id': '20', 'body': 'first\nsecond'}]
+        # tables missing from the extract have no rows
+        assert found['annotations'] == [] and found['quality_metrics'] == []
+        assert found['taxa'] == [{'id': '7', 'name': 'Castor canadensis'}]
+        assert found['users'] == [{'id': '3', 'login': 'someone'}]
+        found = offset_index.lookup(10)
+        assert [row['id'] for row in found['identifications']] == ['1', '3']
+        assert found['comments'] == [] and found['users'] == []
+        found = offset_index.lookup(30)
+        assert found['observations'][0]['description'] == 'quoted "word"'
+        assert found['taxa'] == [] and found['users'] == [{'id': '4', 'login': 'someone, else'}]
+        assert offset_index.lookup(40) == {}
+        assert offset_index.rows('identifications', 7) == []
+
+
+def testChangedCsv(tmp_path):
+    folder = writeExtract(tmp_path, extract)
+    iNatOffsetIndex.buildIndex(folder, 'test', workers=1)
+    writeExtract(tmp_path, {'users': 'id,login\n3,someone\n4,another\n5,new\n'})
+    with pytest.raises(ValueError):
+        iNatOffsetIndex.OffsetIndex(folder, 'test')
+    # only the changed table is indexed again
+    assert iNatOffsetIndex.buildIndex(folder, 'test', workers=1) == 3
+    with iNatOffsetIndex.OffsetIndex(folder, 'test') as offset_index:
+        assert offset_index.lookup(30)['users'] == [{'id': '4', 'login': 'another'}]
+        assert offset_index.rows('users', 5) == [{'id': '5', 'login': 'new'}]
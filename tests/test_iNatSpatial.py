@@ -0,0 +1,80 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: test_iNatSpatial.py
+# Tests of the NumPy point in polygon engine against a brute force crossing number test
+
+# import Python packages
+import numpy
+import pytest
+import iNatBackends
+import iNatSpatial
+
+
+def starRing(cx, cy, outer, inner, points=7):
+    """A concave star, with vertices not aligned to the grid."""
+    angles = numpy.linspace(0, 2 * numpy.pi, 2 * points, endpoint=False) + 0.123
+    radii = numpy.where(numpy.arange(2 * points) % 2 == 0, outer, inner)
+    return numpy.column_stack((cx + radii * numpy.cos(angles), cy + radii * numpy.sin(angles)))
+
+
+# a star with a square hole, a second part and a square whose edges lie on cell boundaries
+test_rings = [starRing(-75.03, 45.01, 2.0, 0.8), numpy.array([[-75.3, 44.7], [-74.7, 44.7], [-74.7, 45.3],
+                                                              [-75.3, 45.3]]),
+              starRing(-70.0, 48.0, 0.5, 0.2, 5), numpy.array([[-68.0, 44.0], [-67.0, 44.0], [-67.0, 45.0],
+                                                               [-68.0, 45.0], [-68.0, 44.0]])]
+
+
+@pytest.mark.parametrize('cell_size', [0.1, 0.37, 5.0])
+def testPolygonGridMatchesBruteForce(cell_size):
+    polygon = iNatSpatial.PolygonGrid('test', 0, test_rings, cell_size)
+    random = numpy.random.default_rng(11)
+    x = numpy.concatenate((random.uniform(-78, -66, 200000), numpy.round(random.uniform(-78, -66, 5000), 1)))
+    y = numpy.concatenate((random.uniform(42, 50, 200000), numpy.round(random.uniform(42, 50, 5000), 1)))
+    inside = polygon.contains(x, y)
+    assert inside.any() and not inside.all()
+    assert (inside == iNatSpatial.bruteForceContains(polygon, x, y)).all()
+    # the mask alone never contradicts the exact test
+    states = polygon.cellStates(x, y)
+    assert inside[states == iNatSpatial.cell_inside].all()
+    assert not inside[states == iNatSpatial.cell_outside].any()
+
+
+def testPolygonGridNullPoints():
+    polygon = iNatSpatial.PolygonGrid('test', 0, test_rings)
+    x = numpy.array([numpy.nan, -75.03, -75.03, -100.0])
+    y = numpy.array([45.0, numpy.nan, 45.6, 45.0])
+    assert polygon.contains(x, y).tolist() == [False, False, True, False]
+
+
+def testJurisdictionIndexGroups():
+    index = iNatSpatial.JurisdictionIndex([iNatSpatial.PolygonGrid('ON', 0, test_rings[:2]),
+                                           iNatSpatial.PolygonGrid('ON', 1, test_rings[2:3]),
+                                           iNatSpatial.PolygonGrid('NB', 0, test_rings[3:])])
+    x = numpy.array([-75.03, -70.0, -67.5, -75.0])
+    y = numpy.array([45.6, 48.0, 44.5, 45.0])
+    assert index.containsAny(x, y, ['ON']).tolist() == [True, True, False, False]
+    assert index.containsAny(x, y, ['ON'], (0,)).tolist() == [True, False, False, False]
+    assert index.containsAny(x, y, ['CA'], (0,)).tolist() == [True, False, True, False]
+    assert index.containsAny(x, y, ['AC']).tolist() == [False, False, True, False]
+
+
+def testShapefileBuffersMatchBruteForce():
+    index = iNatSpatial.loadJurisdictions()
+    x, y = iNatSpatial.syntheticPoints(20000, numpy.random.default_rng(5))[:2]
+    for polygon in index.select(['PE', 'NS', 'YT']):
+        assert (polygon.contains(x, y) == iNatSpatial.bruteForceContains(polygon, x, y)).all()
+
+
+def testCanadaGdbBuffersMatchShapefile():
+    # the EBAR export selects the gdb buffers by JurisdictionID with arcpy and the shapefile CA group without
+    pytest.importorskip('arcpy')
+    gdb = iNatSpatial.loadJurisdictions(None, iNatSpatial.jurisdiction_buffer)
+    shapefile = iNatSpatial.loadJurisdictions()
+    x, y = iNatSpatial.syntheticPoints(200000, numpy.random.default_rng(3))[:2]
+    canada = iNatBackends.ArcpyBackend().canadaJurisdictions()
+    assert sorted(canada) == sorted(iNatSpatial.iNatExchangeUtils.jurisdiction_groups['CA'])
+    assert (gdb.containsAny(x, y, canada, (0,)) == shapefile.containsAny(x, y, ['CA'], (0,))).all()
@@ -0,0 +1,80 @@
+# encoding: utf-8
+
+# Project: iNatExchangeTools
+# Credits: Randal Greene, Allison Siemens-Worsley
+# © NatureServe Canada 2021 under CC BY 4.0 (https://creativecommons.org/licenses/by/4.0/)
+
+# Program: test_iNatTaxa.py
+# Tests of the taxon name prefix index against plain string matching
+
+# import Python packages
+import iNatTaxa
+
+
+names = [('Acer saccharum', 1), ('Acer rubrum', 2), ('acer', 3), ('Aceraceae', 4), ('Abies balsamea', 5),
+         ('Ursus americanus', 6), ('Ursus', 7), ('Straße', 8), ('Ácer', 9), ('Acer saccharum', 1),
+         ('Acer saccharum', 10)]
+
+
+def prefixIndex():
+    return iNatTaxa.PrefixIndex((iNatTaxa.nameKey(name), taxon_id) for name, taxon_id in names)
+
+
+def testPrefixIndexMatchesStartswith():
+    index = prefixIndex()
+    # duplicate pairs are kept once
+    assert len(index) == len(set(names))
+    for prefix in ['Acer', 'ACER S', 'acer sacch', 'Ursus', 'u', 'Ab', 'Zea', '', 'STRASSE', 'Ác']:
+        expected = set(taxon_id for name, taxon_id in names if name.casefold().startswith(prefix.casefold()))
+        assert index.taxonIds([prefix]) == expected, prefix
+
+
+def testPrefixIndexSeveralPrefixes():
+    assert prefixIndex().taxonIds(['Ursus a', 'Abies']) == {5, 6}
+    assert prefixIndex().taxonIds([]) == set()
+
+
+def testNameIdsExactNames():
+    index = prefixIndex()
+    assert index.nameIds(['ACER SACCHARUM']) == {1, 10}
+    assert index.nameIds(['Acer', 'Ursus']) == {3, 7}
+    assert index.nameIds(['Acer sacch']) == set()
+
+
+def testNameList():
+    assert iNatTaxa.nameList("'Acer saccharum'; Ursus ;;'Abies'") == ['Acer saccharum', 'Ursus', 'Abies']
+
+
+def randomTaxa(count=3000):
+    # a random tree under a few roots with iNat style ancestries, plus a taxon whose parent is missing
+    import random
+    rng = random.Random(8)
+    ancestries = {1: None, 2: None}
+    for taxon_id in range(3, count):
+        parent = rng.randrange(1, taxon_id)
+        ancestries[taxon_id] = (ancestries[parent] + '/' if ancestries[parent] else '') + str(parent)
+    ancestries[count] = '999999/' + str(count + 1)
+    return list(ancestries.items())
+
+
+def testNestedIntervalsMatchAncestries():
+    taxa = randomTaxa()
+    intervals = iNatTaxa.nestedIntervals(taxa)
+    assert sorted(taxon_id for taxon_id, start, end in intervals) == sorted(taxon_id for taxon_id, ancestry in taxa)
+    assert sorted(start for taxon_id, start, end in intervals) == list(range(len(taxa)))
+    index = iNatTaxa.CladeIndex(intervals)
+    for clade_id in [1, 2, 3, 50, 777, len(taxa)]:
+        expected = set(taxon_id for taxon_id, ancestry in taxa
+                       if taxon_id == clade_id or (ancestry and str(clade_id) in ancestry.split('/')))
+        assert index.descendantIds([clade_id]) == expected, clade_id
+    assert index.descendantIds([3, 50, 424242]) == index.descendantIds([3]) | index.descendantIds([50])
+
+
+def testNestedIntervalsDeepChain():
+    # deeper than Python's default recursion limit
+    depth = 5000
+    taxa = [(1, None)] + [(taxon_id, '/'.join(str(i) for i in range(1, taxon_id))) for taxon_id in range(2, 200)]
+    taxa += [(taxon_id, '1/' + str(taxon_id - 1)) for taxon_id in range(200, depth)]
+    intervals = dict((taxon_id, (start, end)) for taxon_id, start, end in iNatTaxa.nestedIntervals(taxa))
+    assert intervals[1] == (0, depth - 2)
+    assert intervals[depth - 1] == (depth - 2, depth - 2)